@@ -0,0 +1,159 @@
+from sqlite_store import SqliteStore
+import logging
+import os
+import shutil
+import time
+
+
+STATES = ('pending', 'in_flight', 'done', 'failed')
+
+
+class BatchLedger(SqliteStore):
+    """
+    Filer-level state of a batch crawl, backed by SQLite, so an interrupted batch resumes where it stopped instead of starting over.
+
+    Every CIK moves from pending to in_flight when a spider starts on it, then to done or failed. A job directory (see run_batch) keeps the
+    ledger in <job>/ledger.db and gives each in-flight filer its own Scrapy JOBDIR (<job>/spiders/<cik>/) holding its pending requests, which
+    is deleted once the filer is done. Without a job directory the ledger lives in memory and only drives the retry passes.
+
+    :var job_dir (str | None): The job directory, or None for an in-memory ledger
+    """
+
+    def __init__(self, job_dir=None):
+        """
+        Opens (and creates if needed) the ledger
+
+        :param job_dir: The job directory, or None to keep the ledger in memory
+        """
+
+        self.job_dir = job_dir
+        if job_dir is not None:
+            os.makedirs(os.path.join(job_dir, 'spiders'), exist_ok=True)
+
+        super().__init__(os.path.join(job_dir, 'ledger.db') if job_dir is not None else ':memory:', ["""
+            CREATE TABLE IF NOT EXISTS filers (
+                cik TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )
+        """, 'CREATE INDEX IF NOT EXISTS filers_state ON filers (state, position)'])
+
+    def add(self, ciks, batch_size=1000):
+        """
+        Adds CIKs to the end of the batch as pending. CIKs already in the ledger keep their state, so a batch file can be passed again to resume
+
+        :param ciks: Iterable of CIKs, consumed in batches
+        :param batch_size: Number of CIKs inserted per transaction
+        :return (int): The number of new CIKs
+        """
+
+        added = 0
+        batch = []
+
+        for cik in ciks:
+            batch.append(cik)
+            if len(batch) >= batch_size:
+                added += self._insert(batch)
+                batch = []
+        if batch:
+            added += self._insert(batch)
+        return added
+
+    def _insert(self, ciks):
+        with self.transaction() as connection:
+            position = connection.execute('SELECT COALESCE(MAX(position), -1) + 1 FROM filers').fetchone()[0]
+            before = connection.total_changes
+            connection.executemany('INSERT OR IGNORE INTO filers (cik, position, state, updated_at) VALUES (?, ?, \'pending\', ?)',
+                                   [(cik, position + index, time.time()) for index, cik in enumerate(ciks)])
+            added = connection.total_changes - before
+        return added
+
+    def claim(self):
+        """
+        Moves the next pending CIK to in_flight
+
+        :return (str | None): The CIK, or None once nothing is pending
+        """
+
+        with self.transaction() as connection:
+            row = connection.execute('SELECT cik FROM filers WHERE state = \'pending\' ORDER BY position LIMIT 1').fetchone()
+            if row is not None:
+                connection.execute('UPDATE filers SET state = \'in_flight\', attempts = attempts + 1, updated_at = ? WHERE cik = ?', (time.time(), row[0]))
+        return row[0] if row is not None else None
+
+    def finish(self, cik, succeeded, error=None):
+        """
+        Records the outcome of a filer's crawl. The JOBDIR of a finished filer is deleted, a failed filer starts over on its next attempt
+
+        :param cik: The CIK
+        :param succeeded: Whether the filer was fully crawled
+        :param error: What went wrong, for failed filers
+        """
+
+        with self._lock:
+            self._connection.execute('UPDATE filers SET state = ?, error = ?, updated_at = ? WHERE cik = ?',
+                                     ('done' if succeeded else 'failed', error, time.time(), cik))
+        self.remove_spider_dir(cik)
+
+    def requeue(self, states):
+        """
+        Moves every CIK in the given states back to pending, such as the in_flight filers of an interrupted run or the failed ones before a retry pass
+
+        :param states: Iterable of states
+        :return (int): The number of CIKs moved
+        """
+
+        states = tuple(states)
+        with self._lock:
+            cursor = self._connection.execute(f'UPDATE filers SET state = \'pending\', updated_at = ? WHERE state IN ({", ".join("?" * len(states))})',
+                                              (time.time(),) + states)
+        return cursor.rowcount
+
+    def ciks(self, state):
+        """
+        :param state: One of STATES
+        :return (list): The CIKs in that state, in batch order
+        """
+
+        return [row[0] for row in self._connection.execute('SELECT cik FROM filers WHERE state = ? ORDER BY position', (state,))]
+
+    def counts(self):
+        """
+        :return (dict): The number of CIKs in each state
+        """
+
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self._connection.execute('SELECT state, COUNT(*) FROM filers GROUP BY state').fetchall())
+        return counts
+
+    def spider_dir(self, cik):
+        """
+        :param cik: The CIK
+        :return (str | None): The JOBDIR of the filer's spider, or None without a job directory
+        """
+
+        if self.job_dir is None:
+            return None
+        return os.path.join(self.job_dir, 'spiders', cik)
+
+    def remove_spider_dir(self, cik):
+        spider_dir = self.spider_dir(cik)
+        if spider_dir is not None and os.path.isdir(spider_dir):
+            shutil.rmtree(spider_dir, ignore_errors=True)
+
+
+def resume_spider_dir(spider_dir):
+    """
+    Prepares the JOBDIR of a filer that was in flight when its run stopped. Its queued requests are kept, but the fingerprints of requests that were
+    already sent are dropped: responses still being downloaded when the process died were never handled, and would otherwise never be requested again
+
+    :param spider_dir: The JOBDIR
+    """
+
+    seen = os.path.join(spider_dir, 'requests.seen')
+    if os.path.exists(seen):
+        os.remove(seen)
+        logging.debug(f'Dropped request fingerprints of {spider_dir}')
@@ -0,0 +1,314 @@
+from utilities import make_13f_dir
+from edgar_fixtures import write_corpus
+from w3lib.url import canonicalize_url
+from scrapy.http import Response
+from scrapy.responsetypes import responsetypes
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is reported as None there
+    resource = None
+
+
+FIXTURE_DIR = './benchmark_fixtures'
+SIZES = (100, 1000, 10000, 100000)
+# The original BeautifulSoup engine takes minutes on 100k row tables
+SOUP_MAX_ROWS = 10000
+# A case counts as a regression when its rows/sec drops by more than this fraction against the baseline
+REGRESSION_THRESHOLD = 0.2
+
+
+class FixtureReplayMiddleware:
+    """
+    Scrapy downloader middleware that answers every request from a fixture corpus instead of the network. Requests for URLs missing from the
+    corpus get a 404, so a crawl can never reach sec.gov.
+
+    Settings:
+        FIXTURE_DIR: Directory holding the corpus and its urls.json, see edgar_fixtures.write_corpus
+    """
+
+    def __init__(self, fixture_dir):
+        """
+        :param fixture_dir: Directory holding the corpus
+        """
+
+        self.fixture_dir = fixture_dir
+        with open(os.path.join(fixture_dir, 'urls.json'), 'rt') as urls_file:
+            self.urls = json.load(urls_file)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.get('FIXTURE_DIR', FIXTURE_DIR))
+
+    def process_request(self, request, spider):
+        """
+        :param request: The Scrapy Request
+        :param spider: The Spider that made the request
+        :return (Response): The recorded response
+        """
+
+        entry = self.urls.get(canonicalize_url(request.url))
+        if entry is None:
+            logging.warning(f'No fixture for {request.url}')
+            return Response(request.url, status=404, request=request)
+
+        with open(os.path.join(self.fixture_dir, entry['file']), 'rb') as fixture_file:
+            body = fixture_file.read()
+
+        headers = {'Content-Type': entry['content_type']}
+        response_class = responsetypes.from_args(headers=headers, url=request.url, body=body)
+        return response_class(request.url, status=200, headers=headers, body=body, request=request)
+
+
+def _peak_rss():
+    """
+    :return (tuple): Peak resident set size in MB of this process and of its largest reaped child (the parser workers), or (None, None)
+    """
+
+    if resource is None:
+        return None, None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1), \
+           round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)
+
+
+def _time_parse_info_table(fixture_dir, case, repeat):
+    from xml_parser import INFO_TABLE_PARSERS
+
+    with open(os.path.join(fixture_dir, case['file']), 'rb') as table_file:
+        raw_xml = table_file.read()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = INFO_TABLE_PARSERS[case['engine']](raw_xml, 'benchmark', '2019_08_14')
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), rows
+
+
+def _time_parse_primary_doc(fixture_dir, case, repeat):
+    from xml_parser import parse_primary_doc
+
+    documents = []
+    for file_name in case['files']:
+        with open(os.path.join(fixture_dir, file_name), 'rb') as document_file:
+            documents.append(document_file.read())
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for raw_xml in documents:
+            parse_primary_doc(raw_xml)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), len(documents)
+
+
+def _time_crawl(fixture_dir, case, repeat):
+    # The Twisted reactor can't be restarted, so a crawl is only ever run once per process
+    from scrapy import signals
+    from scrapy.crawler import CrawlerProcess
+    from mutual_fund_spider import MutualFundsSpider
+
+    class ReplaySpider(MutualFundsSpider):
+        custom_settings = dict(MutualFundsSpider.custom_settings, HTTPCACHE_ENABLED=False,
+                               DOWNLOADER_MIDDLEWARES={'benchmark.FixtureReplayMiddleware': 50})
+
+    rows = []
+
+    def item_scraped(item, response, spider):
+        if item.get('document') == 'info_table':
+            rows.append(item.get('rows', 0))
+
+    process = CrawlerProcess(settings={'LOG_LEVEL': 'WARNING', 'FIXTURE_DIR': os.path.abspath(fixture_dir)})
+    crawler = process.create_crawler(ReplaySpider)
+    crawler.signals.connect(item_scraped, signal=signals.item_scraped)
+    process.crawl(crawler, cik=case['cik'], depth=case['filings'], parser=case['engine'], force=True)
+
+    start = time.perf_counter()
+    process.start()
+    seconds = time.perf_counter() - start
+
+    if len(rows) != case['filings']:
+        raise RuntimeError(f'Expected {case["filings"]} holdings reports, scraped {len(rows)}')
+    return seconds, sum(rows)
+
+
+CASE_RUNNERS = {
+    'parse_info_table': _time_parse_info_table,
+    'parse_primary_doc': _time_parse_primary_doc,
+    'crawl': _time_crawl,
+}
+
+
+def run_case(fixture_dir, case, repeat=3):
+    """
+    Runs one benchmark case in the current process, inside a scratch directory so reports and caches never touch ./13F_Reports
+
+    :param fixture_dir: Directory holding the fixture corpus
+    :param case: Case description, as built by list_cases
+    :param repeat: Number of timed runs, the fastest is reported
+    :return (dict): The case with its seconds, rows, rows_per_sec and peak RSS added
+    """
+
+    fixture_dir = os.path.abspath(fixture_dir)
+    with tempfile.TemporaryDirectory(prefix='edgar_benchmark_') as work_dir:
+        os.chdir(work_dir)
+        make_13f_dir()
+        seconds, rows = CASE_RUNNERS[case['kind']](fixture_dir, case, repeat)
+        os.chdir(fixture_dir)
+
+    peak_rss_mb, peak_worker_rss_mb = _peak_rss()
+    return dict(case, seconds=round(seconds, 4), rows=rows, rows_per_sec=round(rows / seconds, 1) if seconds else None,
+                peak_rss_mb=peak_rss_mb, peak_worker_rss_mb=peak_worker_rss_mb)
+
+
+def list_cases(corpus, soup_max_rows=SOUP_MAX_ROWS):
+    """
+    :param corpus: The corpus manifest returned by edgar_fixtures.write_corpus
+    :param soup_max_rows: Largest table the soup engine is timed on
+    :return (list): Every benchmark case over the corpus, each a dict with a unique name
+    """
+
+    cases = []
+    for table in corpus['info_tables']:
+        for engine in ('lxml', 'soup'):
+            if engine == 'soup' and table['rows'] > soup_max_rows:
+                continue
+            cases.append({'name': f'parse_info_table/{engine}/{table["variant"]}/{table["rows"]}', 'kind': 'parse_info_table', 'engine': engine,
+                          'file': table['file']})
+
+    cases.append({'name': 'parse_primary_doc', 'kind': 'parse_primary_doc', 'files': corpus['primary_docs']})
+
+    for filer in corpus['filers']:
+        cases.append({'name': f'crawl/lxml/{filer["variant"]}/{filer["rows"]}', 'kind': 'crawl', 'engine': 'lxml', 'cik': filer['cik'],
+                      'filings': filer['filings']})
+
+    return cases
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    :param results: Results of this run
+    :param baseline: Results of an earlier run, as saved with -output
+    :param threshold: Fraction of rows/sec a case may lose before it counts as a regression
+    :return (list): Names of the cases that regressed
+    """
+
+    previous = {result['name']: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result['name'])
+        if before and before.get('rows_per_sec') and result.get('rows_per_sec') is not None \
+                and result['rows_per_sec'] < before['rows_per_sec'] * (1 - threshold):
+            logging.warning(f'Regression in {result["name"]}: {result["rows_per_sec"]:,.0f} rows/sec, was {before["rows_per_sec"]:,.0f}')
+            regressions.append(result['name'])
+    return regressions
+
+
+def main():
+    """
+    Runs the benchmark suite against a local fixture corpus, with no network access. Every case runs in its own subprocess, so peak RSS is
+    measured per case and each crawl gets a fresh reactor.
+
+    Flags:
+        -fixtures=DIR: Fixture corpus directory (default ./benchmark_fixtures), generated on first use
+        -generate: Regenerate the corpus
+        -sizes=100,1000: Information table sizes to generate
+        -soup_max_rows=N: Skip the soup engine on tables larger than N rows
+        -repeat=N: Timed runs per parse case, the fastest is reported
+        -filter=TEXT: Only run cases whose name contains TEXT
+        -output=FILE: Save the results as JSON
+        -baseline=FILE: Compare against saved results, exiting with status 1 on a regression
+    """
+
+    fixture_dir = FIXTURE_DIR
+    sizes = SIZES
+    soup_max_rows = SOUP_MAX_ROWS
+    repeat = 3
+    generate = False
+    name_filter = None
+    output = None
+    baseline = None
+    case = None
+
+    for arg in sys.argv[1:]:
+        if arg.startswith('-fixtures='):
+            fixture_dir = arg.split('=', 1)[1]
+        elif arg == '-generate':
+            generate = True
+        elif arg.startswith('-sizes='):
+            sizes = tuple(int(size) for size in arg.split('=', 1)[1].split(','))
+            generate = True
+        elif arg.startswith('-soup_max_rows='):
+            soup_max_rows = int(arg.split('=', 1)[1])
+        elif arg.startswith('-repeat='):
+            repeat = max(1, int(arg.split('=', 1)[1]))
+        elif arg.startswith('-filter='):
+            name_filter = arg.split('=', 1)[1]
+        elif arg.startswith('-output='):
+            output = arg.split('=', 1)[1]
+        elif arg.startswith('-baseline='):
+            baseline = arg.split('=', 1)[1]
+        elif arg.startswith('-case='):
+            # Internal: run a single JSON encoded case and print its result
+            case = json.loads(arg.split('=', 1)[1])
+
+    if case is not None:
+        print(json.dumps(run_case(fixture_dir, case, repeat)))
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    corpus_path = os.path.join(fixture_dir, 'corpus.json')
+    if generate or not os.path.exists(corpus_path):
+        logging.info(f'Generating fixture corpus in {fixture_dir}')
+        corpus = write_corpus(fixture_dir, sizes)
+    else:
+        with open(corpus_path, 'rt') as corpus_file:
+            corpus = json.load(corpus_file)
+
+    results = []
+    for case in list_cases(corpus, soup_max_rows):
+        if name_filter and name_filter not in case['name']:
+            continue
+
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), f'-fixtures={os.path.abspath(fixture_dir)}', f'-repeat={repeat}',
+                                f'-case={json.dumps(case)}'], stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if child.returncode != 0:
+            logging.error(f'{case["name"]} failed with exit status {child.returncode}')
+            results.append(dict(case, error=child.returncode))
+            continue
+
+        result = json.loads(child.stdout.decode().strip().splitlines()[-1])
+        results.append(result)
+        logging.info(f'{result["name"]:<40} {result["seconds"]:>9.3f}s {result["rows_per_sec"]:>14,.0f} rows/sec '
+                     f'{result["peak_rss_mb"]:>8} MB peak RSS ({result["peak_worker_rss_mb"]} MB workers)')
+
+    if output:
+        with open(output, 'wt') as output_file:
+            json.dump(results, output_file, indent=1)
+
+    if baseline:
+        with open(baseline, 'rt') as baseline_file:
+            if compare(results, json.load(baseline_file)):
+                sys.exit(1)
+        logging.info('No regressions against the baseline')
+
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
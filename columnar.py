@@ -0,0 +1,257 @@
+from array import array
+import csv
+import itertools
+import os
+import shutil
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Columns stored as int64, missing values are stored as -1
+INT_COLUMNS = ('value', 'sshprnamt', 'votingauthority_sole', 'votingauthority_shared', 'votingauthority_none')
+# Columns stored as fixed-width byte strings
+FIXED_COLUMNS = {'cusip': 9}
+MISSING_INT = -1
+
+
+def columnar_path(fund_name, date):
+    """
+    Returns the location of the columnar copy of a 13F holdings report, next to its .tsv file
+
+    :param fund_name: The name (CIK) of the filer
+    :param date: The period of the report
+    :return (str): Path of the column directory
+    """
+
+    return f'./13F_Reports/{fund_name.lower().strip()}_13f_holdings_{date.lower().strip()}.cols'
+
+
+class DictionaryColumn:
+    """
+    Dictionary encoded text column: every distinct value is stored once in categories, and each row is an int32 code into it
+
+    :var codes (ndarray): int32 code of each row
+    :var categories (ndarray): Distinct values, as a unicode array
+    """
+
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def decode(self):
+        """
+        :return (ndarray): The text value of every row
+        """
+
+        return self.categories[self.codes]
+
+
+class ColumnBuilder:
+    """
+    Accumulates flattened holdings rows into typed columns, using compact array.array buffers rather than lists of Python objects.
+    Columns discovered partway through a report are back-filled as missing for the rows before them.
+
+    :var count (int): Number of rows added
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.columns = { }
+        self.dictionaries = { }
+
+    def add(self, row):
+        """
+        Appends one row
+
+        :param row: Dict of header -> text value, as produced by iter_info_table_rows
+        """
+
+        for name in row:
+            if name not in self.columns:
+                self._add_column(name)
+
+        for name, column in self.columns.items():
+            value = row.get(name)
+
+            if name in INT_COLUMNS:
+                try:
+                    column.append(int(value.replace(',', '')) if value else MISSING_INT)
+                except ValueError:
+                    column.append(MISSING_INT)
+            elif name in FIXED_COLUMNS:
+                width = FIXED_COLUMNS[name]
+                column.extend((value or '').strip().upper().encode('ascii', 'replace')[:width].ljust(width, b' '))
+            else:
+                dictionary = self.dictionaries[name]
+                value = value if value is not None else ''
+                code = dictionary.get(value)
+                if code is None:
+                    code = dictionary[value] = len(dictionary)
+                column.append(code)
+
+        self.count += 1
+
+    def _add_column(self, name):
+        if name in INT_COLUMNS:
+            self.columns[name] = array('q', [MISSING_INT]) * self.count
+        elif name in FIXED_COLUMNS:
+            self.columns[name] = bytearray(b' ' * FIXED_COLUMNS[name] * self.count)
+        else:
+            self.dictionaries[name] = {'': 0}
+            self.columns[name] = array('i', [0]) * self.count
+
+    def to_arrays(self):
+        """
+        Converts the buffers into NumPy arrays without copying the numeric data
+
+        :return (dict): Column name -> ndarray, or DictionaryColumn for text columns
+        """
+
+        arrays = { }
+        for name, column in self.columns.items():
+            if name in INT_COLUMNS:
+                arrays[name] = np.frombuffer(column, dtype=np.int64)
+            elif name in FIXED_COLUMNS:
+                arrays[name] = np.frombuffer(bytes(column), dtype=f'S{FIXED_COLUMNS[name]}')
+            else:
+                arrays[name] = DictionaryColumn(np.frombuffer(column, dtype=np.int32), np.array(list(self.dictionaries[name]), dtype=str))
+        return arrays
+
+
+class ColumnarHoldingsWriter:
+    """
+    Writes a 13F holdings report as a directory of .npy files, one per column, that np.load can memory-map.
+
+    value, sshprnamt and the votingauthority_* fields are int64 (-1 when missing), cusip is a fixed-width 9 byte string, and every other column is
+    dictionary encoded into <column>.codes.npy (int32) and <column>.dict.npy (the distinct values). Requires NumPy.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the column directory to create
+        """
+
+        if np is None:
+            raise ImportError('NumPy is required for columnar output, install it with: pip install numpy')
+
+        self.path = path
+        self.builder = ColumnBuilder()
+
+    def add(self, row):
+        """
+        Appends one row
+
+        :param row: Dict of header -> text value
+        """
+
+        self.builder.add(row)
+
+    def close(self):
+        """
+        Writes every column to disk. The directory is written under a temporary name first and then renamed, so readers never see a partial report
+        """
+
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+
+        for name, column in self.builder.to_arrays().items():
+            if isinstance(column, DictionaryColumn):
+                np.save(os.path.join(temp_path, f'{name}.codes.npy'), column.codes)
+                np.save(os.path.join(temp_path, f'{name}.dict.npy'), column.categories)
+            else:
+                np.save(os.path.join(temp_path, f'{name}.npy'), column)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(temp_path, self.path)
+
+
+def load_holdings(path, names=None):
+    """
+    Loads a 13F holdings report as typed columns. Column directories written by ColumnarHoldingsWriter are memory-mapped, so nothing is parsed
+    or copied. A .tsv report is parsed into the same layout as a fallback.
+
+    :param path: Path of a .cols directory or a .tsv file
+    :param names: Only load these columns, or every column if None
+    :return (dict): Column name -> ndarray, or DictionaryColumn for text columns
+    """
+
+    if np is None:
+        raise ImportError('NumPy is required to load columnar holdings, install it with: pip install numpy')
+
+    if os.path.isdir(path):
+        columns = { }
+        for file_name in os.listdir(path):
+            if file_name.endswith('.codes.npy'):
+                name = file_name[:-len('.codes.npy')]
+                if names is not None and name not in names:
+                    continue
+                columns[name] = DictionaryColumn(np.load(os.path.join(path, file_name), mmap_mode='r'), np.load(os.path.join(path, f'{name}.dict.npy')))
+            elif file_name.endswith('.npy') and not file_name.endswith('.dict.npy'):
+                if names is not None and file_name[:-len('.npy')] not in names:
+                    continue
+                columns[file_name[:-len('.npy')]] = np.load(os.path.join(path, file_name), mmap_mode='r')
+        return columns
+
+    return _load_tsv(path, names)
+
+
+def _load_tsv(path, names=None):
+    """
+    Parses a .tsv report into the layout of load_holdings a whole column at a time: the rows are transposed once, and each column is converted
+    in one pass, instead of building a dict per row
+
+    :param path: Path of the .tsv file
+    :param names: Only load these columns, or every column if None
+    :return (dict): Column name -> ndarray, or DictionaryColumn for text columns
+    """
+
+    with open(path, 'rt', newline='') as tsv_file:
+        reader = csv.reader(tsv_file, delimiter='\t')
+        headers = next(reader, None)
+        if headers is None:
+            return { }
+        # Short rows are padded with the missing placeholder, like the N/A fields of the TSV writer
+        values = list(itertools.zip_longest(*reader, fillvalue='N/A'))
+
+    columns = { }
+    for index, name in enumerate(headers):
+        if names is not None and name not in names:
+            continue
+        column = values[index] if index < len(values) else ()
+
+        if name in INT_COLUMNS:
+            try:
+                columns[name] = np.fromiter(map(int, column), dtype=np.int64, count=len(column))
+            except ValueError:
+                # Missing values or thousands separators, convert value by value
+                columns[name] = np.fromiter(map(_parse_int, column), dtype=np.int64, count=len(column))
+        elif name in FIXED_COLUMNS:
+            width = FIXED_COLUMNS[name]
+            columns[name] = np.array([(value if value != 'N/A' else '').strip().upper().encode('ascii', 'replace')[:width].ljust(width, b' ')
+                                      for value in column], dtype=f'S{width}')
+        else:
+            # Distinct values in order of appearance, with missing values as code 0 like ColumnBuilder
+            categories = dict.fromkeys(('',))
+            categories.update(dict.fromkeys(column))
+            categories.pop('N/A', None)
+            codes = {value: code for code, value in enumerate(categories)}
+            codes['N/A'] = 0
+            columns[name] = DictionaryColumn(np.fromiter(map(codes.__getitem__, column), dtype=np.int32, count=len(column)),
+                                             np.array(list(categories), dtype=str))
+    return columns
+
+
+def _parse_int(value):
+    if value in ('', 'N/A'):
+        return MISSING_INT
+    try:
+        return int(value.replace(',', ''))
+    except ValueError:
+        return MISSING_INT
@@ -0,0 +1,317 @@
+from w3lib.url import canonicalize_url
+from xml.sax.saxutils import escape
+import json
+import os
+import random
+
+
+# Synthetic filers get CIKs from this range, far away from real EDGAR CIKs
+BASE_CIK = 9000000000
+INFO_TABLE_NAMESPACE = 'http://www.sec.gov/edgar/document/thirteenf/informationtable'
+ISSUERS = ['APPLE INC', 'MICROSOFT CORP', 'AMAZON COM INC', 'ALPHABET INC', 'BERKSHIRE HATHAWAY INC DEL', 'JOHNSON & JOHNSON', 'EXXON MOBIL CORP',
+           'JPMORGAN CHASE & CO', 'PROCTER AND GAMBLE CO', 'VISA INC', 'WALMART INC', 'CATERPILLAR INC', 'ECOLAB INC', 'WASTE MGMT INC DEL']
+CLASSES = ['COM', 'CL A', 'CL B', 'SHS', 'SPONSORED ADR']
+
+
+def fixture_cik(index):
+    """
+    :param index: Index of the synthetic filer
+    :return (str): Its CIK, zero padded to 10 digits like EDGAR's
+    """
+
+    return f'{BASE_CIK + index:010d}'
+
+
+def accession_number(cik, sequence):
+    """
+    :param cik: The filer's CIK
+    :param sequence: Index of the filing, 0 is the most recent
+    :return (str): A synthetic accession number formatted 9000000000-19-000001, the last part being sequence + 1
+    """
+
+    return f'{int(cik):010d}-{19 - sequence // 4 % 20:02d}-{sequence + 1:06d}'
+
+
+def accession_sequence(accession):
+    """
+    :param accession: An accession number generated by accession_number, dashed or not
+    :return (int): The sequence it was generated from
+    """
+
+    return int(accession.replace('-', '')[-6:]) - 1
+
+
+def filing_date(sequence):
+    """
+    :param sequence: Index of the filing, 0 is the most recent
+    :return (str): Filing date (YYYY-MM-DD) of a quarterly 13F-HR, one quarter apart going back from 2019-08-14
+    """
+
+    quarter = sequence % 4
+    month = (8, 5, 2, 11)[quarter]
+    year = 2019 - sequence // 4 - (1 if quarter == 3 else 0)
+    return f'{year}-{month:02d}-14'
+
+
+def filing_detail_path(cik, accession):
+    return f'/Archives/edgar/data/{int(cik)}/{accession.replace("-", "")}/{accession}-index.htm'
+
+
+def listing_page(cik, name, filings, start=0, count=100, other_forms=0):
+    """
+    Generates a browse-edgar company listing page
+
+    :param cik: The filer's CIK
+    :param name: The filer's name
+    :param filings: Total number of 13F-HR filings the filer has
+    :param start: Index of the first filing on this page
+    :param count: Number of rows per page
+    :param other_forms: Number of non 13F rows mixed in per page
+    :return (str): The HTML of the page
+    """
+
+    # Pages are numbered by start // count like EDGAR's, other_forms of each page's rows are taken by non 13F filings
+    per_page = max(count - other_forms, 1)
+    first = start // count * per_page
+
+    rows = []
+    for sequence in range(first, min(first + per_page, filings)):
+        accession = accession_number(cik, sequence)
+        rows.append(f'<tr><td nowrap="nowrap">13F-HR</td><td nowrap="nowrap"><a href="{filing_detail_path(cik, accession)}" id="documentsbutton">&nbsp;Documents</a></td>'
+                    f'<td class="small">Quarterly report filed by institutional managers, Holdings<br />Acc-no: {accession}</td>'
+                    f'<td>{filing_date(sequence)}</td><td></td></tr>')
+    for other in range(other_forms if first < filings else 0):
+        rows.append(f'<tr><td nowrap="nowrap">SC 13G</td><td nowrap="nowrap"><a href="/Archives/edgar/data/{int(cik)}/0/{other}-index.htm" id="documentsbutton">&nbsp;Documents</a></td>'
+                    f'<td class="small">Statement of acquisition of beneficial ownership</td><td>2019-01-01</td><td></td></tr>')
+
+    next_button = ''
+    if first + per_page < filings:
+        next_button = f'<input type="button" value="Next {count}" onClick="parent.location=\'/cgi-bin/browse-edgar?action=getcompany&amp;CIK={cik}&amp;type=&amp;dateb=&amp;owner=exclude&amp;start={start + count}&amp;count={count}\'">'
+
+    return f"""<html><head><title>EDGAR Search Results</title></head><body>
+<div id="headerBottom"><div id="PageTitle">EDGAR Search Results</div></div>
+<div id="contentDiv">
+<div class="companyInfo"><span class="companyName">{escape(name)} <acronym title="Central Index Key">CIK</acronym>#: <a href="/cgi-bin/browse-edgar?action=getcompany&amp;CIK={cik}&amp;owner=exclude&amp;count=40">{cik} (see all company filings)</a></span></div>
+<div id="seriesDiv"><table class="tableFile2" summary="Results">
+<tr><th>Filings</th><th>Format</th><th>Description</th><th>Filing Date</th><th>File/Film Number</th></tr>
+{''.join(rows)}
+</table></div>
+{next_button}
+</div></body></html>"""
+
+
+def filing_detail_page(cik, accession, date, info_table_name='form13fInfoTable.xml'):
+    """
+    Generates the Filing Detail (index.htm) page of a 13F-HR filing
+
+    :param cik: The filer's CIK
+    :param accession: The filing's accession number
+    :param date: The filing date (YYYY-MM-DD)
+    :param info_table_name: File name of the information table
+    :return (str): The HTML of the page
+    """
+
+    directory = f'/Archives/edgar/data/{int(cik)}/{accession.replace("-", "")}'
+    return f"""<html><head><title>EDGAR Filing Documents for {accession}</title></head><body>
+<div id="headerBottom"><div id="PageTitle">Filing Detail</div></div>
+<div id="contentDiv">
+<div id="formDiv"><div id="formHeader"><div id="formName"><strong>Form 13F-HR</strong> - Quarterly report filed by institutional managers, Holdings:</div>
+<div id="secNum"><strong><acronym title="Securities and Exchange Commission">SEC</acronym> Accession <acronym title="Number">No.</acronym></strong> {accession}</div></div>
+<div class="formContent"><div class="formGrouping"><div class="infoHead">Filing Date</div><div class="info">{date}</div>
+<div class="infoHead">Accepted</div><div class="info">{date} 16:05:12</div></div>
+<div class="formGrouping"><div class="infoHead">Period of Report</div><div class="info">{date}</div></div></div></div>
+<div id="formDiv"><div><table class="tableFile" summary="Document Format Files">
+<tr><th scope="col">Seq</th><th scope="col">Description</th><th scope="col">Document</th><th scope="col">Type</th><th scope="col">Size</th></tr>
+<tr><td scope="row">1</td><td scope="row"></td><td scope="row"><a href="{directory}/primary_doc.html">primary_doc.html</a></td><td scope="row">13F-HR</td><td scope="row"></td></tr>
+<tr class="blueRow"><td scope="row">&nbsp;</td><td scope="row"></td><td scope="row"><a href="{directory}/primary_doc.xml">primary_doc.xml</a></td><td scope="row">13F-HR</td><td scope="row">3518</td></tr>
+<tr><td scope="row">2</td><td scope="row">INFORMATION TABLE</td><td scope="row"><a href="{directory}/{info_table_name}">{info_table_name}</a></td><td scope="row">INFORMATION TABLE</td><td scope="row"></td></tr>
+<tr><td scope="row">&nbsp;</td><td scope="row">Complete submission text file</td><td scope="row"><a href="{directory}/{accession}.txt">{accession}.txt</a></td><td scope="row">&nbsp;</td><td scope="row"></td></tr>
+</table></div></div>
+</div></body></html>"""
+
+
+def primary_doc(cik, name, date, entries=0, total_value=0):
+    """
+    Generates a primary_doc.xml cover page
+
+    :param cik: The filer's CIK
+    :param name: The filer's name
+    :param date: The filing date (YYYY-MM-DD)
+    :param entries: tableEntryTotal
+    :param total_value: tableValueTotal
+    :return (str): The XML document
+    """
+
+    year, month, _ = date.split('-')
+    quarter_end = {'02': '12-31', '05': '03-31', '08': '06-30', '11': '09-30'}.get(month, '06-30')
+    quarter_year = int(year) - 1 if month == '02' else int(year)
+    period = f'{quarter_end}-{quarter_year}'
+
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<edgarSubmission xmlns="http://www.sec.gov/edgar/thirteenffiler" xmlns:ns1="http://www.sec.gov/edgar/common">
+  <headerData><submissionType>13F-HR</submissionType><filerInfo><liveTestFlag>LIVE</liveTestFlag><flags><confirmingCopyFlag>false</confirmingCopyFlag>
+  <returnCopyFlag>false</returnCopyFlag><overrideInternetFlag>false</overrideInternetFlag></flags>
+  <filer><credentials><cik>{cik}</cik><ccc>XXXXXXXX</ccc></credentials></filer><periodOfReport>{period}</periodOfReport></filerInfo></headerData>
+  <formData><coverPage><reportCalendarOrQuarter>{period}</reportCalendarOrQuarter><isAmendment>false</isAmendment>
+  <filingManager><name>{escape(name)}</name><address><ns1:street1>1 Synthetic Way</ns1:street1><ns1:city>Kirkland</ns1:city>
+  <ns1:stateOrCountry>WA</ns1:stateOrCountry><ns1:zipCode>98033</ns1:zipCode></address></filingManager>
+  <reportType>13F HOLDINGS REPORT</reportType><form13FFileNumber>028-10098</form13FFileNumber><provideInfoForInstruction5>N</provideInfoForInstruction5></coverPage>
+  <signatureBlock><name>Jane Doe</name><title>Authorized Agent</title><phone>(425) 555-0100</phone><signature>Jane Doe</signature>
+  <city>Kirkland</city><stateOrCountry>WA</stateOrCountry><signatureDate>{date[5:7]}-{date[8:10]}-{year}</signatureDate></signatureBlock>
+  <summaryPage><otherIncludedManagersCount>0</otherIncludedManagersCount><tableEntryTotal>{entries}</tableEntryTotal>
+  <tableValueTotal>{total_value}</tableValueTotal><isConfidentialOmitted>false</isConfidentialOmitted></summaryPage></formData>
+</edgarSubmission>
+"""
+
+
+def iter_info_table(rows, ns1=False, seed=0):
+    """
+    Generates a 13F information table chunk by chunk, so even 100k row tables are never built as one string
+
+    :param rows: Number of holdings
+    :param ns1: Use the ns1: prefixed variant instead of a default namespace
+    :param seed: Seed of the random holdings, the same seed always produces the same table
+    :return (generator): Chunks of the XML document
+    """
+
+    prefix = 'ns1:' if ns1 else ''
+    declaration = f'xmlns:ns1="{INFO_TABLE_NAMESPACE}"' if ns1 else f'xmlns="{INFO_TABLE_NAMESPACE}"'
+    generator = random.Random(seed)
+
+    yield f'<?xml version="1.0" encoding="UTF-8"?>\n<{prefix}informationTable {declaration} xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+
+    def tag(name, value):
+        return f'<{prefix}{name}>{value}</{prefix}{name}>'
+
+    chunk = []
+    for row in range(rows):
+        shares = generator.randint(1, 5000000)
+        put_call = tag('putCall', generator.choice(('Put', 'Call'))) if generator.random() < 0.05 else ''
+        other_manager = tag('otherManager', generator.randint(1, 9)) if generator.random() < 0.2 else ''
+        chunk.append(f'<{prefix}infoTable>'
+                     f'{tag("nameOfIssuer", escape(generator.choice(ISSUERS)))}{tag("titleOfClass", generator.choice(CLASSES))}'
+                     f'{tag("cusip", f"{generator.randint(0, 999999):06d}{generator.randint(10, 99)}{row % 10}")}{tag("value", shares * generator.randint(1, 300) // 1000)}'
+                     f'<{prefix}shrsOrPrnAmt>{tag("sshPrnamt", shares)}{tag("sshPrnamtType", "SH")}</{prefix}shrsOrPrnAmt>{put_call}'
+                     f'{tag("investmentDiscretion", generator.choice(("SOLE", "DFND", "OTR")))}{other_manager}'
+                     f'<{prefix}votingAuthority>{tag("Sole", shares)}{tag("Shared", 0)}{tag("None", 0)}</{prefix}votingAuthority>'
+                     f'</{prefix}infoTable>\n')
+        if len(chunk) == 1000:
+            yield ''.join(chunk)
+            chunk = []
+
+    yield ''.join(chunk) + f'</{prefix}informationTable>\n'
+
+
+def info_table(rows, ns1=False, seed=0):
+    """
+    :return (bytes): The whole information table generated by iter_info_table
+    """
+
+    return ''.join(iter_info_table(rows, ns1, seed)).encode('utf-8')
+
+
+
+def full_submission(cik, name, accession, date, rows, ns1=False, seed=0):
+    """
+    Generates the full submission .txt file of a 13F-HR filing, the form EDGAR's quarterly indexes link to
+
+    :param cik: The filer's CIK
+    :param name: The filer's name
+    :param accession: The accession number
+    :param date: The filing date (YYYY-MM-DD)
+    :param rows: Number of holdings in the information table
+    :param ns1: Use the ns1: prefixed information table
+    :param seed: Seed of the random holdings
+    :return (bytes): The submission
+    """
+
+    header = (f'<SEC-DOCUMENT>{accession}.txt : {date.replace("-", "")}\n<SEC-HEADER>{accession}.hdr.sgml : {date.replace("-", "")}\n'
+              f'ACCESSION NUMBER:\t\t{accession}\nCONFORMED SUBMISSION TYPE:\t13F-HR\nFILED AS OF DATE:\t\t{date.replace("-", "")}\n'
+              f'FILER:\n\tCOMPANY DATA:\n\t\tCOMPANY CONFORMED NAME:\t\t\t{name}\n\t\tCENTRAL INDEX KEY:\t\t\t{int(cik):010d}\n</SEC-HEADER>\n')
+    cover = (f'<DOCUMENT>\n<TYPE>13F-HR\n<SEQUENCE>1\n<FILENAME>primary_doc.xml\n<TEXT>\n<XML>\n{primary_doc(cik, name, date, entries=rows)}</XML>\n'
+             f'</TEXT>\n</DOCUMENT>\n')
+    table = '<DOCUMENT>\n<TYPE>INFORMATION TABLE\n<SEQUENCE>2\n<FILENAME>form13fInfoTable.xml\n<TEXT>\n<XML>\n'
+    return (header + cover + table).encode('utf-8') + info_table(rows, ns1, seed) + b'</XML>\n</TEXT>\n</DOCUMENT>\n</SEC-DOCUMENT>\n'
+
+
+def master_index(entries, year, quarter):
+    """
+    Generates a quarterly master.idx file
+
+    :param entries: (cik, company name, form type, date filed, accession number) of every filing
+    :param year: Year of the index
+    :param quarter: Quarter of the index, 1 to 4
+    :return (str): The index
+    """
+
+    lines = ['Description:           Master Index of EDGAR Dissemination Feed', f'Last Data Received:    {year} QTR{quarter}',
+             'Comments:              webmaster@sec.gov', 'Anonymous FTP:         ftp://ftp.sec.gov/edgar/', '', '', '',
+             'CIK|Company Name|Form Type|Date Filed|Filename', '-' * 80]
+    for cik, name, form, date, accession in entries:
+        lines.append(f'{int(cik)}|{name}|{form}|{date}|edgar/data/{int(cik)}/{accession}.txt')
+    return '\n'.join(lines) + '\n'
+
+
+def write_corpus(fixture_dir, sizes=(100, 1000, 10000, 100000), filings=2, crawl_max_rows=10000):
+    """
+    Writes a fixture corpus for benchmark.py: an information table of every size in both the ns1: and plain variants, and for every table up to
+    crawl_max_rows rows a synthetic filer whose listing page, Filing Detail pages and documents can be replayed by URL.
+
+    urls.json maps each canonicalized URL to the file holding its response. Recorded EDGAR responses can be added to a corpus the same way, by
+    saving the body and adding its URL to urls.json.
+
+    :param fixture_dir: Directory to write the corpus to
+    :param sizes: Row counts of the information tables
+    :param filings: Number of 13F-HR filings of each synthetic filer
+    :param crawl_max_rows: Largest table size that gets a filer for end-to-end crawls
+    :return (dict): The corpus manifest, also written to corpus.json
+    """
+
+    os.makedirs(fixture_dir, exist_ok=True)
+    urls = { }
+    corpus = {'info_tables': [], 'primary_docs': [], 'filers': []}
+
+    def add_url(path, file_name, content_type):
+        urls[canonicalize_url(f'https://www.sec.gov{path}')] = {'file': file_name, 'content_type': content_type}
+
+    def write(file_name, content):
+        with open(os.path.join(fixture_dir, file_name), 'wb') as fixture_file:
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            fixture_file.write(content)
+
+    for index, (rows, ns1) in enumerate((rows, ns1) for rows in sizes for ns1 in (False, True)):
+        variant = 'ns1' if ns1 else 'plain'
+        table_name = f'info_table_{variant}_{rows}.xml'
+        with open(os.path.join(fixture_dir, table_name), 'wt', encoding='utf-8') as table_file:
+            for chunk in iter_info_table(rows, ns1, seed=index):
+                table_file.write(chunk)
+        corpus['info_tables'].append({'file': table_name, 'rows': rows, 'variant': variant})
+
+        if rows > crawl_max_rows:
+            continue
+
+        cik = fixture_cik(index)
+        name = f'SYNTHETIC {variant.upper()} {rows} ADVISORS LLC'
+        write(f'listing_{cik}.html', listing_page(cik, name, filings))
+        add_url(f'/cgi-bin/browse-edgar?action=getcompany&CIK={cik}&type=&dateb=&owner=exclude&count=100', f'listing_{cik}.html', 'text/html')
+
+        for sequence in range(filings):
+            accession = accession_number(cik, sequence)
+            date = filing_date(sequence)
+            directory = f'/Archives/edgar/data/{int(cik)}/{accession.replace("-", "")}'
+            write(f'{accession}-index.htm', filing_detail_page(cik, accession, date))
+            write(f'{accession}-primary_doc.xml', primary_doc(cik, name, date, entries=rows))
+            add_url(f'{directory}/{accession}-index.htm', f'{accession}-index.htm', 'text/html')
+            add_url(f'{directory}/primary_doc.xml', f'{accession}-primary_doc.xml', 'text/xml')
+            add_url(f'{directory}/form13fInfoTable.xml', table_name, 'text/xml')
+            corpus['primary_docs'].append(f'{accession}-primary_doc.xml')
+
+        corpus['filers'].append({'cik': cik, 'rows': rows, 'variant': variant, 'filings': filings})
+
+    with open(os.path.join(fixture_dir, 'urls.json'), 'wt') as urls_file:
+        json.dump(urls, urls_file, indent=1)
+    with open(os.path.join(fixture_dir, 'corpus.json'), 'wt') as corpus_file:
+        json.dump(corpus, corpus_file, indent=1)
+
+    return corpus
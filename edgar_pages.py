@@ -0,0 +1,110 @@
+from lxml import etree
+from urllib.parse import urlparse
+import re
+
+
+# Page types returned by read_page
+NO_MATCH = 'no_match'
+LISTING = 'listing'
+COMPANY_MATCHES = 'company_matches'
+FILING_DETAIL = 'filing_detail'
+PRIMARY_DOC = 'primary_doc'
+INFO_TABLE = 'info_table'
+UNKNOWN = 'unknown'
+
+# XPath expressions are compiled once at import instead of for every response. Per filer values are passed in as XPath variables ($name...)
+# rather than formatted into the expression, so one compiled expression serves every spider
+_NO_MATCH = etree.XPath('boolean(//div[@id="contentDiv"]/div[contains(text(), "No matching")] | //h1[contains(text(), "No matching")])')
+_PAGE_TITLE = etree.XPath('//div[@id="headerBottom"]/div[@id="PageTitle"]/text()')
+_COMPANY_NAME = etree.XPath('boolean(//div[@id="contentDiv"]//span[@class="companyName" and (contains(text(), $name) or //a[contains(@href, $cik_parameter)])])')
+_COMPANY_CIK = etree.XPath('//div[@id="contentDiv"]//span[@class="companyName"]/a/text()')
+_COMPANY_MATCHES = etree.XPath('boolean(//div[@id="contentDiv"]/span[@class="companyMatch" and contains(text(), "Companies with names matching")])')
+_COMPANY_LINK = etree.XPath('//div[@id="seriesDiv"]/table//tr[td[1][a[text()=$cik]]]/td[1]/a/@href')
+_FILING_ROWS = etree.XPath('//div[@id="seriesDiv"]/table//tr[td[1][contains(text(), "13F") and contains(text(), "HR")]]')
+_ROW_DATE = etree.XPath('string(td[4])')
+_ROW_LINK = etree.XPath('string(td[2]/a/@href)')
+_NEXT_BUTTON = etree.XPath('boolean(//input[@type="button" and contains(@value, "Next")])')
+_NEXT_BUTTON_ACTION = etree.XPath('string(//input[@type="button" and contains(@value, "Next")]/@onclick)')
+# The Next button navigates with onClick="parent.location='<url>'"
+_NEXT_LOCATION = re.compile(r"location\s*=\s*'([^']+)'")
+_FILING_DATE = etree.XPath('//div[@id="contentDiv"]//div[@class="formContent"]//div[@class="formGrouping"]//div[@class="infoHead" and contains(text(), "Filing Date")]'
+                           '/following-sibling::div/text()')
+_DOCUMENT_ROWS = etree.XPath('//div[@id="contentDiv"]//table[@class="tableFile"]//tr[td[3]/a]')
+_DOCUMENT_NAME = etree.XPath('string(td[3]/a)')
+_DOCUMENT_LINK = etree.XPath('string(td[3]/a/@href)')
+_DOCUMENT_TYPE = etree.XPath('string(td[4])')
+
+
+def page_type_from_url(url):
+    """
+    Decides what a response is from its URL alone, so XML documents never have to be parsed as HTML just to be recognised
+
+    :param url: The response URL
+    :return (str | None): PRIMARY_DOC, INFO_TABLE, FILING_DETAIL, or None when the page has to be classified by its content
+    """
+
+    path = urlparse(url).path
+    if path.endswith('primary_doc.xml'):
+        return PRIMARY_DOC
+    if path.endswith('.xml'):
+        return INFO_TABLE
+    if path.endswith('index.htm'):
+        return FILING_DETAIL
+    return None
+
+
+def read_page(response, fund_name=None, fund_cik=None):
+    """
+    Classifies an EDGAR response and extracts everything the spider needs from it in one pass over the page
+
+    :param response: The Scrapy Response
+    :param fund_name: Name of the filer being crawled, matched against listing pages
+    :param fund_cik: CIK of the filer being crawled
+    :return (dict): 'type' (one of the page types above) and the fields of that page:
+        LISTING: cik (of the listed company), filings ([(filing date, Filing Detail URL)] of every 13F-HR row, newest first), has_next and
+            next_url (the page the Next button leads to, or None if it has no link)
+        COMPANY_MATCHES: company_url, the listing of fund_cik among the matches or None
+        FILING_DETAIL: filing_date, primary_doc_url and info_table_url
+    """
+
+    page_type = page_type_from_url(response.url)
+    if page_type in (PRIMARY_DOC, INFO_TABLE):
+        return {'type': page_type}
+
+    root = response.selector.root
+    title = ' '.join(_PAGE_TITLE(root))
+
+    if page_type == FILING_DETAIL and 'Filing Detail' in title:
+        return _read_filing_detail(response, root)
+
+    if _NO_MATCH(root):
+        return {'type': NO_MATCH}
+
+    if 'EDGAR Search Results' in title and (fund_name is not None or fund_cik is not None) \
+            and _COMPANY_NAME(root, name=str(fund_name), cik_parameter=f'CIK={fund_cik}'):
+        filings = [(_ROW_DATE(row).strip(), response.urljoin(_ROW_LINK(row))) for row in _FILING_ROWS(root)]
+        cik = _COMPANY_CIK(root)
+        next_location = _NEXT_LOCATION.search(_NEXT_BUTTON_ACTION(root))
+        return {'type': LISTING, 'cik': cik[0].split(' ')[0].strip() if cik else None, 'filings': filings, 'has_next': _NEXT_BUTTON(root),
+                'next_url': response.urljoin(next_location.group(1)) if next_location else None}
+
+    if fund_name is not None and _COMPANY_MATCHES(root):
+        link = _COMPANY_LINK(root, cik=str(fund_cik)) if fund_cik is not None else []
+        return {'type': COMPANY_MATCHES, 'company_url': response.urljoin(link[0]) if link else None}
+
+    return {'type': UNKNOWN}
+
+
+def _read_filing_detail(response, root):
+    filing_date = _FILING_DATE(root)
+    page = {'type': FILING_DETAIL, 'filing_date': filing_date[0].strip() if filing_date else None, 'primary_doc_url': None, 'info_table_url': None}
+
+    # One pass over the document table finds both target documents
+    for row in _DOCUMENT_ROWS(root):
+        name = _DOCUMENT_NAME(row)
+        if page['primary_doc_url'] is None and name == 'primary_doc.xml':
+            page['primary_doc_url'] = response.urljoin(_DOCUMENT_LINK(row))
+        elif page['info_table_url'] is None and '.xml' in name and 'information table' in _DOCUMENT_TYPE(row).lower():
+            page['info_table_url'] = response.urljoin(_DOCUMENT_LINK(row))
+
+    return page
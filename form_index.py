@@ -0,0 +1,247 @@
+import scrapy
+import gzip
+import io
+import logging
+import os
+import re
+from urllib.parse import urlparse
+from utilities import *
+from mutual_fund_spider import MutualFundsSpider
+from xml_parser import INFO_TABLE_PARSERS
+from manifest import accession_from_url, get_manifest
+
+
+QUARTER_PATTERN = re.compile(r'^(?P<year>\d{4})\s*Q(?P<quarter>[1-4])$', re.IGNORECASE)
+FORM_TYPES = ('13F-HR',)
+# A full submission .txt file concatenates its documents, each opening with a <TYPE> line and wrapping XML content in <XML></XML>
+DOCUMENT_PATTERN = re.compile(rb'<DOCUMENT>(.*?)</DOCUMENT>', re.DOTALL)
+DOCUMENT_TYPE_PATTERN = re.compile(rb'<TYPE>([^\r\n<]*)')
+DOCUMENT_XML_PATTERN = re.compile(rb'<XML>\s*(.*?)\s*</XML>', re.DOTALL)
+
+
+def form_index_url(quarter, base_url='https://www.sec.gov', index='master'):
+    """
+    :param quarter: The quarter, formatted 2019Q2
+    :param base_url: Scheme and host of EDGAR
+    :param index: 'master' or 'form'
+    :return (str | None): URL of EDGAR's quarterly index file, or None if quarter isn't formatted YYYYQn
+    """
+
+    match = QUARTER_PATTERN.match(quarter.strip())
+    if match is None:
+        return None
+    return f'{base_url.rstrip("/")}/Archives/edgar/full-index/{match.group("year")}/QTR{match.group("quarter")}/{index}.idx'
+
+
+def iter_form_index(lines, form_types=FORM_TYPES):
+    """
+    Filters the lines of a master.idx or form.idx file down to the filings of the given form types, one line at a time.
+
+    master.idx lines are pipe separated (CIK|Company Name|Form Type|Date Filed|Filename). form.idx lines are fixed width with the form type first
+    and the CIK, date filed and file name as the last three columns, so the company name (which may contain spaces) is never split.
+
+    :param lines: Iterable of text lines, such as an open file
+    :param form_types: Exact form types to keep; amendments (13F-HR/A) have a form type of their own
+    :return (generator): Dicts of cik, company, form, date (YYYY-MM-DD) and filename (path of the full submission under /Archives/)
+    """
+
+    form_types = set(form_types)
+    for line in lines:
+        line = line.rstrip('\r\n')
+
+        if '|' in line:
+            fields = line.split('|')
+            if len(fields) != 5 or fields[2] not in form_types:
+                continue
+            cik, company, form, date, filename = fields
+        else:
+            # Cheap prefix test before splitting, almost every line of a form.idx file is some other form
+            if not line.startswith(tuple(form_types)):
+                continue
+            head_fields = line.rsplit(None, 3)
+            if len(head_fields) != 4:
+                continue
+            head, cik, date, filename = head_fields
+            form, _, company = head.partition(' ')
+            if form not in form_types:
+                continue
+
+        if not cik.strip().isdigit():
+            continue
+        yield {'cik': cik.strip(), 'company': company.strip(), 'form': form, 'date': date.strip(), 'filename': filename.strip()}
+
+
+def latest_filings(entries):
+    """
+    Keeps the most recent filing of each filer
+
+    :param entries: Entries yielded by iter_form_index
+    :return (list): One entry per CIK, in the order filers first appeared
+    """
+
+    latest = { }
+    for entry in entries:
+        if entry['cik'] not in latest or entry['date'] > latest[entry['cik']]['date']:
+            latest[entry['cik']] = entry
+    return list(latest.values())
+
+
+def open_form_index(path):
+    """
+    Opens a local copy of an index file, gzip compressed or not, for streaming its lines
+
+    :param path: Path of the master.idx/form.idx (or .gz) file
+    :return (file): Text file object. EDGAR indexes are Latin-1 encoded
+    """
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='latin-1')
+    return open(path, 'rt', encoding='latin-1')
+
+
+def split_submission(body):
+    """
+    Pulls the XML documents of a 13F-HR filing out of its full submission .txt file
+
+    :param body: The raw bytes of the submission
+    :return (dict): The raw XML of the 'primary_doc' (the 13F-HR cover page) and the 'info_table', for those present
+    """
+
+    documents = { }
+    for document in DOCUMENT_PATTERN.finditer(body):
+        document_type = DOCUMENT_TYPE_PATTERN.search(document.group(1))
+        xml = DOCUMENT_XML_PATTERN.search(document.group(1))
+        # Cover letters and other exhibits are plain text or HTML
+        if document_type is None or xml is None:
+            continue
+
+        document_type = document_type.group(1).strip().upper()
+        if document_type.startswith(b'13F-HR') and 'primary_doc' not in documents:
+            documents['primary_doc'] = xml.group(1)
+        elif document_type == b'INFORMATION TABLE' and 'info_table' not in documents:
+            documents['info_table'] = xml.group(1)
+    return documents
+
+
+class FormIndexSpider(scrapy.Spider):
+    """
+    Scrapy Spider ingesting every 13F-HR filing of a quarter from EDGAR's quarterly form index, instead of browsing filer by filer.
+
+    The index (a local file, or downloaded through the HTTP cache) is filtered line by line, and each filer's most recent filing is fetched as
+    its full submission .txt file, which holds both the primary_doc.xml cover page and the information table. That is one request per filing
+    instead of the listing page, Filing Detail page and two documents. The documents go through the same ParsingPipeline and manifest as
+    MutualFundsSpider.
+
+    :var index (str): A quarter formatted 2019Q2, or the path of a local master.idx/form.idx file
+    :var form_types ([str]): Form types ingested
+    """
+
+    name = 'FormIndexSpider'
+    custom_settings = MutualFundsSpider.custom_settings
+    base_url = MutualFundsSpider.base_url
+    index = None
+    form_types = FORM_TYPES
+    parser = 'lxml'
+    force = False
+    columnar = False
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        if self.parser not in INFO_TABLE_PARSERS:
+            logging.warning(f'Unknown parser \'{self.parser}\', falling back to \'{FormIndexSpider.parser}\'')
+            self.parser = FormIndexSpider.parser
+
+        self.base_url = self.base_url.rstrip('/')
+        self.allowed_domains = [urlparse(self.base_url).hostname]
+        self.filings_found = 0
+
+    def start_requests(self):
+        """
+        Streams a local index file straight into filing requests, or requests the quarter's index from EDGAR
+
+        :return (generator): Requests
+        """
+
+        if self.index is None:
+            logging.error('No form index given, pass a quarter (2019Q2) or the path of a master.idx/form.idx file')
+            return
+
+        if os.path.exists(self.index):
+            logging.info(f'Reading form index {self.index}')
+            with open_form_index(self.index) as index_file:
+                yield from self.filing_requests(iter_form_index(index_file, self.form_types))
+            return
+
+        url = form_index_url(self.index, self.base_url)
+        if url is None:
+            logging.error(f'{self.index} is neither a file nor a quarter formatted YYYYQn')
+            return
+        yield scrapy.Request(url, callback=self.parse_index)
+
+    async def start(self):
+        """
+        Same as start_requests, for Scrapy versions that start spiders from an async iterable and only fall back to start_urls
+
+        :return (async generator): Requests
+        """
+
+        for request in self.start_requests():
+            yield request
+
+    def parse_index(self, response):
+        """
+        Filters a downloaded index file for the filings to ingest
+
+        :param response: The Response holding master.idx or form.idx
+        :return (generator): Requests for the full submission of each filing
+        """
+
+        lines = io.TextIOWrapper(io.BytesIO(response.body), encoding='latin-1')
+        yield from self.filing_requests(iter_form_index(lines, self.form_types))
+
+    def filing_requests(self, entries):
+        """
+        :param entries: Index entries, as yielded by iter_form_index
+        :return (generator): A request for the full submission of each filer's latest filing not already in the manifest
+        """
+
+        manifest = get_manifest()
+        skipped = 0
+
+        for entry in latest_filings(entries):
+            self.filings_found += 1
+            url = f'{self.base_url}/Archives/{entry["filename"]}'
+            accession = accession_from_url(url)
+            if not self.force and accession is not None and accession in manifest:
+                skipped += 1
+                continue
+
+            yield scrapy.Request(url, callback=self.parse_submission, meta={'entry': entry})
+
+        if skipped:
+            self.crawler.stats.inc_value('manifest/skipped', skipped)
+        logging.info(f'Found {self.filings_found} filers with {"/".join(self.form_types)} filings, {skipped} already ingested')
+
+    def parse_submission(self, response):
+        """
+        Splits a full submission into the items ParsingPipeline parses
+
+        :param response: The Response holding the submission .txt file
+        :return (generator): The primary_doc and info_table items
+        """
+
+        entry = response.meta['entry']
+        accession = accession_from_url(response.url)
+        documents = split_submission(response.body)
+
+        if 'info_table' not in documents:
+            logging.warning(f'No information table in {response.url}')
+            self.crawler.stats.inc_value('form_index/missing_info_table')
+            return
+
+        if 'primary_doc' in documents:
+            yield {'document': 'primary_doc', 'raw_xml': documents['primary_doc'], 'accession': accession}
+
+        yield {'document': 'info_table', 'raw_xml': documents['info_table'], 'accession': accession, 'fund_cik': f'{int(entry["cik"]):010d}',
+               'date': entry['date'].replace('-', '_'), 'parser': self.parser, 'columnar': self.columnar}
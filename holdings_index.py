@@ -0,0 +1,349 @@
+from columnar import load_holdings
+from manifest import Manifest
+import itertools
+import logging
+import os
+import re
+import shutil
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+REPORTS_DIR = './13F_Reports'
+INDEX_DIR = './13F_Reports/cusip_index'
+REPORT_PATTERN = re.compile(r'^(?P<filer>.+)_13f_holdings_(?P<date>.+)\.(?P<format>tsv|cols)$')
+# amendmentType of a 13F-HR/A that only adds holdings to the report it amends, the other kind (RESTATEMENT) replaces it
+NEW_HOLDINGS = 'NEW HOLDINGS'
+
+
+def report_quarter(date):
+    """
+    Guesses the calendar quarter a 13F filing reports on from its filing date, for reports the manifest has no period of report for (see
+    report_periods). Filings are due within 45 days of the end of the quarter they cover, so this is the quarter before the one the filing
+    date falls in
+
+    :param date: The filing date as used in report file names, YYYY_MM_DD
+    :return (str): The quarter formatted YYYYQn, or the date itself if it can't be parsed
+    """
+
+    try:
+        year, month = int(date[0:4]), int(date[5:7])
+    except ValueError:
+        return date
+
+    quarter = (month - 1) // 3
+    if quarter == 0:
+        return f'{year - 1}Q4'
+    return f'{year}Q{quarter}'
+
+
+def period_quarter(period):
+    """
+    :param period: A reportCalendarOrQuarter, formatted MM-DD-YYYY
+    :return (str | None): The quarter formatted YYYYQn, or None if the period can't be parsed
+    """
+
+    try:
+        month, year = int(period[0:2]), int(period[6:10])
+    except (TypeError, ValueError):
+        return None
+    if not 1 <= month <= 12:
+        return None
+    return f'{year}Q{(month - 1) // 3 + 1}'
+
+
+def report_periods(reports_dir=REPORTS_DIR):
+    """
+    Looks up the period of report and amendment type of every ingested filing in the manifest (see manifest.Manifest), which records them from
+    the filing's primary_doc.xml
+
+    :param reports_dir: Directory holding the reports and manifest.db
+    :return (dict): (filer, date) as listed by find_reports -> (quarter, amendment type or None)
+    """
+
+    path = os.path.join(reports_dir, 'manifest.db')
+    if not os.path.exists(path):
+        return { }
+
+    manifest = Manifest(path, read_only=True)
+    try:
+        periods = { }
+        for entry in manifest:
+            quarter = period_quarter(entry.get('period'))
+            if quarter is not None:
+                periods[(entry['cik'].lower().strip(), entry['date'].lower().strip())] = (quarter, entry.get('amendment_type'))
+        return periods
+    finally:
+        manifest.close()
+
+
+def filing_period(filer, date, periods):
+    """
+    :param filer: The filer, as listed by find_reports
+    :param date: The filing date, as listed by find_reports
+    :param periods: As returned by report_periods
+    :return (tuple): The quarter the report covers and its amendment type, None for an original report. Reports missing from the manifest are
+        taken as original reports of the quarter before their filing date
+    """
+
+    return periods.get((filer, date)) or (report_quarter(date), None)
+
+
+def counted_reports(amendment_types):
+    """
+    Decides which of a filer's reports for one quarter make up its holdings for the quarter. The last original report or RESTATEMENT amendment
+    replaces every report filed before it, and NEW HOLDINGS amendments filed after it add their holdings to it
+
+    :param amendment_types: Amendment type of each report (None for an original report), in filing order
+    :return (list): Whether each report counts
+    """
+
+    counted = []
+    replaced = False
+    for amendment_type in reversed(amendment_types):
+        counted.append(not replaced)
+        if amendment_type != NEW_HOLDINGS:
+            replaced = True
+    return counted[::-1]
+
+
+def find_reports(reports_dir=REPORTS_DIR):
+    """
+    Lists every parsed 13F holdings report, preferring the columnar copy of a report when it has one
+
+    :param reports_dir: Directory holding the reports
+    :return (list): (filer, date, path) tuples
+    """
+
+    reports = { }
+    for file_name in os.listdir(reports_dir):
+        match = REPORT_PATTERN.match(file_name)
+        if match is None:
+            continue
+        key = (match.group('filer'), match.group('date'))
+        if key not in reports or match.group('format') == 'cols':
+            reports[key] = os.path.join(reports_dir, file_name)
+
+    return [(filer, date, path) for (filer, date), path in sorted(reports.items())]
+
+
+def report_postings(path, names=False):
+    """
+    Reads the postings of one report: the CUSIP, row offset, value and share count of every holding
+
+    :param path: Path of the report, as listed by find_reports
+    :param names: Also read the issuer name of every holding, as 'nameofissuer' (None if the report has no such column)
+    :return (dict | None): Arrays of cusip, row, value and shares, or None if the report can't be read or has no CUSIP column
+    """
+
+    try:
+        holdings = load_holdings(path, ('cusip', 'value', 'sshprnamt', 'nameofissuer') if names else ('cusip', 'value', 'sshprnamt'))
+    except (IOError, ValueError) as e:
+        logging.warning(f'Skipping {path}: {e}')
+        return None
+    if 'cusip' not in holdings:
+        return None
+
+    count = len(holdings['cusip'])
+    postings = {'cusip': np.asarray(holdings['cusip']), 'row': np.arange(count, dtype=np.int32)}
+    for target, name in (('value', 'value'), ('shares', 'sshprnamt')):
+        column = np.asarray(holdings[name]) if name in holdings else np.zeros(count, dtype=np.int64)
+        # Missing values are stored as -1, count them as 0 in aggregates
+        postings[target] = np.maximum(column, 0)
+    if names:
+        postings['nameofissuer'] = holdings.get('nameofissuer')
+    return postings
+
+
+def merge_postings(reports, postings, periods=None):
+    """
+    Combines the postings of every report into the arrays of the index, sorted by CUSIP, then quarter, then filer
+
+    :param reports: (filer, date, path) tuples, as listed by find_reports
+    :param postings: Callable returning the postings of a report path, see report_postings
+    :param periods: Period of report and amendment type of the reports, as returned by report_periods
+    :return (dict): The index arrays, as saved by build_index and read by HoldingsIndex
+    """
+
+    # Number reports in (quarter, filer, date) order, so sorting postings by report id also sorts them by quarter and filer
+    reports = sorted(((filer, date, path) + filing_period(filer, date, periods or { }) for filer, date, path in reports),
+                     key=lambda report: (report[3], report[0], report[1]))
+
+    cusips, report_ids, rows, values, shares = [], [], [], [], []
+    for report_id, (filer, date, path, _, _) in enumerate(reports):
+        report = postings(path)
+        if report is None:
+            continue
+        cusips.append(report['cusip'])
+        report_ids.append(np.full(len(report['cusip']), report_id, dtype=np.int32))
+        rows.append(report['row'])
+        values.append(report['value'])
+        shares.append(report['shares'])
+
+    if not cusips:
+        cusips, report_ids, rows, values, shares = [np.empty(0, dtype='S9')], [np.empty(0, dtype=np.int32)], [np.empty(0, dtype=np.int32)], \
+                                                   [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+
+    cusip = np.concatenate(cusips)
+    report = np.concatenate(report_ids)
+    order = np.lexsort((report, cusip))
+
+    return {
+        'cusip': cusip[order],
+        'report': report[order],
+        'row': np.concatenate(rows)[order],
+        'value': np.concatenate(values)[order],
+        'shares': np.concatenate(shares)[order],
+        'report_filer': np.array([report[0] for report in reports] or [''], dtype=str),
+        'report_date': np.array([report[1] for report in reports] or [''], dtype=str),
+        'report_quarter': np.array([report[3] for report in reports] or [''], dtype=str),
+        'report_amendment': np.array([report[4] or '' for report in reports] or [''], dtype=str),
+    }
+
+
+def build_index(reports_dir=REPORTS_DIR, index_dir=INDEX_DIR):
+    """
+    Scans every parsed holdings report and writes an inverted index from CUSIP to (filer, period, row offset).
+
+    Postings are stored as parallel .npy arrays sorted by CUSIP, then quarter, then filer, so every CUSIP's postings are one contiguous slice
+    that HoldingsIndex finds with a binary search, and per quarter aggregates are a single reduceat over that slice. Reports are filed under
+    the period of report the manifest recorded for them, see report_periods.
+
+    :param reports_dir: Directory holding the reports
+    :param index_dir: Directory the index is written to
+    :return (int): The number of postings indexed
+    """
+
+    if np is None:
+        raise ImportError('NumPy is required to build the CUSIP index, install it with: pip install numpy')
+
+    reports = find_reports(reports_dir)
+    arrays = merge_postings(reports, report_postings, report_periods(reports_dir))
+
+    temp_dir = f'{index_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_dir, f'{name}.npy'), array)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(temp_dir, index_dir)
+
+    logging.info(f'Indexed {len(arrays["cusip"])} holdings from {len(reports)} reports into {index_dir}')
+    return len(arrays['cusip'])
+
+
+class HoldingsIndex:
+    """
+    Read-only view of the CUSIP index written by build_index. The postings are memory-mapped, so opening the index is instant and queries only
+    touch the slice of the CUSIP they ask about. An index can also be held in memory, from the arrays returned by merge_postings.
+    """
+
+    def __init__(self, index_dir=INDEX_DIR, arrays=None):
+        """
+        :param index_dir: Directory the index was written to
+        :param arrays: The index arrays, as returned by merge_postings, to use instead of reading index_dir
+        """
+
+        if np is None:
+            raise ImportError('NumPy is required to query the CUSIP index, install it with: pip install numpy')
+
+        def load(name, mmap_mode='r'):
+            if arrays is not None:
+                return arrays[name]
+            return np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        def has(name):
+            return name in arrays if arrays is not None else os.path.exists(os.path.join(index_dir, f'{name}.npy'))
+
+        self.cusip = load('cusip')
+        self.report = load('report')
+        self.row = load('row')
+        self.value = load('value')
+        self.shares = load('shares')
+        self.report_filer = load('report_filer', None)
+        self.report_date = load('report_date', None)
+        self.report_quarter = load('report_quarter', None)
+        # Indexes built before amendment types were recorded take every report as an original
+        self.report_amendment = load('report_amendment', None) if has('report_amendment') else np.full(len(self.report_filer), '', dtype=str)
+
+        # Quarters and filers as integer codes, so group boundaries are found with integer comparisons
+        _, self.report_quarter_code = np.unique(self.report_quarter, return_inverse=True)
+        _, self.report_filer_code = np.unique(self.report_filer, return_inverse=True)
+
+        # A filer can have several reports for one quarter, such as an original 13F-HR and 13F-HR/A amendments filed later. A RESTATEMENT
+        # replaces the reports before it and NEW HOLDINGS add to them (see counted_reports), so a filer's holdings are never summed twice
+        order = np.lexsort((self.report_date, self.report_filer_code, self.report_quarter_code))
+        self.report_latest = np.zeros(len(order), dtype=bool)
+        groups = itertools.groupby(order.tolist(), key=lambda report: (self.report_quarter_code[report], self.report_filer_code[report]))
+        for _, group in groups:
+            group = list(group)
+            self.report_latest[group] = counted_reports([self.report_amendment[report] or None for report in group])
+
+    def _slice(self, cusip):
+        key = cusip.strip().upper().encode('ascii').ljust(9, b' ')[:9]
+        return slice(int(np.searchsorted(self.cusip, key, 'left')), int(np.searchsorted(self.cusip, key, 'right')))
+
+    def holders(self, cusip, superseded=False):
+        """
+        Lists every holding of a CUSIP across the indexed reports
+
+        :param cusip: The CUSIP
+        :param superseded: Also list holdings from reports replaced by a later report or RESTATEMENT of the same filer for the same quarter
+        :return (dict): Arrays of filer, date, quarter, amendment (the amendment type, empty for an original report), row (offset into the
+            report), value, shares and latest (False for superseded reports), one entry per holding
+        """
+
+        postings = self._slice(cusip)
+        report = np.asarray(self.report[postings])
+        keep = slice(None) if superseded else self.report_latest[report]
+        report = report[keep]
+        return {
+            'filer': self.report_filer[report],
+            'date': self.report_date[report],
+            'quarter': self.report_quarter[report],
+            'amendment': self.report_amendment[report],
+            'row': np.asarray(self.row[postings])[keep],
+            'value': np.asarray(self.value[postings])[keep],
+            'shares': np.asarray(self.shares[postings])[keep],
+            'latest': self.report_latest[report],
+        }
+
+    def aggregate(self, cusip=None):
+        """
+        Totals the value, share count and number of distinct holders per CUSIP per quarter, from the reports that make up each filer's holdings for
+        the quarter: its latest original report or RESTATEMENT, plus the NEW HOLDINGS amendments filed after it
+
+        :param cusip: Only aggregate this CUSIP, or every CUSIP if None
+        :return (dict): Arrays of cusip, quarter, value, shares and holders, one entry per (CUSIP, quarter)
+        """
+
+        postings = self._slice(cusip) if cusip is not None else slice(0, len(self.cusip))
+        report = np.asarray(self.report[postings])
+        keep = self.report_latest[report]
+        report = report[keep]
+        cusips = np.asarray(self.cusip[postings])[keep]
+        quarter = self.report_quarter_code[report]
+        filer = self.report_filer_code[report]
+
+        if len(cusips) == 0:
+            return {'cusip': cusips, 'quarter': np.empty(0, dtype=str), 'value': np.empty(0, dtype=np.int64),
+                    'shares': np.empty(0, dtype=np.int64), 'holders': np.empty(0, dtype=np.int64)}
+
+        # Postings are sorted by (cusip, quarter, filer), so each group starts where cusip or quarter changes, and each holder where filer also does
+        new_group = np.ones(len(cusips), dtype=bool)
+        new_group[1:] = (cusips[1:] != cusips[:-1]) | (quarter[1:] != quarter[:-1])
+        new_holder = new_group.copy()
+        new_holder[1:] |= filer[1:] != filer[:-1]
+        starts = np.flatnonzero(new_group)
+
+        return {
+            'cusip': cusips[starts],
+            'quarter': self.report_quarter[report[starts]],
+            'value': np.add.reduceat(np.asarray(self.value[postings])[keep], starts),
+            'shares': np.add.reduceat(np.asarray(self.shares[postings])[keep], starts),
+            'holders': np.add.reduceat(new_holder.astype(np.int64), starts),
+        }
@@ -0,0 +1,149 @@
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from urllib.parse import urlparse
+from hashlib import sha1
+import gzip
+import logging
+import os
+import pickle
+import time
+
+
+class EdgarCacheStorage:
+    """
+    Scrapy HTTP cache storage tailored to EDGAR, enabled through MutualFundsSpider.custom_settings.
+
+    Everything under /Archives/edgar/data/ (the Filing Detail index.htm, primary_doc.xml and the information table) is immutable once its
+    accession number exists, so those responses are stored by host/CIK/accession/file name and never expire. Every other page (the browse-edgar
+    company listings) is stored by the SHA-1 of its URL, expires after HTTPCACHE_LISTING_TTL seconds, and is evicted least-recently-used first once
+    more than HTTPCACHE_LISTING_MAX_ENTRIES are stored. All entries are gzip compressed.
+
+    :var cache_dir (str): Root directory of the cache
+    :var listing_ttl (int): Seconds a listing page stays fresh
+    :var listing_max_entries (int): Maximum number of listing pages kept on disk
+    """
+
+    def __init__(self, settings):
+        """
+        Reads the cache configuration from the Scrapy settings
+
+        :param settings: The crawler's Scrapy Settings
+        """
+
+        self.cache_dir = settings.get('HTTPCACHE_DIR')
+        self.listing_ttl = settings.getint('HTTPCACHE_LISTING_TTL', 3600)
+        self.listing_max_entries = settings.getint('HTTPCACHE_LISTING_MAX_ENTRIES', 1000)
+        self.listing_count = 0
+
+    def open_spider(self, spider):
+        """
+        Creates the cache directories and counts the listing pages already stored
+
+        :param spider: The Spider being opened
+        """
+
+        os.makedirs(os.path.join(self.cache_dir, 'immutable'), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, 'listing'), exist_ok=True)
+        self.listing_count = len(os.listdir(os.path.join(self.cache_dir, 'listing')))
+        logging.debug(f'Using EDGAR HTTP cache in {self.cache_dir}')
+
+    def close_spider(self, spider):
+        pass
+
+    def retrieve_response(self, spider, request):
+        """
+        Returns the cached response for the request, or None if it isn't cached or has expired
+
+        :param spider: The Spider making the request
+        :param request: The Scrapy Request
+        :return (Response | None): The cached response
+        """
+
+        path, immutable = self._entry_path(request.url)
+
+        try:
+            with gzip.open(path, 'rb') as cache_file:
+                entry = pickle.load(cache_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if not immutable:
+            if time.time() - entry['time'] > self.listing_ttl:
+                return None
+            # Refresh the access time, which orders listing pages for LRU eviction
+            os.utime(path)
+
+        headers = Headers(entry['headers'])
+        respcls = responsetypes.from_args(headers=headers, url=entry['url'])
+        return respcls(url=entry['url'], headers=headers, status=entry['status'], body=entry['body'])
+
+    def store_response(self, spider, request, response):
+        """
+        Compresses and writes the response to the cache
+
+        :param spider: The Spider that made the request
+        :param request: The Scrapy Request
+        :param response: The downloaded Response
+        """
+
+        path, immutable = self._entry_path(request.url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        entry = {
+            'url': response.url,
+            'status': response.status,
+            'headers': dict(response.headers),
+            'body': response.body,
+            'time': time.time(),
+        }
+
+        exists = os.path.exists(path)
+        # Write to a temporary file first so parallel spiders never read a half written entry
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with gzip.open(temp_path, 'wb') as cache_file:
+            pickle.dump(entry, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+        if not immutable and not exists:
+            self.listing_count += 1
+            if self.listing_count > self.listing_max_entries:
+                self._evict_listings()
+
+    def _evict_listings(self):
+        """
+        Deletes the least recently used listing pages until the cache is 10% under its size cap
+        """
+
+        listing_dir = os.path.join(self.cache_dir, 'listing')
+        entries = []
+        for name in os.listdir(listing_dir):
+            try:
+                entries.append((os.path.getmtime(os.path.join(listing_dir, name)), name))
+            except OSError:
+                continue
+        entries.sort()
+
+        keep = int(self.listing_max_entries * 0.9)
+        for _, name in entries[:max(len(entries) - keep, 0)]:
+            try:
+                os.remove(os.path.join(listing_dir, name))
+            except OSError:
+                pass
+
+        self.listing_count = min(len(entries), keep)
+
+    def _entry_path(self, url):
+        """
+        Maps a URL to its location in the cache
+
+        :param url: The requested URL
+        :return (str, bool): The path of the cache entry, and whether the document is immutable
+        """
+
+        parsed = urlparse(url)
+
+        if parsed.path.startswith('/Archives/edgar/data/') and not parsed.path.endswith('/') and '..' not in parsed.path and not parsed.query:
+            # /Archives/edgar/data/<cik>/<accession>/<file name>
+            return os.path.join(self.cache_dir, 'immutable', parsed.netloc.replace(':', '_'), *parsed.path[len('/Archives/edgar/data/'):].split('/')) + '.gz', True
+
+        return os.path.join(self.cache_dir, 'listing', sha1(url.encode('utf-8')).hexdigest() + '.gz'), False
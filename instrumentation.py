@@ -0,0 +1,261 @@
+from scrapy import Request
+from contextlib import contextmanager
+from collections import Counter
+from sqlite_store import per_process
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+METRICS_PATH = './13F_Reports/metrics.jsonl'
+PROFILE_DIR = './13F_Reports/profiles'
+PROFILE_MODES = ('cpu', 'memory')
+
+# Seconds spent in each stage (parse, write...) of the document currently being parsed, see end_stage(). A document is parsed start to finish
+# in one thread, so each thread keeps its own counter and documents parsed in parallel threads (PARSER_WORKERS = 0) never mix their timings
+_stages = threading.local()
+
+
+def _stage_seconds():
+    if not hasattr(_stages, 'seconds'):
+        _stages.seconds = Counter()
+    return _stages.seconds
+
+
+def end_stage(stage, start):
+    """
+    Adds the time since start to a parsing stage of the current document
+
+    :param stage: Name of the stage, such as 'parse' or 'write'
+    :param start: time.perf_counter() when the stage started
+    :return (float): The current time.perf_counter(), where the next stage starts
+    """
+
+    now = time.perf_counter()
+    _stage_seconds()[stage] += now - start
+    return now
+
+
+def take_stage_seconds():
+    """
+    :return (dict): Seconds spent in each stage by this thread since its last call, rounded to microseconds
+    """
+
+    stage_seconds = _stage_seconds()
+    stages = {stage: round(seconds, 6) for stage, seconds in stage_seconds.items()}
+    stage_seconds.clear()
+    return stages
+
+
+@contextmanager
+def profiling(mode, name, profile_dir=PROFILE_DIR):
+    """
+    Profiles the with block and dumps a report for it. 'cpu' writes <name>.prof (cProfile stats, readable with pstats or snakeviz) and a
+    <name>.cpu.txt summary of the 30 most expensive functions, 'memory' writes <name>.memory.txt with tracemalloc's peak and top allocation sites.
+    tracemalloc traces the whole process, so memory profiles are only accurate while one document is parsed at a time per process (see
+    ParsingPipeline).
+
+    :param mode: 'cpu', 'memory', or None to not profile
+    :param name: Base name of the report files, such as the accession number of the document
+    :param profile_dir: Directory the reports are written to
+    """
+
+    if mode not in PROFILE_MODES:
+        yield
+        return
+
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, name)
+
+    if mode == 'memory':
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(f'{path}.memory.txt', 'wt') as report:
+                report.write(f'Peak traced memory: {peak / 1024 / 1024:.2f} MB, still allocated: {current / 1024 / 1024:.2f} MB\n\n')
+                for statistic in snapshot.statistics('lineno')[:30]:
+                    report.write(f'{statistic}\n')
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(f'{path}.prof')
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(30)
+        with open(f'{path}.cpu.txt', 'wt') as report:
+            report.write(summary.getvalue())
+
+
+class MetricsLog:
+    """
+    Appends metric records to a JSON-lines file, one JSON object per line. The file is line buffered, so records survive a crash
+    and a metrics file can be followed with tail -f during a crawl.
+    """
+
+    def __init__(self, path=METRICS_PATH):
+        """
+        :param path: Path of the .jsonl file
+        """
+
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'at', buffering=1)
+
+    def write(self, event, **fields):
+        """
+        Appends one record
+
+        :param event: Kind of record: 'download', 'callback' or 'parse'
+        :param fields: The record's values
+        """
+
+        try:
+            self.file.write(json.dumps(dict(event=event, time=round(time.time(), 3), **fields)) + '\n')
+        except (IOError, ValueError) as e:
+            logging.debug(f'Failed to write to {self.path}: {e}')
+
+    def close(self):
+        self.file.close()
+
+
+def get_metrics_log(path=METRICS_PATH):
+    """
+    Returns the MetricsLog for a path, shared by every crawler and pipeline in the process. None disables the metrics file
+
+    :param path: Path of the .jsonl file, or None
+    :return (MetricsLog | None): The log
+    """
+
+    if not path:
+        return None
+    return per_process(('metrics_log', path), lambda: MetricsLog(path))
+
+
+class InstrumentationMiddleware:
+    """
+    Scrapy spider middleware recording how long each response took to download and how long the spider callback that handled it ran
+    (XPath matching and request building), into the crawler's stats under metrics/ and into the METRICS_FILE JSON-lines file.
+
+    It has to be the spider middleware closest to the spider, so the time spent iterating a callback's output is the callback's own.
+
+    Settings:
+        METRICS_FILE: Path of the JSON-lines metrics file, empty to only record stats
+    """
+
+    def __init__(self, stats, metrics_log):
+        """
+        :param stats: The crawler's StatsCollector
+        :param metrics_log: The MetricsLog, or None
+        """
+
+        self.stats = stats
+        self.metrics_log = metrics_log
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats, get_metrics_log(crawler.settings.get('METRICS_FILE', METRICS_PATH)))
+
+    def process_spider_input(self, response, spider):
+        """
+        Records the download latency of the response. Responses served from the HTTP cache were never downloaded and are only counted
+
+        :param response: The downloaded Response
+        :param spider: The Spider it is for
+        """
+
+        latency = response.meta.get('download_latency')
+        if 'cached' in response.flags or latency is None:
+            self.stats.inc_value('metrics/cached_responses')
+            return None
+
+        self.stats.inc_value('metrics/download_seconds', latency)
+        self.stats.max_value('metrics/download_seconds_max', latency)
+        self.stats.inc_value('metrics/download_bytes', len(response.body))
+        if self.metrics_log is not None:
+            self.metrics_log.write('download', cik=getattr(spider, 'fund_cik', None), url=response.url, status=response.status,
+                                   seconds=round(latency, 6), bytes=len(response.body))
+        return None
+
+    def process_spider_output(self, response, result, spider):
+        """
+        :param response: The Response the callback handled
+        :param result: The callback's output
+        :param spider: The Spider
+        :return (generator): The same output, timed as it is consumed
+        """
+
+        return self._timed_output(response, result, spider)
+
+    async def process_spider_output_async(self, response, result, spider):
+        """
+        Same as process_spider_output, for Scrapy versions that pass callback output along as an async iterable
+
+        :param response: The Response the callback handled
+        :param result: The callback's output
+        :param spider: The Spider
+        :return (async generator): The same output, timed as it is consumed
+        """
+
+        seconds = 0.0
+        counts = {'requests': 0, 'items': 0}
+
+        output = result.__aiter__()
+        while True:
+            start = time.perf_counter()
+            try:
+                value = await output.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - start
+
+            counts['requests' if isinstance(value, Request) else 'items'] += 1
+            yield value
+
+        self._record_callback(response, spider, seconds, counts)
+
+    def _timed_output(self, response, result, spider):
+        seconds = 0.0
+        counts = {'requests': 0, 'items': 0}
+
+        # Only time spent inside the callback counts, not the time the engine spends between pulling outputs
+        output = iter(result)
+        while True:
+            start = time.perf_counter()
+            try:
+                value = next(output)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - start
+
+            counts['requests' if isinstance(value, Request) else 'items'] += 1
+            yield value
+
+        self._record_callback(response, spider, seconds, counts)
+
+    def _record_callback(self, response, spider, seconds, counts):
+        request_callback = getattr(response.request, 'callback', None) if response.request is not None else None
+        callback = getattr(request_callback, '__name__', 'parse')
+
+        self.stats.inc_value(f'metrics/callback_seconds/{callback}', seconds)
+        self.stats.max_value(f'metrics/callback_seconds_max/{callback}', seconds)
+        if self.metrics_log is not None:
+            self.metrics_log.write('callback', cik=getattr(spider, 'fund_cik', None), url=response.url, callback=callback, seconds=round(seconds, 6),
+                                   **counts)
@@ -1,6 +1,13 @@
 from utilities import *
 from scrapy.crawler import CrawlerProcess
 from mutual_fund_spider import MutualFundsSpider
+from form_index import FormIndexSpider
+from summary_store import get_summary_store
+from holdings_index import build_index
+from position_diff import diff_filer
+from raw_archive import reparse
+from datetime import datetime
+from urllib.parse import urlparse
 import sys
 import logging
 
@@ -8,52 +15,174 @@ import logging
 # Change the logging format to this custom one
 logging.basicConfig(format='(%(asctime)s) %(levelname)s: %(message)s', level=logging.INFO)
 
-# Declare variables
-depth = 1
-cik = None
-test_mode = False
-
-make_13f_dir()
-
-# Check for command-line arguments
-if sys.getsizeof(sys.argv) > 1:
-    for arg in sys.argv:
-        if arg.startswith('-'):
-            if '=' in arg:
-                arg = arg[1::].split('=')
-                arg_name = arg[0].lower()
-                arg_value = arg[1]
-            else:
-                arg = arg[1::]
-                arg_name = arg.lower()
-                arg_value = None
-
-            if arg_name == 'ticker':
-                try:
-                    cik = arg_value.split('|')[1].strip()
-                except IndexError:
-                    cik = None
-                    logging.warn(f'The ticker you entered ({arg_value}) is not properly formatted: \"Name | CIK\"')
-                    sys.exit()
-            elif arg_name == 'cik' and arg_value is not None:
-                cik = arg_value
-            elif arg_name == 'depth' and arg_value is not None:
-                try:
-                    depth = int(arg_value)
-                except ValueError:
-                    logging.warn("Argument \'depth\' must be an integer")
-                    sys.exit()
-            elif arg_name == 'test':
-                logging.info("-depth cannot be set in test mode")
-                test_mode = True
-            else:
-                logging.warn(f'{arg} is not a valid argument')
-
-if test_mode:
-    # Run parallel processes
-    run_test()
-else:
-    # Run a single process
-    process = CrawlerProcess()
-    process.crawl(MutualFundsSpider, depth=depth, cik=cik)
-    process.start()
+
+def main():
+    """
+    Parses the command-line arguments and runs the requested crawl
+    """
+
+    # Declare variables
+    depth = 1
+    cik = None
+    parser = 'lxml'
+    since = None
+    test_mode = False
+    export_only = False
+    force = False
+    columnar = False
+    build_cusip_index = False
+    diff_only = False
+    reparse_only = False
+    batch_source = None
+    form_index = None
+    max_spiders = 8
+    max_requests = 16
+    job = None
+    retries = 1
+    base_url = None
+    rate_limit = None
+    profile = None
+
+    make_13f_dir()
+
+    # Check for command-line arguments
+    if sys.getsizeof(sys.argv) > 1:
+        for arg in sys.argv:
+            if arg.startswith('-'):
+                if '=' in arg:
+                    arg = arg[1::].split('=')
+                    arg_name = arg[0].lower()
+                    arg_value = arg[1]
+                else:
+                    arg = arg[1::]
+                    arg_name = arg.lower()
+                    arg_value = None
+
+                if arg_name == 'ticker':
+                    try:
+                        cik = arg_value.split('|')[1].strip()
+                    except IndexError:
+                        cik = None
+                        logging.warn(f'The ticker you entered ({arg_value}) is not properly formatted: \"Name | CIK\"')
+                        sys.exit()
+                elif arg_name == 'cik' and arg_value is not None:
+                    cik = arg_value
+                elif arg_name == 'depth' and arg_value is not None:
+                    try:
+                        depth = int(arg_value)
+                    except ValueError:
+                        logging.warn("Argument \'depth\' must be an integer")
+                        sys.exit()
+                elif arg_name == 'since' and arg_value is not None:
+                    try:
+                        since = datetime.strptime(arg_value, '%Y-%m-%d').strftime('%Y-%m-%d')
+                    except ValueError:
+                        logging.warn("Argument \'since\' must be a date formatted YYYY-MM-DD")
+                        sys.exit()
+                elif arg_name == 'parser' and arg_value is not None:
+                    parser = arg_value.lower()
+                elif arg_name == 'batch' and arg_value is not None:
+                    batch_source = arg_value
+                elif arg_name == 'job' and arg_value is not None:
+                    job = arg_value
+                elif arg_name == 'form_index' and arg_value is not None:
+                    form_index = arg_value
+                elif arg_name in ('max_spiders', 'max_requests', 'retries') and arg_value is not None:
+                    try:
+                        if arg_name == 'max_spiders':
+                            max_spiders = int(arg_value)
+                        elif arg_name == 'retries':
+                            retries = int(arg_value)
+                        else:
+                            max_requests = int(arg_value)
+                    except ValueError:
+                        logging.warn(f"Argument \'{arg_name}\' must be an integer")
+                        sys.exit()
+                    if arg_name != 'retries' and int(arg_value) < 1:
+                        logging.warn(f"Argument \'{arg_name}\' must be at least 1")
+                        sys.exit(1)
+                elif arg_name == 'base_url' and arg_value is not None:
+                    base_url = arg_value
+                elif arg_name == 'rate_limit' and arg_value is not None:
+                    try:
+                        rate_limit = float(arg_value)
+                    except ValueError:
+                        logging.warn("Argument \'rate_limit\' must be a number")
+                        sys.exit()
+                elif arg_name == 'profile':
+                    profile = (arg_value or 'cpu').lower()
+                    if profile not in ('cpu', 'memory'):
+                        logging.warn("Argument \'profile\' must be cpu or memory")
+                        sys.exit()
+                elif arg_name == 'diff':
+                    diff_only = True
+                elif arg_name == 'reparse':
+                    reparse_only = True
+                elif arg_name == 'index':
+                    build_cusip_index = True
+                elif arg_name == 'columnar':
+                    columnar = True
+                elif arg_name == 'force':
+                    force = True
+                elif arg_name == 'export':
+                    export_only = True
+                elif arg_name == 'test':
+                    logging.info("-depth cannot be set in test mode")
+                    test_mode = True
+                else:
+                    logging.warn(f'{arg} is not a valid argument')
+
+    if diff_only and cik is None:
+        logging.warn('-diff needs the filer whose reports to diff, pass -cik or -ticker')
+        sys.exit(1)
+
+    spider_kwargs = {'depth': depth, 'parser': parser, 'since': since, 'force': force, 'columnar': columnar}
+    settings = { }
+    if profile is not None:
+        settings['PARSER_PROFILE'] = profile
+    if base_url is not None:
+        spider_kwargs['base_url'] = base_url
+        # Throttling by a stand-in server is retried the same way as SEC's, and its pages must never end up in the EDGAR response cache
+        settings.update({'HTTPCACHE_ENABLED': False, 'SEC_RATE_LIMIT_HOSTS': [urlparse(base_url).hostname]})
+        if rate_limit is not None:
+            settings['SEC_RATE_LIMIT'] = rate_limit
+    elif rate_limit is not None:
+        logging.warn('-rate_limit only applies with -base_url, SEC allows no more than 10 requests/second')
+
+    if export_only:
+        # Skip crawling, search_summary.tsv is regenerated from the summary store below
+        logging.info('Exporting search_summary.tsv...')
+    elif reparse_only:
+        # Skip crawling and rebuild every report and summary from the raw document archive
+        reparse(parser=parser, columnar=columnar)
+    elif diff_only:
+        # Skip crawling and diff every pair of reports of this CIK already on disk, including the pairs whose diff is up to date
+        diff_filer(cik, force=True)
+    elif build_cusip_index:
+        # Skip crawling and rebuild the CUSIP index from the reports already on disk
+        build_index()
+    elif test_mode:
+        # Run parallel processes
+        run_test()
+    elif form_index is not None:
+        # Ingest every filer's 13F-HR of a quarter straight from EDGAR's form index
+        process = CrawlerProcess(crawler_settings(settings))
+        process.crawl(FormIndexSpider, index=form_index, **{key: spider_kwargs[key] for key in ('parser', 'force', 'columnar', 'base_url') if key in spider_kwargs})
+        process.start()
+    elif batch_source is not None or job is not None:
+        # Run a spider for every CIK in the batch file, a bounded number at a time. A job without a batch file resumes the CIKs in its ledger
+        run_batch(read_ciks(batch_source) if batch_source is not None else (), max_spiders=max_spiders, max_requests=max_requests, settings=settings,
+                  job=job, retries=retries, **spider_kwargs)
+    else:
+        # Run a single process
+        process = CrawlerProcess(crawler_settings(settings))
+        process.crawl(MutualFundsSpider, cik=cik, **spider_kwargs)
+        process.start()
+
+    # Export the summaries collected so far to search_summary.tsv
+    get_summary_store().export_tsv()
+
+
+# Guarded so that worker processes (see pipelines.py) can import this module without starting a crawl
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+from sqlite_store import SqliteStore, per_process
+import json
+import re
+import time
+
+
+MANIFEST_DB_PATH = './13F_Reports/manifest.db'
+
+# Documents of a filing that must be parsed and on disk before the filing counts as ingested
+FILING_DOCUMENTS = ('primary_doc', 'info_table')
+# Columns of an ingested filing, period and amendment_type come from primary_doc.xml, the rest from the information table
+ENTRY_COLUMNS = ('accession', 'cik', 'date', 'sha1', 'rows', 'period', 'amendment_type', 'ingested_at')
+
+# Accession numbers appear as 0001104659-19-045326 in file names, and without dashes as the filing's directory
+ACCESSION_PATTERN = re.compile(r'(\d{10}-\d{2}-\d{6})|/(\d{18})(?:/|$)')
+
+
+def accession_from_url(url):
+    """
+    Extracts the accession number from the URL of a filing document or Filing Detail page
+
+    :param url: URL under /Archives/edgar/data/
+    :return (str | None): The accession number formatted 0001104659-19-045326, or None if the URL has none
+    """
+
+    match = ACCESSION_PATTERN.search(url)
+    if match is None:
+        return None
+    if match.group(1):
+        return match.group(1)
+
+    digits = match.group(2)
+    return f'{digits[:10]}-{digits[10:12]}-{digits[12:]}'
+
+
+class Manifest(SqliteStore):
+    """
+    Persistent record of every filing that has been ingested, keyed by accession number and backed by SQLite.
+
+    Each document of a filing is recorded once it has been parsed and written to disk, and the filing only counts as ingested once every
+    document in FILING_DOCUMENTS has been, so a filing whose primary_doc.xml or information table failed is fetched again by the next sweep.
+    MutualFundsSpider checks it on the Filing Detail page and skips filings that are already on disk, so repeated sweeps only pay for the
+    listing request of each filer.
+
+    :var path (str): Location of the SQLite database file
+    """
+
+    def __init__(self, path=MANIFEST_DB_PATH, read_only=False):
+        """
+        Opens (and creates if needed) the manifest database
+
+        :param path: Location of the SQLite database file
+        :param read_only: Open an existing manifest without creating or upgrading it, see SqliteStore
+        """
+
+        super().__init__(path, ["""
+            CREATE TABLE IF NOT EXISTS ingested (
+                accession TEXT PRIMARY KEY,
+                cik TEXT NOT NULL,
+                date TEXT NOT NULL,
+                sha1 TEXT NOT NULL,
+                rows INTEGER NOT NULL,
+                ingested_at REAL NOT NULL,
+                period TEXT,
+                amendment_type TEXT
+            )
+        """, """
+            CREATE TABLE IF NOT EXISTS pending (
+                accession TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            )
+        """], read_only)
+        if read_only:
+            return
+
+        # Manifests written before the cover page was recorded lack its columns
+        columns = {row[1] for row in self._connection.execute('PRAGMA table_info(ingested)')}
+        for column in ('period', 'amendment_type'):
+            if column not in columns:
+                self._connection.execute(f'ALTER TABLE ingested ADD COLUMN {column} TEXT')
+
+    def __contains__(self, accession):
+        """
+        :param accession: The filing's accession number
+        :return (bool): Whether the filing has already been ingested
+        """
+
+        return self._connection.execute('SELECT 1 FROM ingested WHERE accession = ?', (accession,)).fetchone() is not None
+
+    def get(self, accession):
+        """
+        Looks up the manifest entry of a filing
+
+        :param accession: The filing's accession number
+        :return (dict | None): The entry, or None if the filing hasn't been ingested
+        """
+
+        row = self._connection.execute(f'SELECT {", ".join(ENTRY_COLUMNS)} FROM ingested WHERE accession = ?', (accession,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(ENTRY_COLUMNS, row))
+
+    def __iter__(self):
+        """
+        Iterates over every ingested filing, ordered by filer and filing date
+
+        :return (generator): One entry dict per filing, see get. Manifests opened read-only before they were upgraded have no period or amendment_type
+        """
+
+        cursor = self._connection.execute('SELECT * FROM ingested ORDER BY cik, date')
+        columns = [column[0] for column in cursor.description]
+        for row in cursor:
+            yield dict(zip(columns, row))
+
+    def record(self, accession, document, **fields):
+        """
+        Records that one document of a filing has been parsed and written to disk. Once every document in FILING_DOCUMENTS is recorded, the
+        filing is marked as ingested, replacing any previous entry for it
+
+        :param accession: The filing's accession number
+        :param document: 'primary_doc' or 'info_table'
+        :param fields: Columns of the entry known from this document. The information table gives cik, date (the filing date used in the .tsv
+            file name), sha1 (of the raw XML) and rows (the number of holdings written); primary_doc.xml gives period (reportCalendarOrQuarter)
+            and amendment_type (RESTATEMENT or NEW HOLDINGS, None for an original report)
+        :return (bool): True if the filing is now ingested
+        """
+
+        with self.transaction() as connection:
+            row = connection.execute('SELECT data FROM pending WHERE accession = ?', (accession,)).fetchone()
+            entry = json.loads(row[0]) if row else {'documents': []}
+            entry.update(fields)
+            entry['documents'] = sorted(set(entry['documents']) | {document})
+
+            if not set(FILING_DOCUMENTS) <= set(entry['documents']):
+                connection.execute('INSERT OR REPLACE INTO pending (accession, data) VALUES (?, ?)', (accession, json.dumps(entry)))
+                return False
+
+            entry.update(accession=accession, ingested_at=time.time())
+            connection.execute(f'INSERT OR REPLACE INTO ingested ({", ".join(ENTRY_COLUMNS)}) VALUES ({", ".join("?" * len(ENTRY_COLUMNS))})',
+                               [entry.get(column) for column in ENTRY_COLUMNS])
+            connection.execute('DELETE FROM pending WHERE accession = ?', (accession,))
+            return True
+
+
+def get_manifest():
+    """
+    Returns this process' shared Manifest, opening it on first use
+
+    :return (Manifest): The shared manifest
+    """
+
+    return per_process(('manifest', MANIFEST_DB_PATH), Manifest)
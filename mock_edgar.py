@@ -0,0 +1,246 @@
+from edgar_fixtures import accession_number, accession_sequence, filing_date, filing_detail_page, fixture_cik, full_submission, info_table, listing_page, \
+    master_index, primary_doc
+from twisted.internet import reactor
+from twisted.web import resource, server
+from functools import lru_cache
+from collections import Counter
+import json
+import logging
+import random
+import re
+import sys
+
+
+DOCUMENT_PATTERN = re.compile(r'^/Archives/edgar/data/(?P<cik>\d+)/(?P<accession>\d{18})/(?P<document>[^/]+)$')
+SUBMISSION_PATTERN = re.compile(r'^/Archives/edgar/data/(?P<cik>\d+)/(?P<accession>\d{10}-\d{2}-\d{6})\.txt$')
+FORM_INDEX_PATTERN = re.compile(r'^/Archives/edgar/full-index/(?P<year>\d{4})/QTR(?P<quarter>[1-4])/master\.idx$')
+# Distinct information tables generated per size, filers share them round robin so the server doesn't regenerate a table per request
+TABLE_VARIANTS = 8
+
+
+@lru_cache(maxsize=2 * TABLE_VARIANTS)
+def _cached_info_table(rows, ns1, seed):
+    return info_table(rows, ns1, seed)
+
+
+class MockEdgarResource(resource.Resource):
+    """
+    twisted.web resource standing in for the parts of EDGAR MutualFundsSpider crawls: browse-edgar company listings, Filing Detail pages,
+    primary_doc.xml and information tables. Every CIK exists and has the same number of synthetic 13F-HR filings, generated by edgar_fixtures.
+
+    :var stats (Counter): Requests served, by kind, and the number of injected errors
+    """
+
+    isLeaf = True
+
+    def __init__(self, filings=4, rows=1000, page_size=None, other_forms=0, latency=0.0, jitter=0.0, error_rate=0.0, error_codes=(429, 503),
+                 seed=None, index_filers=100):
+        """
+        :param filings: Number of 13F-HR filings of every filer
+        :param rows: Number of holdings in every information table
+        :param page_size: Maximum rows per listing page, or None to honour the count parameter of each request like EDGAR does
+        :param other_forms: Number of non 13F filings on every listing page, to force more pagination
+        :param latency: Seconds every response is delayed by
+        :param jitter: Up to this many seconds are added to latency at random
+        :param error_rate: Fraction of requests answered with one of error_codes instead
+        :param error_codes: HTTP status codes used for injected errors
+        :param seed: Seed of the error and jitter randomness
+        :param index_filers: Number of synthetic filers listed in each quarterly master.idx
+        """
+
+        super().__init__()
+        self.filings = filings
+        self.rows = rows
+        self.page_size = page_size
+        self.other_forms = other_forms
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.random = random.Random(seed)
+        self.index_filers = index_filers
+        self.stats = Counter()
+
+    def render_GET(self, request):
+        """
+        Answers the request after the configured latency
+
+        :param request: The twisted.web Request
+        :return: server.NOT_DONE_YET, the response is written later
+        """
+
+        delay = self.latency + self.random.uniform(0, self.jitter) if self.jitter else self.latency
+        call = reactor.callLater(delay, self._respond, request)
+        request.notifyFinish().addErrback(lambda _: call.cancel() if call.active() else None)
+        return server.NOT_DONE_YET
+
+    def _respond(self, request):
+        if self.error_rate and self.random.random() < self.error_rate:
+            status = self.random.choice(self.error_codes)
+            self.stats['errors'] += 1
+            self.stats[f'errors/{status}'] += 1
+            request.setResponseCode(status)
+            if status == 429:
+                request.setHeader('Retry-After', '1')
+            body, content_type = b'', 'text/html'
+        else:
+            status, body, content_type = self.route(request.path.decode('utf-8', 'replace'),
+                                                    {key.decode(): values[0].decode() for key, values in request.args.items()})
+            request.setResponseCode(status)
+
+        request.setHeader('Content-Type', content_type)
+        request.setHeader('Content-Length', str(len(body)))
+        request.write(body)
+        request.finish()
+
+    def route(self, path, query):
+        """
+        Generates the page a path refers to
+
+        :param path: The URL path
+        :param query: The query parameters
+        :return (tuple): HTTP status, body and content type
+        """
+
+        if path == '/_stats':
+            return 200, json.dumps(self.stats).encode(), 'application/json'
+
+        if path == '/cgi-bin/browse-edgar':
+            cik = query.get('CIK', '')
+            if not cik.isdigit():
+                self.stats['not_found'] += 1
+                return 200, b'<html><body><h1>No matching Ticker Symbol.</h1></body></html>', 'text/html'
+            count = int(query.get('count', 40) or 40)
+            # Like a server capping the page size, the Next button of a shorter page links to the right offset
+            if self.page_size:
+                count = min(count, self.page_size)
+            self.stats['listings'] += 1
+            return 200, listing_page(cik, self._name(cik), self.filings, int(query.get('start', 0) or 0), count, self.other_forms).encode(), 'text/html'
+
+        match = FORM_INDEX_PATTERN.match(path)
+        if match is not None:
+            self.stats['form_indexes'] += 1
+            return 200, self._master_index(int(match.group('year')), int(match.group('quarter'))).encode('latin-1'), 'text/plain'
+
+        match = SUBMISSION_PATTERN.match(path)
+        if match is not None and accession_sequence(match.group('accession')) < self.filings:
+            cik, sequence = match.group('cik'), accession_sequence(match.group('accession'))
+            self.stats['submissions'] += 1
+            return 200, full_submission(cik, self._name(cik), match.group('accession'), filing_date(sequence), self.rows, int(cik) % 2 == 1,
+                                        (int(cik) + sequence) % TABLE_VARIANTS), 'text/plain'
+
+        match = DOCUMENT_PATTERN.match(path)
+        if match is None or accession_sequence(match.group('accession')) >= self.filings:
+            self.stats['not_found'] += 1
+            return 404, b'', 'text/html'
+
+        cik, document = match.group('cik'), match.group('document')
+        sequence = accession_sequence(match.group('accession'))
+        accession = f'{match.group("accession")[:10]}-{match.group("accession")[10:12]}-{match.group("accession")[12:]}'
+        date = filing_date(sequence)
+
+        if document == f'{accession}-index.htm':
+            self.stats['filing_details'] += 1
+            return 200, filing_detail_page(cik, accession, date).encode(), 'text/html'
+        if document == 'primary_doc.xml':
+            self.stats['primary_docs'] += 1
+            return 200, primary_doc(cik, self._name(cik), date, entries=self.rows).encode(), 'text/xml'
+        if document == 'form13fInfoTable.xml':
+            self.stats['info_tables'] += 1
+            # Alternate the ns1: and plain variants between filers
+            return 200, _cached_info_table(self.rows, int(cik) % 2 == 1, (int(cik) + sequence) % TABLE_VARIANTS), 'text/xml'
+
+        self.stats['not_found'] += 1
+        return 404, b'', 'text/html'
+
+    def _master_index(self, year, quarter):
+        entries = []
+        for index in range(self.index_filers):
+            cik = fixture_cik(index)
+            for sequence in range(self.filings):
+                date = filing_date(sequence)
+                if int(date[:4]) == year and (int(date[5:7]) - 1) // 3 + 1 == quarter:
+                    entries.append((cik, self._name(cik), '13F-HR', date, accession_number(cik, sequence)))
+                    # Other forms filed the same day, which the index has to be filtered for
+                    entries.append((cik, self._name(cik), '13F-HR/A' if index % 3 == 0 else 'SC 13G', date, accession_number(cik, sequence + 500000)))
+        return master_index(entries, year, quarter)
+
+    @staticmethod
+    def _name(cik):
+        return f'MOCK FILER {int(cik)} LLC'
+
+
+def write_ciks(path, count):
+    """
+    Writes a -batch file of synthetic CIKs for load tests against the mock server
+
+    :param path: Path of the file
+    :param count: Number of CIKs
+    """
+
+    with open(path, 'wt') as cik_file:
+        for index in range(count):
+            cik_file.write(f'{fixture_cik(index)}\n')
+
+
+def main():
+    """
+    Serves the mock EDGAR until interrupted. Crawl it with: python3 main.py -base_url=http://127.0.0.1:8000 -batch=ciks.txt -force
+
+    Flags:
+        -port=N, -host=ADDRESS: Where to listen (default 127.0.0.1:8000)
+        -filings=N: 13F-HR filings per filer (default 4)
+        -rows=N: Holdings per information table (default 1000)
+        -page_size=N: Maximum rows per listing page, capping the count parameter of requests
+        -other_forms=N: Non 13F filings on every listing page
+        -latency=SECONDS, -jitter=SECONDS: Delay of every response
+        -error_rate=FRACTION: Fraction of requests answered with -error_codes (default 429,503)
+        -write_ciks=PATH, -filers=N: Write a -batch file of N synthetic CIKs and exit
+        -index_filers=N: Filers listed in every quarterly master.idx (default 100)
+    """
+
+    logging.basicConfig(format='(%(asctime)s) %(levelname)s: %(message)s', level=logging.INFO)
+
+    options = {}
+    host, port = '127.0.0.1', 8000
+    ciks_path, filers = None, 1000
+
+    for arg in sys.argv[1:]:
+        if not arg.startswith('-'):
+            continue
+        arg_name, _, arg_value = arg[1:].partition('=')
+        try:
+            if arg_name == 'host':
+                host = arg_value
+            elif arg_name == 'port':
+                port = int(arg_value)
+            elif arg_name in ('filings', 'rows', 'page_size', 'other_forms', 'index_filers'):
+                options[arg_name] = int(arg_value)
+            elif arg_name in ('latency', 'jitter', 'error_rate'):
+                options[arg_name] = float(arg_value)
+            elif arg_name == 'error_codes':
+                options['error_codes'] = [int(code) for code in arg_value.split(',')]
+            elif arg_name == 'write_ciks':
+                ciks_path = arg_value
+            elif arg_name == 'filers':
+                filers = int(arg_value)
+            else:
+                logging.warning(f'{arg} is not a valid argument')
+        except ValueError:
+            logging.warning(f'Argument \'{arg_name}\' must be a number')
+            sys.exit()
+
+    if ciks_path is not None:
+        write_ciks(ciks_path, filers)
+        logging.info(f'Wrote {filers} CIKs to {ciks_path}')
+        return
+
+    site = server.Site(MockEdgarResource(**options))
+    site.displayTracebacks = False
+    reactor.listenTCP(port, site, interface=host)
+    logging.info(f'Mock EDGAR listening on http://{host}:{port} ({options or "defaults"}), request counts at /_stats')
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
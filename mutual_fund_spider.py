@@ -1,7 +1,13 @@
 import scrapy
 import logging
+import os
+import sys
+from urllib.parse import urlparse
+from w3lib.url import add_or_replace_parameter, url_query_parameter
 from utilities import *
 from xml_parser import *
+from edgar_pages import COMPANY_MATCHES, FILING_DETAIL, INFO_TABLE, LISTING, NO_MATCH, PRIMARY_DOC, read_page
+from manifest import accession_from_url, get_manifest
 
 
 class MutualFundsSpider(scrapy.Spider):
@@ -13,22 +19,59 @@ class MutualFundsSpider(scrapy.Spider):
     :var allowed_domains ([str]): Scrapy will only crawl URLs within these domains
     :var fund_cik (str | None): Mutual Fund Central Index Key collected from the user
     :var fund_name (str | None): Mutual Fund Name collected from the user
-
-    :returns (str): Either the raw XML from the target document, or an error message
+    :var custom_settings (dict): Scrapy settings applied to every instance of this Spider
+    :var parser (str): Key into INFO_TABLE_PARSERS selecting the engine used for 13F Holdings Reports
+    :var columnar (bool): Also write each 13F Holdings Report as typed NumPy columns next to its .tsv file
+    :var force (bool): Re-download filings even if the manifest says they have already been ingested
+    :var since (str | None): Filing date cutoff (YYYY-MM-DD). In depth mode, listing pages are followed until depth reports or this date is reached
+    :var base_url (str): Scheme and host of EDGAR. Point it at a stand-in like mock_edgar.py to crawl without going near SEC
+
+    :returns (dict): Items holding the raw XML of the target documents, parsed by pipelines.ParsingPipeline
     """
 
     # Declare class fields
     name = "MutualFundsSpider"
     start_urls = []
     allowed_domains = ["www.sec.gov"]
+    custom_settings = {
+        # SEC's fair-access policy requires a declared User-Agent with a contact address, set SEC_USER_AGENT to your own
+        'USER_AGENT': os.environ.get('SEC_USER_AGENT', 'Mutual-Fund-Web-Scraper admin@example.com'),
+        # Keep every spider in the process under SEC's 10 requests/second, see rate_limiter.py
+        'DOWNLOADER_MIDDLEWARES': {'rate_limiter.EdgarRateLimitMiddleware': 950},
+        'SEC_RATE_LIMIT': 10,
+        'SEC_THROTTLE_HTTP_CODES': [403, 429, 500, 502, 503, 504],
+        'SEC_MAX_RETRIES': 5,
+        'SEC_RETRY_BACKOFF': 2.0,
+        # Throttling responses are retried by EdgarRateLimitMiddleware instead
+        'RETRY_HTTP_CODES': [408, 522, 524],
+        # Serve repeated runs and -depth backfills from disk, see http_cache.py
+        'HTTPCACHE_ENABLED': True,
+        'HTTPCACHE_DIR': '.edgar_cache',
+        'HTTPCACHE_STORAGE': 'http_cache.EdgarCacheStorage',
+        'HTTPCACHE_POLICY': 'scrapy.extensions.httpcache.DummyPolicy',
+        'HTTPCACHE_IGNORE_HTTP_CODES': [403, 404, 429, 500, 502, 503, 504],
+        'HTTPCACHE_LISTING_TTL': 3600,
+        'HTTPCACHE_LISTING_MAX_ENTRIES': 1000,
+        # Parse documents in worker processes, see pipelines.py
+        'ITEM_PIPELINES': {'pipelines.ParsingPipeline': 300},
+        'PARSER_WORKERS': os.cpu_count() or 1,
+        'PARSER_MAX_IN_FLIGHT': 2 * (os.cpu_count() or 1),
+        'PARSER_PROFILE': None,
+        # Keep every raw document, so reports can be rebuilt with main.py -reparse, see raw_archive.py
+        'RAW_ARCHIVE_DIR': './13F_Reports/raw_archive',
+        # Download, callback and parse timings, see instrumentation.py
+        'SPIDER_MIDDLEWARES': {'instrumentation.InstrumentationMiddleware': 950},
+        'METRICS_FILE': './13F_Reports/metrics.jsonl',
+    }
     fund_cik = None
     fund_name = None
     date_filed = None
     depth = 1
-    filing_dates = []
-    filed_reports = []
-    primary_doc_parsed = False
-    last_date = []
+    parser = 'lxml'
+    since = None
+    force = False
+    columnar = False
+    base_url = 'https://www.sec.gov'
 
     # Define constructor
     def __init__(self, **kwargs):
@@ -42,12 +85,26 @@ class MutualFundsSpider(scrapy.Spider):
         super().__init__(**kwargs)
 
         user_input = None
+        # Crawl state lives on the instance so parallel spiders in run_test never share it
+        self.reports_requested = 0
+        self.listing_exhausted = False
 
         if len(kwargs) > 0:
             if 'depth' in kwargs and kwargs['depth'] is not None and kwargs['depth'] > 1:
                 self.depth = kwargs['depth']
             if 'cik' in kwargs and kwargs['cik'] is not None:
                 user_input = kwargs['cik']
+            if 'since' in kwargs and kwargs['since'] is not None:
+                self.since = kwargs['since']
+                # Without an explicit depth, crawl every report filed since the cutoff date
+                if self.depth == 1:
+                    self.depth = sys.maxsize
+            if 'parser' in kwargs and kwargs['parser'] is not None:
+                if kwargs['parser'] in INFO_TABLE_PARSERS:
+                    self.parser = kwargs['parser']
+                else:
+                    logging.warning(f'Unknown parser \'{kwargs["parser"]}\', falling back to \'{self.parser}\'')
+                    self.parser = MutualFundsSpider.parser
 
         if user_input is None:
             print('Enter the CIK, Mutual Fund Name, or both in the format \"Name | CIK\": \n')
@@ -71,11 +128,15 @@ class MutualFundsSpider(scrapy.Spider):
                 self.fund_name = user_input
                 self.fund_cik = None
 
+        # Only crawl the host EDGAR is served from
+        self.base_url = self.base_url.rstrip('/')
+        self.allowed_domains = [urlparse(self.base_url).hostname]
+
         if self.fund_cik is not None:
-            url = f'https://www.sec.gov/cgi-bin/browse-edgar?action=getcompany&CIK={self.fund_cik}&type=&dateb=&owner=exclude&count=100'
+            url = f'{self.base_url}/cgi-bin/browse-edgar?action=getcompany&CIK={self.fund_cik}&type=&dateb=&owner=exclude&count=100'
             self.start_urls = [url]
         elif self.fund_name is not None:
-            url = f'https://www.sec.gov/cgi-bin/browse-edgar?company={self.fund_name}&owner=exclude&action=getcompany'
+            url = f'{self.base_url}/cgi-bin/browse-edgar?company={self.fund_name}&owner=exclude&action=getcompany'
             self.start_urls = [url]
         else:
             logging.warning('Invalid Company Name or CIK number, please check your input and try again...')
@@ -90,139 +151,172 @@ class MutualFundsSpider(scrapy.Spider):
 
         # Yield a new Scrapy Request for each start_url
         for url in self.start_urls:
-            yield scrapy.Request(url=url, callback=self.parse)
+            yield scrapy.Request(url=url, callback=self.parse, errback=self.request_failed)
 
 
-    def parse_depth(self, response):
+    def info_table_item(self, response, date):
         """
-        Used for parsing a series of holding reports when the depth command-line parameter is passed
+        Builds the item ParsingPipeline turns into a 13F holdings .tsv file
 
-        :param response: The Scrapy Response object
+        :param response: The Response holding the raw XML of the 13F Holdings Report
+        :param date: The filing date used in the .tsv file name
+        :return (dict): The item
         """
 
-        logging.info(f'Crawling URL in --depth mode: {response.url}')
+        return {'document': 'info_table', 'raw_xml': response.body, 'accession': accession_from_url(response.url), 'fund_cik': self.fund_cik, 'date': date, 'parser': self.parser,
+                'columnar': self.columnar}
 
-        # Determine the current page
-        # Reached the Filing Details Page in -depth mode
-        if response.xpath('//div[@id="headerBottom"]/div[@id="PageTitle" and contains(text(), "Filing Detail")]') and "index.htm" in response.url:
-            logging.info('Reached the Filing Detail Page in -depth mode')
 
-            # Query the URLs of the target documents
-            primary_doc_url = response.urljoin(response.xpath('//div[@id="contentDiv"]//table[@class="tableFile"]//tr [td[3] [a [text()="primary_doc.xml"]]] /td[3]/a/@href').get())
-            holdings_report_url = response.urljoin(
-                response.xpath('//div[@id="contentDiv"]//table[@class="tableFile"]//tr [td[3] [a [contains(text(), ".xml")]] and td[4] [contains(text(), "INFORMATION TABLE") or contains(text(), "information table")]] /td[3]/a/@href').get())
-
-            # Generate a request for the primary_doc.xml and 13fInfoTable.xml URLs
-            for i in range(2):
-                # Check if the primary_doc has already been parsed to avoid overwriting unnecessarily
-                if i == 0:
-                    yield scrapy.Request(primary_doc_url, callback=self.parse)
-                elif i == 1:
-                    self.last_date.append(
-                        response.xpath('//div[@id="contentDiv"]//div[@class="formContent"]//div[@class="formGrouping"]//div [@class="infoHead" and contains(text(), "Filing Date")]/following-sibling::div/text()').get().replace('-', '_').strip())
-                    yield scrapy.Request(holdings_report_url, callback=self.parse_depth)
+    def already_ingested(self, url):
+        """
+        Checks the manifest for the filing a Filing Detail URL belongs to, unless the force argument was passed
 
-        # Reached the 13F Holdings Report XML document
-        elif ".xml" in response.url:
-            logging.info('Reached the target 13F Holdings Report in -depth mode')
+        :param url: URL of the Filing Detail page (or any document of the filing)
+        :return (bool): True if the filing has already been ingested and should be skipped
+        """
 
-            # Append this report to filed_reports list
-            self.filed_reports.append(response.body)
+        accession = accession_from_url(url)
+        if self.force or accession is None or accession not in get_manifest():
+            return False
 
-            # If this report is the last one needed, loop through filed_reports and parse them
-            if len(self.filed_reports) is self.depth:
-                try:
-                    for n, report in enumerate(self.filed_reports):
-                        parse_info_table(report, self.fund_cik, self.last_date[n])
-                except IndexError:
-                    logging.error("Index is out of range. filed_reports and last_date should be the exact same length.")
+        logging.info(f'Skipping filing {accession}, it has already been ingested')
+        self.crawler.stats.inc_value('manifest/skipped')
+        return True
 
 
     def parse(self, response):
         """
-        Parses the current page. Determines what page in the chain the Spider is currently crawling, and responds the next page in the chain, an error message, or the target document XML
+        Parses the current page. Determines what page in the chain the Spider is currently crawling (see edgar_pages.read_page), and responds the next page in the chain, an error message, or the target document XML
 
         :param response: The Scrapy Response object
         :return:
         """
 
         logging.info(f'Crawling URL: {response.url}')
+        page = read_page(response, self.fund_name, self.fund_cik)
 
         # The entered CIK or Name was invalid, print an error message
-        if response.xpath('//div[@id="contentDiv"]/div[contains(text(), "No matching")]') or response.xpath('//h1[contains(text(), "No matching")]'):
+        if page['type'] == NO_MATCH:
             logging.error('Invalid Company Name or CIK number, please check your input and try again...')
 
-        # Reached the filings page, find the most recent 13F entry and follow to filing details
-        elif (self.fund_cik is not None or self.fund_name is not None) \
-                and response.xpath(f'//div[@id="contentDiv"]//span[@class="companyName" and (contains(text(), "{self.fund_name}") or //a[contains(@href, "CIK={self.fund_cik}")])]') \
-                and response.xpath('//div[@id="headerBottom"]/div[@id="PageTitle" and contains(text(), "EDGAR Search Results")]'):
+        # Reached the filings page, follow the 13F-HR entries to their filing details
+        elif page['type'] == LISTING:
+            yield from self.parse_listing(response, page)
 
-            logging.info('Reached the Filings Page')
-            if not self.fund_cik:
-                self.fund_cik = response.xpath('//div[@id="contentDiv"]//span[@class="companyName"]/a/text()').get().split(' ')[0].strip()
+        # Reached the name results page. This means the entered name is not written EXACTLY as it is on EDGAR. Check for CIK to compensate
+        elif page['type'] == COMPANY_MATCHES:
+            if page['company_url'] is not None:
+                yield scrapy.Request(page['company_url'], callback=self.parse, errback=self.request_failed)
+            else:
+                logging.warning('The Fund Name you entered is ambiguous. Make sure the name is spelled EXACTLY as it is on EDGAR, or enter a CIK.')
 
-            if self.depth > 1:
-                # Find the last depth number of holding reports
-                reports = response.xpath('//div[@id="seriesDiv"]/table//tr [td[1] [contains(text(), "13F") and contains(text(), "HR")]] //td[2]//a//@href')
-                max_depth = len(reports)
+        # Reached the filing detail page of a 13F-HR report, follow the primary_doc.xml summary document and the holdings report
+        elif page['type'] == FILING_DETAIL:
+            yield from self.parse_filing_detail(response, page)
 
-                # Make sure depth isn't greater than the number of 13F forms on this page. Unable to handle turning pages yet.
-                if self.depth > max_depth:
-                    self.depth = max_depth
+        # Reached the summary document, pass to parser utility and write to file
+        elif page['type'] == PRIMARY_DOC:
+            logging.info('Reached the \'primary_doc.xml\' Document')
+            yield {'document': 'primary_doc', 'raw_xml': response.body, 'accession': accession_from_url(response.url)}
 
-                # Take self.depth number of reports from the list
-                reports = reports[0:self.depth]
+        # Reached the 13F holdings document, hand it to ParsingPipeline as soon as it arrives so no more than one report per in-flight slot is held in memory
+        elif page['type'] == INFO_TABLE:
+            logging.info('Reached the target 13F Holdings Report')
+            yield self.info_table_item(response, response.meta.get('date_filed', self.date_filed))
 
-                # Get the filing dates for each report and push it to the filing_dates field
-                dates = response.xpath('//div[@id="seriesDiv"]/table//tr [td[1] [contains(text(), "13F") and contains(text(), "HR")]] //td[4]//text()')[0:self.depth]
-                for date in dates:
-                    self.filing_dates.append(date.get().replace('-', '_').strip())
+        else:
+            logging.debug('Reached an unrecognized page')
 
-                # Iterate over each report and generate a new request for the Filing Detail page
-                for report in reports:
-                    next_url = response.urljoin(report.get())
-                    # Uses the parse_depth function as callback, as depth searches must be handled differently
-                    yield scrapy.Request(next_url, callback=self.parse_depth)
 
-            else:
-                # Save date_filed to class field for non-depth searches
-                if not self.date_filed:
-                    self.date_filed = response.xpath('//div[@id="seriesDiv"]/table//tr [td[1] [contains(text(), "13F") and contains(text(), "HR")]] /td[4]/text()').get().replace('-', '_').strip()
+    def parse_listing(self, response, page):
+        """
+        Follows the 13F-HR filings of a company listing page. In depth mode, every 13F-HR row (newest first) is followed until depth reports are
+        requested or since is passed, turning to the next listing page when needed. Otherwise only the most recent filing is followed
 
-                next_url = response.urljoin(response.xpath('//div[@id="seriesDiv"]/table//tr [td[1] [contains(text(), "13F") and contains(text(), "HR")]] /td[2]/a/@href').get())
-                yield scrapy.Request(next_url, callback=self.parse)
+        :param response: The Scrapy Response of the listing page
+        :param page: The page as read by edgar_pages.read_page
+        :return (generator): Requests for the Filing Detail pages, and the next listing page
+        """
 
-        # Reached the name results page. This means the entered name is not written EXACTLY as it is on EDGAR. Check for CIK to compensate
-        elif self.fund_name is not None and response.xpath(f'//div[@id="contentDiv"]/span[@class="companyMatch" and contains(text(), "Companies with names matching")]'):
-            if self.fund_cik is not None:
-                next_url = response.urljoin(response.xpath(f'//div[@id="seriesDiv"]/table//tr [td[1] [a [text()="{self.fund_cik}"]]] /td[1]/a/@href').get())
-                yield scrapy.Request(next_url, callback=self.parse)
-            else:
-                logging.warning('The Fund Name you entered is ambiguous. Make sure the name is spelled EXACTLY as it is on EDGAR, or enter a CIK.')
+        logging.info('Reached the Filings Page')
+        if not self.fund_cik:
+            self.fund_cik = page['cik']
+
+        if self.depth > 1 or self.since:
+            for filing_date, next_url in page['filings']:
+                if self.since and filing_date < self.since:
+                    self.listing_exhausted = True
+                    break
+
+                self.reports_requested += 1
+                # Filings already on disk still count towards depth, but don't need to be downloaded again
+                if not self.already_ingested(next_url):
+                    # Carry the filing date with the request, so each report is matched to its own date whatever order responses arrive in
+                    yield scrapy.Request(next_url, callback=self.parse, errback=self.request_failed, meta={'date_filed': filing_date.replace('-', '_')})
+
+                if self.reports_requested >= self.depth:
+                    self.listing_exhausted = True
+                    break
+
+            # Turn the page while more reports are needed. Listing pages get a higher priority so they keep streaming ahead of the Filing Detail requests
+            if not self.listing_exhausted:
+                if page['has_next']:
+                    # Follow the Next button's own link, the server may have returned fewer rows than the count asked for
+                    next_url = page['next_url']
+                    if next_url is None:
+                        start = int(url_query_parameter(response.url, 'start', '0'))
+                        count = int(url_query_parameter(response.url, 'count', '40'))
+                        next_url = add_or_replace_parameter(response.url, 'start', str(start + count))
+                    yield scrapy.Request(next_url, callback=self.parse, errback=self.request_failed, priority=1)
+                else:
+                    self.listing_exhausted = True
+
+            if self.listing_exhausted and self.reports_requested < self.depth:
+                logging.info(f'Found {self.reports_requested} 13F-HR reports for CIK {self.fund_cik}')
+
+        elif not page['filings']:
+            logging.warning(f'No 13F-HR reports found for CIK {self.fund_cik}')
 
-        # Reached the filing detail page for the most recent 13F - HR report, and the primary_doc.xml summary document and follow their links
-        elif response.xpath('//div[@id="headerBottom"]/div[@id="PageTitle" and contains(text(), "Filing Detail")]') and "index.htm" in response.url:
-            logging.info('Reached the Filing Detail Page')
+        else:
+            filing_date, next_url = page['filings'][0]
+            # Save date_filed to class field for non-depth searches
+            if not self.date_filed:
+                self.date_filed = filing_date.replace('-', '_')
 
-            primary_doc_url = response.urljoin(response.xpath('//div[@id="contentDiv"]//table[@class="tableFile"]//tr [td[3] [a [text()="primary_doc.xml"]]] /td[3]/a/@href').get())
-            holdings_report_url = response.urljoin(
-                response.xpath('//div[@id="contentDiv"]//table[@class="tableFile"]//tr [td[3] [a [contains(text(), ".xml")]] and td[4] [contains(text(), "INFORMATION TABLE") or contains(text(), "information table")]] /td[3]/a/@href').get())
+            if not self.already_ingested(next_url):
+                yield scrapy.Request(next_url, callback=self.parse, errback=self.request_failed, meta={'date_filed': self.date_filed})
 
-            # Generate a request for the primary_doc.xml and 13fInfoTable.xml URLs
-            for i in range(2):
-                if i == 0:
-                    yield scrapy.Request(primary_doc_url, callback=self.parse)
-                elif i == 1:
-                    yield scrapy.Request(holdings_report_url, callback=self.parse)
 
-        # Reached the summary document, pass to parser utility and write to file
-        elif "primary_doc.xml" in response.url:
-            logging.info('Reached the \'primary_doc.xml\' Document')
-            parse_primary_doc(response.body)
-            # TODO: Create a utility parser to turn raw XML into TSV and write to file
-        # Reached the 13F holdings document, pass to parser utility and write to file
-        elif ".xml" in response.url:
-            logging.info('Reached the target 13F Holdings Report')
-            parse_info_table(response.body, self.fund_cik, self.date_filed)
+    def parse_filing_detail(self, response, page):
+        """
+        Follows the primary_doc.xml and information table documents of a Filing Detail page
+
+        :param response: The Scrapy Response of the Filing Detail page
+        :param page: The page as read by edgar_pages.read_page
+        :return (generator): Requests for both documents
+        """
+
+        logging.info('Reached the Filing Detail Page')
+        if self.already_ingested(response.url):
+            return
+
+        date_filed = page['filing_date'].replace('-', '_') if page['filing_date'] else response.meta.get('date_filed', self.date_filed)
+
+        if page['primary_doc_url'] is not None:
+            yield scrapy.Request(page['primary_doc_url'], callback=self.parse, errback=self.request_failed)
+        if page['info_table_url'] is not None:
+            yield scrapy.Request(page['info_table_url'], callback=self.parse, errback=self.request_failed, meta={'date_filed': date_filed})
         else:
-            logging.debug('Reached an unrecognized page')
+            logging.warning(f'No 13F information table found on {response.url}')
+
+
+    def request_failed(self, failure):
+        """
+        Errback of every request. Responses ignored by HttpErrorMiddleware (such as a 404 for a filing document) and requests that ran out of
+        retries are counted under requests/failed, so run_batch doesn't mark the filer as done
+
+        :param failure: The Twisted Failure
+        """
+
+        logging.error(f'Failed to download {failure.request.url}: {failure.getErrorMessage()}')
+        self.crawler.stats.inc_value('requests/failed')
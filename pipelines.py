@@ -0,0 +1,279 @@
+from concurrent.futures import ProcessPoolExecutor
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+from xml_parser import INFO_TABLE_PARSERS, amendment_type, holdings_tsv_path, parse_primary_doc
+from columnar import columnar_path
+from manifest import get_manifest
+from position_diff import diff_filer
+from instrumentation import METRICS_PATH, end_stage, get_metrics_log, profiling, take_stage_seconds
+from raw_archive import RAW_ARCHIVE_DIR, get_raw_archive
+from hashlib import sha1
+import logging
+import os
+import time
+
+
+def parse_document(item, profile=None, archive=None):
+    """
+    Parses a raw XML document yielded by MutualFundsSpider. Runs inside a worker process, so it must stay a module-level function
+
+    :param item: Dict with the document type ('primary_doc' or 'info_table'), its raw_xml, accession and, for info tables, fund_cik, date, parser and columnar
+    :param profile: 'cpu' or 'memory' to dump a profile of this document, see instrumentation.profiling
+    :param archive: Directory of the RawArchive the raw document is kept in before parsing, or None
+    :return (dict): The number of rows written, the seconds spent parsing in total and per stage, and the bytes written to disk
+    """
+
+    take_stage_seconds()
+    start = time.perf_counter()
+    bytes_written = 0
+
+    # Archived before parsing, so a document that breaks the parser can be reparsed once the parser is fixed
+    raw_archive = get_raw_archive(archive)
+    if raw_archive is not None and item.get('accession'):
+        raw_archive.add(item['accession'], item['document'], item['raw_xml'], item.get('fund_cik'), item.get('date'))
+        end_stage('archive', start)
+
+    with profiling(profile, f'{item.get("accession") or item.get("fund_cik")}_{item["document"]}'):
+        if item['document'] == 'primary_doc':
+            summary = parse_primary_doc(item['raw_xml'])
+            rows = 1
+        else:
+            rows = INFO_TABLE_PARSERS[item['parser']](item['raw_xml'], item['fund_cik'], item['date'], columnar=item.get('columnar', False))
+
+    seconds = time.perf_counter() - start
+
+    if item['document'] == 'primary_doc':
+        fields = {'period': summary.get('reportcalendarorquarter'), 'amendment_type': amendment_type(summary)}
+    else:
+        tsv_path = holdings_tsv_path(item['fund_cik'], item['date'])
+        if not os.path.exists(tsv_path):
+            raise IOError(f'{tsv_path} was not written')
+
+        bytes_written = _size_on_disk(tsv_path)
+        if item.get('columnar'):
+            bytes_written += _size_on_disk(columnar_path(item['fund_cik'], item['date']))
+        fields = {'cik': item['fund_cik'], 'date': item['date'], 'sha1': sha1(item['raw_xml']).hexdigest(), 'rows': rows}
+
+    # The filing counts as ingested once both its cover page and its holdings are on disk
+    if item.get('accession'):
+        get_manifest().record(item['accession'], item['document'], **fields)
+
+    return {'rows': rows, 'seconds': round(seconds, 6), 'stages': take_stage_seconds(), 'bytes_written': bytes_written}
+
+
+def _size_on_disk(path):
+    if os.path.isdir(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class ParserPool:
+    """
+    Worker pool shared by the ParsingPipeline of every crawler in the process that uses the same settings, so parallel spiders don't each start
+    their own pool. Each pipeline holds its own reference from open_spider to close_spider, and the pool is only shut down once the last one is
+    released.
+
+    :var executor (ProcessPoolExecutor | None): The worker processes, or None to parse in the reactor's thread pool
+    :var semaphore (DeferredSemaphore): Caps the number of documents in flight across every spider using the pool
+    """
+
+    # (workers, max_in_flight) -> ParserPool
+    _pools = { }
+
+    def __init__(self, workers, max_in_flight):
+        """
+        :param workers: Number of worker processes, 0 to use threads
+        :param max_in_flight: Maximum number of documents submitted at once
+        """
+
+        self.key = (workers, max_in_flight)
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.semaphore = defer.DeferredSemaphore(max_in_flight)
+        self.references = 0
+        if workers > 0:
+            logging.info(f'Starting {workers} parser worker processes')
+
+    @classmethod
+    def acquire(cls, workers, max_in_flight):
+        """
+        :param workers: Number of worker processes, 0 to use threads
+        :param max_in_flight: Maximum number of documents submitted at once
+        :return (ParserPool): The shared pool for these settings, started if no open spider uses it
+        """
+
+        pool = cls._pools.get((workers, max_in_flight))
+        if pool is None:
+            pool = cls._pools[(workers, max_in_flight)] = cls(workers, max_in_flight)
+        pool.references += 1
+        return pool
+
+    def release(self):
+        """
+        Drops a reference, shutting the workers down once no spider uses the pool
+        """
+
+        self.references -= 1
+        if self.references == 0:
+            if ParserPool._pools.get(self.key) is self:
+                del ParserPool._pools[self.key]
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+
+    def submit(self, *args):
+        """
+        Runs parse_document in a worker process, or a thread when there are no workers
+
+        :param args: Arguments of parse_document
+        :return (Deferred): Fires with its result
+        """
+
+        if self.executor is None:
+            return threads.deferToThread(parse_document, *args)
+        return _deferred_from_future(self.executor.submit(parse_document, *args))
+
+
+class ParsingPipeline:
+    """
+    Scrapy item pipeline that moves the CPU-heavy XML parsing off the Twisted reactor, so downloads keep flowing while large reports are parsed.
+
+    Raw documents are handed to a ParserPool shared by every crawler in the process, and the result comes back to the reactor as a Deferred.
+    The pool's DeferredSemaphore caps the number of documents in flight; while it is full, items wait in Scrapy's scraper slot, which in turn
+    stops the downloader from fetching more responses.
+
+    Parse time, per stage timings, rows and bytes written are added to the crawler's stats under metrics/ and to the METRICS_FILE JSON-lines file.
+
+    Settings:
+        PARSER_WORKERS: Number of worker processes (defaults to the number of CPUs). 0 parses in the reactor's thread pool instead
+        PARSER_MAX_IN_FLIGHT: Maximum number of documents being parsed or queued for a worker (defaults to twice PARSER_WORKERS)
+        PARSER_PROFILE: 'cpu' or 'memory' to dump a cProfile or tracemalloc report of every document to 13F_Reports/profiles/
+        RAW_ARCHIVE_DIR: Directory of the raw document archive (see raw_archive.py), empty to not archive documents
+        METRICS_FILE: Path of the JSON-lines metrics file, empty to only record stats
+    """
+
+    def __init__(self, workers, max_in_flight, stats=None, metrics_log=None, profile=None, archive=None):
+        """
+        :param workers: Number of worker processes, 0 to use threads
+        :param max_in_flight: Maximum number of documents submitted at once
+        :param stats: The crawler's StatsCollector
+        :param metrics_log: The instrumentation.MetricsLog, or None
+        :param profile: 'cpu' or 'memory' to profile every document, or None
+        :param archive: Directory of the raw document archive, or None
+        """
+
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.stats = stats
+        self.metrics_log = metrics_log
+        self.profile = profile
+        self.archive = archive
+        self.pool = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """
+        Creates the pipeline from the crawler's PARSER_* settings
+
+        :param crawler: The Scrapy Crawler
+        """
+
+        workers = crawler.settings.getint('PARSER_WORKERS', os.cpu_count() or 1)
+        max_in_flight = crawler.settings.getint('PARSER_MAX_IN_FLIGHT', 2 * max(workers, 1))
+        profile = crawler.settings.get('PARSER_PROFILE')
+        if profile == 'memory' and workers == 0 and max_in_flight > 1:
+            # tracemalloc traces the whole process, documents parsed in parallel threads would end up in each other's memory profiles
+            logging.warning('Memory profiling parses one document at a time when PARSER_WORKERS is 0')
+            max_in_flight = 1
+        return cls(workers, max_in_flight, crawler.stats, get_metrics_log(crawler.settings.get('METRICS_FILE', METRICS_PATH)), profile,
+                   crawler.settings.get('RAW_ARCHIVE_DIR', RAW_ARCHIVE_DIR))
+
+    def open_spider(self, spider):
+        """
+        Takes a reference to the shared worker pool, starting it if no open spider uses it
+
+        :param spider: The Spider being opened
+        """
+
+        self.pool = ParserPool.acquire(self.workers, self.max_in_flight)
+
+    def close_spider(self, spider):
+        """
+        Releases this spider's reference to the worker pool, which shuts down once the last spider using it has closed. After a depth crawl,
+        every report of the filer is diffed against the one before it
+
+        :param spider: The Spider being closed
+        :return (Deferred | None): Fires once the position diffs are written
+        """
+
+        if self.pool is not None:
+            self.pool.release()
+            self.pool = None
+
+        if (getattr(spider, 'depth', 1) > 1 or getattr(spider, 'since', None)) and getattr(spider, 'fund_cik', None):
+            return threads.deferToThread(diff_filer, spider.fund_cik)
+
+    def process_item(self, item, spider):
+        """
+        Queues the document for parsing
+
+        :param item: The document yielded by the Spider
+        :param spider: The Spider that yielded it
+        :return (Deferred): Fires with the item, minus its raw_xml and plus the number of rows written, once it has been parsed
+        """
+
+        if 'raw_xml' not in item:
+            return item
+
+        deferred = self.pool.semaphore.run(self.pool.submit, item, self.profile, self.archive)
+        deferred.addCallbacks(self._parsed, self._failed, callbackArgs=(item,), errbackArgs=(item,))
+        return deferred
+
+    def _parsed(self, result, item):
+        raw_bytes = len(item['raw_xml'])
+        # Drop the raw body, it is no longer needed and would otherwise end up in Scrapy's item log
+        del item['raw_xml']
+        item['rows'] = result['rows']
+
+        if self.stats is not None:
+            document = item['document']
+            self.stats.inc_value(f'metrics/parse_seconds/{document}', result['seconds'])
+            self.stats.max_value(f'metrics/parse_seconds_max/{document}', result['seconds'])
+            for stage, seconds in result['stages'].items():
+                self.stats.inc_value(f'metrics/stage_seconds/{document}/{stage}', seconds)
+            if document == 'info_table':
+                self.stats.inc_value('metrics/rows', result['rows'])
+            self.stats.inc_value('metrics/bytes_written', result['bytes_written'])
+
+        if self.metrics_log is not None:
+            self.metrics_log.write('parse', cik=item.get('fund_cik'), accession=item.get('accession'), document=item['document'], raw_bytes=raw_bytes,
+                                   **result)
+        return item
+
+
+    def _failed(self, failure, item):
+        # Counted so run_batch doesn't mark the filer done when one of its documents never reached disk
+        if self.stats is not None:
+            self.stats.inc_value('parser/failed')
+            self.stats.inc_value(f'parser/failed/{item["document"]}')
+        item.pop('raw_xml', None)
+        return failure
+
+
+def _deferred_from_future(future):
+    """
+    Wraps a concurrent.futures.Future in a Deferred that fires in the reactor thread
+
+    :param future: The Future returned by the executor
+    :return (Deferred): Fires with the Future's result, or errbacks with its exception
+    """
+
+    deferred = defer.Deferred()
+
+    def done(finished):
+        exception = finished.exception()
+        if exception is not None:
+            reactor.callFromThread(deferred.errback, Failure(exception))
+        else:
+            reactor.callFromThread(deferred.callback, finished.result())
+
+    future.add_done_callback(done)
+    return deferred
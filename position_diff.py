@@ -0,0 +1,242 @@
+from columnar import DictionaryColumn, load_holdings
+from holdings_index import REPORTS_DIR, counted_reports, filing_period, find_reports, report_periods
+import csv
+import logging
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Report columns a diff reads, the others are never loaded
+POSITION_COLUMNS = ('cusip', 'titleofclass', 'putcall', 'nameofissuer', 'sshprnamt', 'value')
+DIFF_COLUMNS = ['status', 'cusip', 'titleofclass', 'putcall', 'nameofissuer', 'sshprnamt_old', 'sshprnamt_new', 'sshprnamt_delta',
+                'value_old', 'value_new', 'value_delta']
+
+
+def _text(holdings, name, count):
+    column = holdings.get(name)
+    if column is None:
+        return np.full(count, '', dtype=str)
+    if isinstance(column, DictionaryColumn):
+        return column.decode()
+    return np.asarray(column).astype(str)
+
+
+def _int(holdings, name, count):
+    column = holdings.get(name)
+    if column is None:
+        return np.zeros(count, dtype=np.int64)
+    # Missing values are stored as -1
+    return np.maximum(np.asarray(column), 0)
+
+
+def diff_positions(old, new):
+    """
+    Compares two holdings reports of the same filer, position by position.
+
+    A position is identified by CUSIP, put/call and title of class, and lines sharing a position (split across other managers, for example)
+    are summed first. Every component is mapped to an integer code and packed into one int64 key, so grouping and the join are np.unique and
+    np.searchsorted over sorted key arrays rather than Python dict loops.
+
+    :param old: Columns of the earlier report, as returned by columnar.load_holdings
+    :param new: Columns of the later report
+    :return (dict): Column name -> array for every position that is new, exited, increased or decreased, see DIFF_COLUMNS
+    """
+
+    old_count, new_count = len(old['cusip']), len(new['cusip'])
+
+    # Encode every key component over both reports at once, so equal values get equal codes
+    components = []
+    for name in ('cusip', 'titleofclass', 'putcall'):
+        if name == 'cusip':
+            values = np.concatenate((np.asarray(old['cusip']), np.asarray(new['cusip'])))
+        else:
+            values = np.concatenate((_text(old, name, old_count), _text(new, name, new_count)))
+        uniques, codes = np.unique(values, return_inverse=True)
+        components.append((uniques, codes.astype(np.int64)))
+
+    keys = np.zeros(old_count + new_count, dtype=np.int64)
+    for uniques, codes in components:
+        keys = keys * len(uniques) + codes
+
+    names = np.concatenate((_text(old, 'nameofissuer', old_count), _text(new, 'nameofissuer', new_count)))
+    shares = np.concatenate((_int(old, 'sshprnamt', old_count), _int(new, 'sshprnamt', new_count)))
+    values = np.concatenate((_int(old, 'value', old_count), _int(new, 'value', new_count)))
+
+    def totals(rows):
+        # Sum every line of a position into one entry per key
+        position_keys, first, inverse = np.unique(keys[rows], return_index=True, return_inverse=True)
+        return position_keys, first + rows.start, np.bincount(inverse, weights=shares[rows]).astype(np.int64), \
+               np.bincount(inverse, weights=values[rows]).astype(np.int64)
+
+    old_keys, old_first, old_shares, old_values = totals(slice(0, old_count))
+    new_keys, new_first, new_shares, new_values = totals(slice(old_count, old_count + new_count))
+
+    # Sort-merge join: both key arrays are sorted, so each side's position in the union is a binary search
+    all_keys = np.union1d(old_keys, new_keys)
+    in_old = np.isin(all_keys, old_keys, assume_unique=True)
+    in_new = np.isin(all_keys, new_keys, assume_unique=True)
+    old_index = np.searchsorted(old_keys, all_keys).clip(max=max(len(old_keys) - 1, 0))
+    new_index = np.searchsorted(new_keys, all_keys).clip(max=max(len(new_keys) - 1, 0))
+
+    zeros = np.zeros(len(all_keys), dtype=np.int64)
+    shares_old = np.where(in_old, old_shares[old_index] if len(old_keys) else zeros, 0)
+    shares_new = np.where(in_new, new_shares[new_index] if len(new_keys) else zeros, 0)
+    value_old = np.where(in_old, old_values[old_index] if len(old_keys) else zeros, 0)
+    value_new = np.where(in_new, new_values[new_index] if len(new_keys) else zeros, 0)
+    # Describe each position with its line from the newer report when it has one
+    first_line = np.where(in_new, new_first[new_index] if len(new_keys) else zeros, old_first[old_index] if len(old_keys) else zeros)
+
+    status = np.full(len(all_keys), 'unchanged', dtype='U9')
+    status[shares_new > shares_old] = 'increased'
+    status[shares_new < shares_old] = 'decreased'
+    status[~in_old] = 'new'
+    status[~in_new] = 'exited'
+    changed = status != 'unchanged'
+
+    # Unpack the key back into its components
+    component_values = []
+    remainder = all_keys[changed]
+    for uniques, _ in reversed(components):
+        component_values.append(uniques[remainder % len(uniques)])
+        remainder = remainder // len(uniques)
+    putcall, titleofclass, cusip = component_values
+
+    return {
+        'status': status[changed],
+        'cusip': cusip,
+        'titleofclass': titleofclass,
+        'putcall': putcall,
+        'nameofissuer': names[first_line[changed]],
+        'sshprnamt_old': shares_old[changed],
+        'sshprnamt_new': shares_new[changed],
+        'sshprnamt_delta': (shares_new - shares_old)[changed],
+        'value_old': value_old[changed],
+        'value_new': value_new[changed],
+        'value_delta': (value_new - value_old)[changed],
+    }
+
+
+def write_diff(diff, path):
+    """
+    Writes a diff produced by diff_positions to a .tsv file
+
+    :param diff: The diff
+    :param path: Path of the .tsv file
+    """
+
+    columns = [diff[name].tolist() for name in DIFF_COLUMNS]
+    columns[1] = [cusip.decode('ascii').strip() for cusip in columns[1]]
+
+    try:
+        with open(path, 'wt') as tsv_file:
+            tsv_writer = csv.writer(tsv_file, delimiter='\t')
+            tsv_writer.writerow(DIFF_COLUMNS)
+            tsv_writer.writerows(zip(*columns))
+    except IOError:
+        logging.debug(f'Failed to create {path}')
+
+
+def quarter_reports(filer, reports_dir=REPORTS_DIR):
+    """
+    Groups the reports of a filer on disk by the quarter they cover, keeping the reports that make up its holdings for each quarter: the latest
+    original report or RESTATEMENT amendment, plus the NEW HOLDINGS amendments filed after it (see holdings_index.counted_reports)
+
+    :param filer: The filer's CIK, as used in report file names
+    :param reports_dir: Directory holding the reports and the manifest
+    :return (list): (quarter, [path]) tuples, oldest quarter first, paths in filing order
+    """
+
+    filer = filer.lower().strip()
+    periods = report_periods(reports_dir)
+
+    quarters = { }
+    for report_filer, date, path in find_reports(reports_dir):
+        if report_filer == filer:
+            quarter, amendment_type = filing_period(filer, date, periods)
+            quarters.setdefault(quarter, []).append((date, path, amendment_type))
+
+    grouped = []
+    for quarter, reports in sorted(quarters.items()):
+        reports.sort()
+        counted = counted_reports([amendment_type for _, _, amendment_type in reports])
+        grouped.append((quarter, [path for (_, path, _), counts in zip(reports, counted) if counts]))
+    return grouped
+
+
+def load_quarter(paths):
+    """
+    Loads the positions of a filer for one quarter, concatenating the reports that make it up
+
+    :param paths: Paths of the reports, see quarter_reports
+    :return (dict): Columns of POSITION_COLUMNS, as returned by columnar.load_holdings. Empty if no report has a CUSIP column
+    """
+
+    parts = [holdings for holdings in (load_holdings(path, POSITION_COLUMNS) for path in paths) if 'cusip' in holdings]
+    if len(parts) <= 1:
+        return parts[0] if parts else { }
+
+    counts = [len(part['cusip']) for part in parts]
+    merged = {'cusip': np.concatenate([np.asarray(part['cusip']) for part in parts])}
+    for name in ('titleofclass', 'putcall', 'nameofissuer'):
+        merged[name] = np.concatenate([_text(part, name, count) for part, count in zip(parts, counts)])
+    for name in ('sshprnamt', 'value'):
+        merged[name] = np.concatenate([_int(part, name, count) for part, count in zip(parts, counts)])
+    return merged
+
+
+def diff_filer(filer, reports_dir=REPORTS_DIR, force=False):
+    """
+    Diffs the holdings of a filer for every pair of consecutive quarters on disk, writing <filer>_13f_diff_<old quarter>_<new quarter>.tsv for
+    each pair. Reports are grouped by their period of report rather than their filing date, so amendments are merged into the quarter they
+    amend (see quarter_reports). A pair whose diff file is newer than all of its reports is left alone, so only pairs with a new or rewritten
+    report are diffed again
+
+    :param filer: The filer's CIK, as used in report file names
+    :param reports_dir: Directory holding the reports
+    :param force: Diff every pair again, even if its diff file is up to date
+    :return (list): Paths of the diff files written
+    """
+
+    if np is None:
+        logging.warning('NumPy is required to diff positions, install it with: pip install numpy')
+        return []
+
+    filer = filer.lower().strip()
+    quarters = quarter_reports(filer, reports_dir)
+
+    written = []
+    up_to_date = 0
+    # Holdings of the previous quarter, kept while consecutive pairs need diffing so each quarter is loaded once
+    previous_holdings = None
+    for (old_quarter, old_paths), (new_quarter, new_paths) in zip(quarters, quarters[1:]):
+        diff_path = os.path.join(reports_dir, f'{filer}_13f_diff_{old_quarter}_{new_quarter}.tsv')
+        if not force and _newer_than(diff_path, *old_paths, *new_paths):
+            up_to_date += 1
+            previous_holdings = None
+            continue
+
+        old = previous_holdings if previous_holdings is not None else load_quarter(old_paths)
+        new = previous_holdings = load_quarter(new_paths)
+        if 'cusip' in old and 'cusip' in new:
+            write_diff(diff_positions(old, new), diff_path)
+            written.append(diff_path)
+
+    logging.info(f'Wrote {len(written)} position diffs for {filer}' + (f', {up_to_date} already up to date' if up_to_date else ''))
+    return written
+
+
+def _newer_than(path, *sources):
+    """
+    :param path: The file written from sources
+    :param sources: Paths of the files it was written from
+    :return (bool): Whether path exists and was modified after every source
+    """
+
+    if not os.path.exists(path):
+        return False
+    modified = os.path.getmtime(path)
+    return all(os.path.getmtime(source) < modified for source in sources)
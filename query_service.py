@@ -0,0 +1,549 @@
+from holdings_index import REPORTS_DIR, HoldingsIndex, filing_period, find_reports, merge_postings, report_periods, report_postings
+from columnar import DictionaryColumn, load_holdings
+from summary_store import SummaryStore
+from collections import OrderedDict
+from functools import lru_cache
+from urllib.parse import parse_qs, unquote, urlparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+POLL_INTERVAL = 5.0
+CACHE_SIZE = 1024
+# Cap on the rows a single response returns, use offset to page through larger reports
+MAX_LIMIT = 10000
+# Cap on the CUSIPs /top returns
+MAX_TOP = 1000
+# CUSIPs are 9 characters out of letters, digits, *, @ and #
+CUSIP_PATTERN = re.compile(r'^[0-9A-Z*@#]{1,9}$')
+STATUS_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class QueryError(Exception):
+    """
+    A query that can't be answered, turned into a JSON error response with its HTTP status
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _filer_key(cik):
+    # Report file names keep the CIK as it was crawled, zero padded or not
+    return cik.strip().lstrip('0') or '0'
+
+
+def _json_value(value):
+    # NumPy scalars become their Python equivalents, fixed-width CUSIPs become text
+    if np is not None and isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bytes):
+        return value.decode('ascii', 'replace').strip()
+    return value
+
+
+class HoldingsSnapshot:
+    """
+    Everything the service answers queries from, loaded at one point in time: the list of reports per filer, an in-memory CUSIP index (see
+    holdings_index.merge_postings) and every primary_doc.xml summary from the summary store, grouped by filer. Holdings of a filer's report are
+    loaded with columnar.load_holdings when first asked for.
+
+    Nothing is written to the reports directory, so the service stays read-only next to a crawl or main.py -index. The postings of every report
+    are kept with the size and modification time they were read at, and a reload only reads the reports that are new or changed since then.
+
+    :var reports (dict): Filer CIK (without leading zeros) -> [(date, path)], oldest first
+    :var periods (dict): Report path -> (quarter it covers, amendment type), see holdings_index.filing_period
+    :var signature (tuple): Paths and modification times the snapshot was loaded from, see report_signature
+    :var postings (dict): Report path -> ((modification time, size), postings of the report, with issuer names)
+    :var issuers (dict): CUSIP (9 bytes, as indexed) -> issuer name, from the CUSIP's first posting in the index
+    :var totals (dict): Value, shares and holders per CUSIP per quarter, see HoldingsIndex.aggregate
+    """
+
+    def __init__(self, reports_dir=REPORTS_DIR, previous=None):
+        """
+        Loads a snapshot of a reports directory. Slow, run it off the event loop
+
+        :param reports_dir: Directory holding the reports and the summary store
+        :param previous: The snapshot being replaced, whose postings are reused for the reports that haven't changed
+        """
+
+        self.reports_dir = reports_dir
+        self.signature = report_signature(reports_dir)
+        self.loaded_at = time.time()
+        # Reports read for holdings queries and issuer names, .tsv reports are parsed so keep the most recent ones
+        self.load_holdings = lru_cache(maxsize=64)(load_holdings)
+
+        self.reports = { }
+        self.report_paths = { }
+        self.periods = { }
+        manifest_periods = report_periods(reports_dir)
+        for filer, date, path in find_reports(reports_dir):
+            self.reports.setdefault(_filer_key(filer), []).append((date, path))
+            self.report_paths[(filer, date)] = path
+            self.periods[path] = filing_period(filer, date, manifest_periods)
+
+        versions = {path: (mtime, size) for path, mtime, size in self.signature}
+        known = previous.postings if previous is not None else { }
+        self.postings = { }
+        reread = 0
+
+        def postings(path):
+            version = versions.get(path)
+            cached = known.get(path)
+            if cached is not None and cached[0] == version:
+                self.postings[path] = cached
+            else:
+                nonlocal reread
+                reread += 1
+                self.postings[path] = (version, report_postings(path, names=True))
+            return self.postings[path][1]
+
+        arrays = merge_postings(find_reports(reports_dir), postings, manifest_periods)
+        self.index = HoldingsIndex(arrays=arrays)
+        self.holdings_count = len(arrays['cusip'])
+        logging.info(f'Read the holdings of {reread} new or changed reports, reused {len(self.postings) - reread}')
+
+        # Worked out once per snapshot, so /top neither scans the index nor reads reports for issuer names on every query
+        self.totals = self.index.aggregate()
+        self.issuers = self._issuer_names()
+
+        self.summaries = { }
+        summary_path = os.path.join(reports_dir, 'search_summary.db')
+        if not os.path.exists(summary_path):
+            # Opening the store would create it, leave that to the crawl
+            return
+        store = SummaryStore(summary_path)
+        try:
+            for summary in store:
+                self.summaries.setdefault(_filer_key(summary.get('filer_cik', '')), []).append(summary)
+        finally:
+            store.close()
+
+    def filer(self, cik):
+        """
+        :param cik: The filer's CIK
+        :return (dict): The filer's reports and primary_doc.xml summaries
+        """
+
+        key = _filer_key(cik)
+        if key not in self.reports and key not in self.summaries:
+            raise QueryError(404, f'No reports for CIK {cik}')
+        return {'cik': cik, 'reports': [{'date': date, 'quarter': self.periods[path][0], 'amendment_type': self.periods[path][1]}
+                                        for date, path in self.reports.get(key, [])],
+                'summaries': self.summaries.get(key, [])}
+
+    def holdings(self, cik, date=None, top=None, offset=0, limit=MAX_LIMIT):
+        """
+        Holdings of one report of a filer
+
+        :param cik: The filer's CIK
+        :param date: Filing date of the report (YYYY_MM_DD), the latest report if None
+        :param top: Only return the top rows by value
+        :param offset: Index of the first row returned
+        :param limit: Maximum number of rows returned
+        :return (dict): The report's date, quarter, amendment type, total row count and rows
+        """
+
+        reports = self.reports.get(_filer_key(cik))
+        if not reports:
+            raise QueryError(404, f'No reports for CIK {cik}')
+
+        if date is None:
+            date, path = reports[-1]
+        else:
+            path = dict(reports).get(date)
+            if path is None:
+                raise QueryError(404, f'No report filed on {date} for CIK {cik}')
+
+        columns = self.load_holdings(path)
+        count = len(next(iter(columns.values()))) if columns else 0
+
+        if top is not None and 'value' in columns:
+            rows = np.argsort(-np.asarray(columns['value']), kind='stable')[:top]
+        else:
+            rows = np.arange(offset, min(offset + limit, count))
+
+        decoded = { }
+        for name, column in columns.items():
+            if isinstance(column, DictionaryColumn):
+                decoded[name] = column.categories[np.asarray(column.codes)[rows]]
+            else:
+                decoded[name] = np.asarray(column)[rows]
+
+        holdings = []
+        for position in range(len(rows)):
+            holding = { }
+            for name, column in decoded.items():
+                value = _json_value(column[position])
+                # Missing numbers are stored as -1 and missing text as ''
+                holding[name] = None if value == -1 or value == '' else value
+            holdings.append(holding)
+
+        quarter, amendment_type = self.periods[path]
+        return {'cik': cik, 'date': date, 'quarter': quarter, 'amendment_type': amendment_type, 'count': count, 'holdings': holdings}
+
+    def holders(self, cusip, quarter=None):
+        """
+        Every filer holding a CUSIP, largest positions first
+
+        :param cusip: The CUSIP
+        :param quarter: Only holdings reported for this quarter (YYYYQn)
+        :return (dict): The holdings
+        """
+
+        found = self.index.holders(_cusip(cusip))
+        positions = np.arange(len(found['filer']))
+        if quarter is not None:
+            positions = positions[found['quarter'] == quarter]
+        positions = positions[np.argsort(-found['value'][positions], kind='stable')]
+
+        holders = [{'cik': _json_value(found['filer'][position]), 'date': _json_value(found['date'][position]),
+                    'quarter': _json_value(found['quarter'][position]), 'amendment_type': _json_value(found['amendment'][position]) or None,
+                    'value': _json_value(found['value'][position]),
+                    'shares': _json_value(found['shares'][position])} for position in positions]
+        return {'cusip': _cusip(cusip), 'quarter': quarter, 'holders': holders}
+
+    def top(self, count=10, quarter=None):
+        """
+        CUSIPs with the largest total value held across every filer in a quarter
+
+        :param count: Number of CUSIPs returned
+        :param quarter: The quarter (YYYYQn), the latest one indexed if None
+        :return (dict): The CUSIPs, with their issuer name, total value, shares and number of holders
+        """
+
+        totals = self.totals
+        if len(totals['cusip']) == 0:
+            return {'quarter': quarter, 'top': []}
+
+        if quarter is None:
+            quarter = max(totals['quarter'].tolist())
+        positions = np.flatnonzero(totals['quarter'] == quarter)
+        positions = positions[np.argsort(-totals['value'][positions], kind='stable')[:count]]
+
+        top = []
+        for position in positions:
+            cusip = _json_value(totals['cusip'][position])
+            top.append({'cusip': cusip, 'name': self.issuers.get(bytes(totals['cusip'][position])), 'value': _json_value(totals['value'][position]),
+                        'shares': _json_value(totals['shares'][position]), 'holders': _json_value(totals['holders'][position])})
+        return {'quarter': quarter, 'top': top}
+
+    def _issuer_names(self):
+        # The index has no issuer names, take the name of each CUSIP's first posting from the issuer names kept with the report's postings
+        cusips = self.index.cusip
+        if len(cusips) == 0:
+            return { }
+        starts = np.flatnonzero(np.concatenate(([True], cusips[1:] != cusips[:-1])))
+        reports = np.asarray(self.index.report[starts])
+        rows = np.asarray(self.index.row[starts])
+
+        # Group the first postings by report, so each report's names are looked up in one go
+        order = np.argsort(reports, kind='stable')
+        report_ids, group_starts = np.unique(reports[order], return_index=True)
+
+        issuers = { }
+        for report, positions in zip(report_ids.tolist(), np.split(order, group_starts[1:])):
+            path = self.report_paths.get((str(self.index.report_filer[report]), str(self.index.report_date[report])))
+            postings = self.postings.get(path, (None, None))[1]
+            column = postings.get('nameofissuer') if postings is not None else None
+            if column is None:
+                continue
+            if isinstance(column, DictionaryColumn):
+                names = column.categories[np.asarray(column.codes)[rows[positions]]]
+            else:
+                names = np.asarray(column)[rows[positions]]
+            for cusip, name in zip(np.asarray(cusips[starts[positions]]).tolist(), names.tolist()):
+                if name:
+                    issuers[cusip] = name
+        return issuers
+
+
+def report_signature(reports_dir=REPORTS_DIR):
+    """
+    Fingerprints the reports, the summary store and the manifest of a directory, so the service notices new or rewritten reports without
+    reloading them. The manifest holds the period of report of every filing, see holdings_index.report_periods
+
+    :param reports_dir: Directory holding the reports
+    :return (tuple): Sorted (path, modification time, size) of every report, summary store and manifest file
+    """
+
+    paths = [path for _, _, path in find_reports(reports_dir)]
+    paths += [os.path.join(reports_dir, name) for name in ('search_summary.db', 'search_summary.db-wal', 'manifest.db', 'manifest.db-wal')]
+
+    signature = []
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+class QueryService:
+    """
+    Local HTTP/JSON service answering holdings queries from an in-memory HoldingsSnapshot, built on asyncio streams.
+
+    Results are kept in an LRU cache keyed by the request path and query string. Queries missing from it are answered in a worker thread, as
+    they can read a report from disk, so the event loop keeps serving other clients meanwhile. The reports directory is polled for new or
+    rewritten reports, and a changed directory is reloaded in a worker thread while queries keep being answered from the previous snapshot,
+    which is then swapped out and the cache cleared.
+
+    Endpoints (all GET):
+        /filers/<cik>: The filer's reports and primary_doc.xml summaries
+        /filers/<cik>/holdings?date=YYYY_MM_DD&top=N&offset=N&limit=N: Holdings of a report, the latest one by default
+        /cusips/<cusip>/holders?quarter=YYYYQn: Every filer holding a CUSIP, largest positions first
+        /top?n=N&quarter=YYYYQn: The CUSIPs with the largest total value held in a quarter (at most MAX_TOP), the latest one by default
+        /status: Number of reports and holdings loaded, cache statistics and the time of the last reload
+    """
+
+    def __init__(self, reports_dir=REPORTS_DIR, poll_interval=POLL_INTERVAL, cache_size=CACHE_SIZE):
+        """
+        :param reports_dir: Directory holding the reports
+        :param poll_interval: Seconds between checks for new reports, 0 to never reload
+        :param cache_size: Number of query results kept in the LRU cache
+        """
+
+        self.reports_dir = reports_dir
+        self.poll_interval = poll_interval
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.snapshot = None
+
+    def load(self):
+        """
+        Loads the first snapshot
+        """
+
+        self.swap(HoldingsSnapshot(self.reports_dir))
+
+    def swap(self, snapshot):
+        """
+        Starts answering queries from a new snapshot. Cached results came from the previous one, so the cache is cleared
+
+        :param snapshot: The HoldingsSnapshot
+        """
+
+        self.snapshot = snapshot
+        self.cache.clear()
+        logging.info(f'Loaded {sum(len(reports) for reports in snapshot.reports.values())} reports ({snapshot.holdings_count} holdings) '
+                     f'in {time.time() - snapshot.loaded_at:.1f}s')
+
+    async def watch(self):
+        """
+        Reloads the snapshot whenever the reports on disk change
+        """
+
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                signature = await loop.run_in_executor(None, report_signature, self.reports_dir)
+                if signature != self.snapshot.signature:
+                    logging.info('Reports changed, reloading')
+                    # Only the loading runs in the worker thread, the swap happens on the event loop between two requests
+                    self.swap(await loop.run_in_executor(None, HoldingsSnapshot, self.reports_dir, self.snapshot))
+            except Exception as e:
+                logging.warning(f'Reload failed, still serving the previous snapshot: {e}')
+
+    async def query(self, target):
+        """
+        Answers one request, from the cache when possible
+
+        :param target: The request target, path and query string
+        :return (int, bytes): HTTP status and JSON body
+        """
+
+        cached = self.cache.get(target)
+        if cached is not None:
+            self.cache.move_to_end(target)
+            self.cache_hits += 1
+            return cached
+
+        self.cache_misses += 1
+        url = urlparse(target)
+        parts = [unquote(part) for part in url.path.strip('/').split('/') if part]
+        parameters = {name: values[0] for name, values in parse_qs(url.query).items()}
+
+        snapshot = self.snapshot
+        try:
+            if parts == ['status']:
+                result = 200, json.dumps(self.status()).encode('utf-8')
+            else:
+                loop = asyncio.get_event_loop()
+                result = 200, await loop.run_in_executor(None, lambda: json.dumps(self.route(snapshot, parts, parameters)).encode('utf-8'))
+        except QueryError as e:
+            result = e.status, json.dumps({'error': str(e)}).encode('utf-8')
+
+        # Status responses change with every request, errors aren't worth a cache slot, and results of a snapshot swapped out meanwhile are stale
+        if result[0] == 200 and parts != ['status'] and snapshot is self.snapshot:
+            self.cache[target] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def status(self):
+        """
+        :return (dict): Number of reports and holdings loaded, cache statistics and the time of the last reload
+        """
+
+        snapshot = self.snapshot
+        return {'reports': sum(len(reports) for reports in snapshot.reports.values()), 'filers': len(snapshot.reports),
+                'holdings': snapshot.holdings_count, 'summaries': sum(len(summaries) for summaries in snapshot.summaries.values()),
+                'loaded_at': snapshot.loaded_at, 'cache': {'entries': len(self.cache), 'hits': self.cache_hits, 'misses': self.cache_misses}}
+
+    @staticmethod
+    def route(snapshot, parts, parameters):
+        """
+        Answers a query from a snapshot. Runs in a worker thread, so it must not touch the service's cache
+
+        :param snapshot: The HoldingsSnapshot the query is answered from
+        :param parts: The URL path segments
+        :param parameters: The query string parameters
+        :return (dict): The JSON-serializable result
+        """
+
+        if len(parts) == 2 and parts[0] == 'filers':
+            return snapshot.filer(parts[1])
+        if len(parts) == 3 and parts[0] == 'filers' and parts[2] == 'holdings':
+            top = _int_parameter(parameters, 'top', None)
+            return snapshot.holdings(parts[1], parameters.get('date'), top=min(top, MAX_LIMIT) if top is not None else None,
+                                     offset=_int_parameter(parameters, 'offset', 0), limit=min(_int_parameter(parameters, 'limit', MAX_LIMIT), MAX_LIMIT))
+        if len(parts) == 3 and parts[0] == 'cusips' and parts[2] == 'holders':
+            return snapshot.holders(parts[1], parameters.get('quarter'))
+        if parts == ['top']:
+            return snapshot.top(min(_int_parameter(parameters, 'n', 10), MAX_TOP), parameters.get('quarter'))
+        raise QueryError(404, 'Unknown endpoint, see query_service.QueryService for the list of endpoints')
+
+    async def handle(self, reader, writer):
+        """
+        Serves one HTTP connection: reads a single request and answers it with a JSON body, then closes the connection
+
+        :param reader: The connection's asyncio.StreamReader
+        :param writer: The connection's asyncio.StreamWriter
+        """
+
+        try:
+            request_line = await reader.readline()
+            # Headers carry nothing the service uses, skip to the blank line ending them
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+            fields = request_line.decode('latin-1').split()
+            if len(fields) != 3:
+                status, body = 400, json.dumps({'error': 'Malformed request'}).encode('utf-8')
+            elif fields[0] != 'GET':
+                status, body = 405, json.dumps({'error': 'Only GET is supported'}).encode('utf-8')
+            elif self.snapshot is None:
+                status, body = 503, json.dumps({'error': 'Still loading reports'}).encode('utf-8')
+            else:
+                try:
+                    status, body = await self.query(fields[1])
+                except Exception as e:
+                    logging.exception(f'Failed to answer {fields[1]}')
+                    status, body = 500, json.dumps({'error': str(e)}).encode('utf-8')
+
+            writer.write(f'HTTP/1.1 {status} {STATUS_REASONS.get(status, "")}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def _cusip(cusip):
+    cusip = cusip.strip().upper()
+    if not CUSIP_PATTERN.match(cusip):
+        raise QueryError(400, f'Invalid CUSIP {cusip!r}, expected up to 9 letters, digits, *, @ or #')
+    return cusip
+
+
+def _int_parameter(parameters, name, default):
+    value = parameters.get(name)
+    if value is None:
+        return default
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        raise QueryError(400, f'Parameter \'{name}\' must be an integer')
+
+
+def main():
+    """
+    Serves holdings queries until interrupted. Query it with: curl http://127.0.0.1:8080/top?n=20
+
+    Flags:
+        -port=N, -host=ADDRESS: Where to listen (default 127.0.0.1:8080)
+        -reports_dir=DIR: Directory holding the reports (default ./13F_Reports)
+        -poll=SECONDS: Seconds between checks for new reports, 0 to never reload (default 5)
+        -cache_size=N: Number of query results cached (default 1024)
+    """
+
+    logging.basicConfig(format='(%(asctime)s) %(levelname)s: %(message)s', level=logging.INFO)
+
+    host, port = '127.0.0.1', 8080
+    options = {}
+
+    for arg in sys.argv[1:]:
+        if not arg.startswith('-'):
+            continue
+        arg_name, _, arg_value = arg[1:].partition('=')
+        try:
+            if arg_name == 'host':
+                host = arg_value
+            elif arg_name == 'port':
+                port = int(arg_value)
+            elif arg_name == 'reports_dir':
+                options['reports_dir'] = arg_value
+            elif arg_name == 'poll':
+                options['poll_interval'] = float(arg_value)
+            elif arg_name == 'cache_size':
+                options['cache_size'] = int(arg_value)
+            else:
+                logging.warning(f'{arg} is not a valid argument')
+        except ValueError:
+            logging.warning(f'Argument \'{arg_name}\' must be a number')
+            sys.exit()
+
+    if np is None:
+        logging.error('NumPy is required for the query service, install it with: pip install numpy')
+        sys.exit()
+
+    service = QueryService(**options)
+    service.load()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(asyncio.start_server(service.handle, host, port))
+    if service.poll_interval > 0:
+        loop.create_task(service.watch())
+    logging.info(f'Query service listening on http://{host}:{port}')
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
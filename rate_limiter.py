@@ -0,0 +1,261 @@
+from scrapy import signals
+from twisted.internet import reactor, task
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from collections import deque
+import logging
+import random
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every MutualFundsSpider in the process, keeping the combined request rate under SEC's fair-access limit.
+
+    The rate adapts AIMD style: every throttled response (429/403/5xx) halves it, and every successful response adds back a small step until the
+    ceiling is reached again, so crawls settle right under whatever rate SEC is currently accepting.
+
+    :var ceiling (float): Maximum requests per second
+    :var rate (float): Current requests per second
+    """
+
+    def __init__(self, ceiling, burst=1.0, min_rate=0.5, recovery_step=0.05, cooldown=2.0):
+        """
+        :param ceiling: Maximum requests per second
+        :param burst: Number of requests that may be sent back to back after an idle period
+        :param min_rate: The rate is never halved below this
+        :param recovery_step: Requests per second added back after each successful response
+        :param cooldown: Seconds after halving the rate during which further throttling is ignored
+        """
+
+        self.ceiling = ceiling
+        self.rate = ceiling
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recovery_step = recovery_step
+        self.cooldown = cooldown
+        self.last_throttled = float('-inf')
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.sent = deque()
+
+    def reserve(self):
+        """
+        Takes a token for one request. Tokens may go negative, which queues the request behind the ones already waiting
+
+        :return (float): Seconds the request has to wait before it may be sent
+        """
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        self.sent.append(now + wait)
+        return wait
+
+    def throttled(self):
+        """
+        Halves the rate after SEC pushed back. Requests already in flight when the rate was halved are likely to be throttled too, so further
+        pushback within the cooldown doesn't halve it again
+        """
+
+        now = time.monotonic()
+        if now - self.last_throttled < self.cooldown:
+            return
+        self.last_throttled = now
+
+        self.rate = max(self.min_rate, self.rate / 2)
+        logging.warning(f'SEC is throttling requests, slowing down to {self.rate:.2f} requests/sec')
+
+    def succeeded(self):
+        """
+        Recovers the rate by one step after a successful response
+        """
+
+        if self.rate < self.ceiling:
+            self.rate = min(self.ceiling, self.rate + self.recovery_step)
+
+    def requests_per_second(self, window=10.0):
+        """
+        Measures the rate requests were actually sent at over the last window seconds
+
+        :param window: Length of the sliding window in seconds
+        :return (float): Requests per second
+        """
+
+        now = time.monotonic()
+        while self.sent and self.sent[0] < now - window:
+            self.sent.popleft()
+        return sum(1 for sent in self.sent if sent <= now) / window
+
+
+class EdgarRateLimitMiddleware:
+    """
+    Scrapy downloader middleware that sends every request to an SEC host through the process-wide TokenBucket, and retries throttled responses
+    with exponential backoff and jitter, waiting at least as long as the response's Retry-After header asks.
+
+    It sits after HttpCacheMiddleware, so responses served from the cache never spend a token.
+
+    Settings:
+        SEC_RATE_LIMIT: Maximum requests per second across the process (SEC allows 10)
+        SEC_RATE_LIMIT_HOSTS: These hosts and their subdomains are rate limited
+        SEC_THROTTLE_HTTP_CODES: Responses that slow the bucket down and are retried
+        SEC_MAX_RETRIES: Retries per request before giving up
+        SEC_RETRY_BACKOFF: Base delay in seconds, doubled on every retry of the same request
+    """
+
+    bucket = None
+    open_spiders = 0
+    metrics_loop = None
+
+    def __init__(self, crawler):
+        """
+        :param crawler: The Scrapy Crawler
+        """
+
+        settings = crawler.settings
+        self.stats = crawler.stats
+        self.hosts = tuple(settings.getlist('SEC_RATE_LIMIT_HOSTS', ['sec.gov']))
+        self.throttle_codes = set(int(code) for code in settings.getlist('SEC_THROTTLE_HTTP_CODES', [403, 429, 500, 502, 503, 504]))
+        self.max_retries = settings.getint('SEC_MAX_RETRIES', 5)
+        self.backoff = settings.getfloat('SEC_RETRY_BACKOFF', 2.0)
+
+        if EdgarRateLimitMiddleware.bucket is None:
+            EdgarRateLimitMiddleware.bucket = TokenBucket(settings.getfloat('SEC_RATE_LIMIT', 10.0))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """
+        Creates the middleware and hooks it up to the spider_opened and spider_closed signals
+
+        :param crawler: The Scrapy Crawler
+        """
+
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_opened(self, spider):
+        """
+        Starts logging the live request rate when the first spider opens
+
+        :param spider: The Spider being opened
+        """
+
+        EdgarRateLimitMiddleware.open_spiders += 1
+        if EdgarRateLimitMiddleware.metrics_loop is None:
+            EdgarRateLimitMiddleware.metrics_loop = task.LoopingCall(self.log_rate)
+            EdgarRateLimitMiddleware.metrics_loop.start(10.0, now=False)
+
+    def spider_closed(self, spider):
+        """
+        Stops logging the request rate once the last spider has closed
+
+        :param spider: The Spider being closed
+        """
+
+        self.stats.set_value('rate_limiter/rate', round(EdgarRateLimitMiddleware.bucket.rate, 2))
+        EdgarRateLimitMiddleware.open_spiders -= 1
+        if EdgarRateLimitMiddleware.open_spiders == 0 and EdgarRateLimitMiddleware.metrics_loop is not None:
+            EdgarRateLimitMiddleware.metrics_loop.stop()
+            EdgarRateLimitMiddleware.metrics_loop = None
+
+    def log_rate(self):
+        """
+        Logs the measured requests/sec against the bucket's current allowed rate
+        """
+
+        bucket = EdgarRateLimitMiddleware.bucket
+        requests_per_second = bucket.requests_per_second()
+        self.stats.max_value('rate_limiter/max_requests_per_second', round(requests_per_second, 2))
+        logging.info(f'SEC rate limiter: {requests_per_second:.2f} requests/sec (allowed {bucket.rate:.2f}/{bucket.ceiling:.2f})')
+
+    def process_request(self, request, spider):
+        """
+        Delays the request until it may be sent
+
+        :param request: The Scrapy Request
+        :param spider: The Spider that made the request
+        :return (Deferred | None): Fires once the request may be sent, or None if it can go right away
+        """
+
+        if not self._limited(request):
+            return None
+
+        # A retried request first waits out its backoff, then queues for a token like any other request
+        backoff = request.meta.pop('sec_retry_delay', 0)
+        if backoff:
+            return task.deferLater(reactor, backoff, self._wait_for_token)
+        return self._wait_for_token()
+
+    def _wait_for_token(self):
+        wait = EdgarRateLimitMiddleware.bucket.reserve()
+        if wait > 0:
+            return task.deferLater(reactor, wait, lambda: None)
+        return None
+
+    def process_response(self, request, response, spider):
+        """
+        Slows the bucket down and schedules a retry when SEC throttles a request, otherwise lets the rate recover
+
+        :param request: The Scrapy Request
+        :param response: The downloaded Response
+        :param spider: The Spider that made the request
+        :return (Response | Request): The response, or the retry request
+        """
+
+        if not self._limited(request) or 'cached' in response.flags:
+            return response
+
+        bucket = EdgarRateLimitMiddleware.bucket
+
+        if response.status not in self.throttle_codes:
+            bucket.succeeded()
+            return response
+
+        bucket.throttled()
+        retries = request.meta.get('sec_retry_times', 0) + 1
+        if retries > self.max_retries:
+            logging.error(f'Giving up on {request.url} after {self.max_retries} retries (HTTP {response.status})')
+            self.stats.inc_value('rate_limiter/gave_up')
+            return response
+
+        retry = request.copy()
+        retry.meta['sec_retry_times'] = retries
+        # Jitter keeps parallel spiders from retrying in lockstep, but never retries sooner than SEC asked to
+        retry.meta['sec_retry_delay'] = max(random.uniform(0.5, 1.5) * self.backoff * 2 ** (retries - 1), retry_after(response))
+        retry.dont_filter = True
+        self.stats.inc_value('rate_limiter/retries')
+        self.stats.inc_value(f'rate_limiter/retries/{response.status}')
+        logging.info(f'Retrying {request.url} in {retry.meta["sec_retry_delay"]:.1f}s (HTTP {response.status}, attempt {retries})')
+        return retry
+
+    def _limited(self, request):
+        hostname = urlparse(request.url).hostname or ''
+        return any(hostname == host or hostname.endswith('.' + host) for host in self.hosts)
+
+
+def retry_after(response):
+    """
+    Reads the Retry-After header of a throttled response
+
+    :param response: The Scrapy Response
+    :return (float): Seconds to wait, given directly or as an HTTP date, or 0 if the header is missing or malformed
+    """
+
+    value = response.headers.get('Retry-After')
+    if not value:
+        return 0.0
+    value = value.decode('latin-1').strip()
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return 0.0
@@ -0,0 +1,267 @@
+from concurrent.futures import ProcessPoolExecutor
+from xml_parser import INFO_TABLE_PARSERS
+from sqlite_store import SqliteStore, per_process
+from hashlib import sha1
+import gzip
+import logging
+import mmap
+import os
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+RAW_ARCHIVE_DIR = './13F_Reports/raw_archive'
+# A new segment file is started once the current one reaches this size
+SEGMENT_SIZE = 256 * 1024 * 1024
+
+
+def _compress(data):
+    """
+    :param data: Raw document bytes
+    :return (str, bytes): The codec used and the compressed bytes, zstd when the zstandard package is installed and gzip otherwise
+    """
+
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=3).compress(data)
+    return 'gzip', gzip.compress(data, compresslevel=6)
+
+
+def _decompress(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('The zstandard package is required to read zstd compressed documents, install it with: pip install zstandard')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class RawArchive(SqliteStore):
+    """
+    Append-only archive of the raw XML documents of every ingested filing, so reports can be parsed again without going back to SEC.
+
+    Each document is compressed on its own and appended to the current segment file (segment-000000.dat, ...). An SQLite index maps
+    (accession, document) to the segment, offset and length of the compressed bytes, plus the values needed to parse it again. Appends write to
+    the segment inside a SqliteStore.transaction, which holds SQLite's write lock, so worker processes and parallel spiders can share an archive.
+    Segments are read through read-only memory maps, so a random read costs one page-cache slice and a decompression.
+
+    :var path (str): Directory holding the segments and index.db
+    """
+
+    def __init__(self, path=RAW_ARCHIVE_DIR):
+        """
+        Opens (and creates if needed) the archive
+
+        :param path: Directory of the archive
+        """
+
+        os.makedirs(path, exist_ok=True)
+        super().__init__(os.path.join(path, 'index.db'), ["""
+            CREATE TABLE IF NOT EXISTS documents (
+                accession TEXT NOT NULL,
+                document TEXT NOT NULL,
+                cik TEXT,
+                date TEXT,
+                segment INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                raw_length INTEGER NOT NULL,
+                codec TEXT NOT NULL,
+                sha1 TEXT NOT NULL,
+                archived_at REAL NOT NULL,
+                PRIMARY KEY (accession, document)
+            )
+        """])
+        # The archive directory, the index lives in index.db inside it
+        self.path = path
+        self._maps = { }
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f'segment-{segment:06d}.dat')
+
+    def __contains__(self, key):
+        """
+        :param key: (accession, document) tuple
+        :return (bool): Whether the document is archived
+        """
+
+        return self._connection.execute('SELECT 1 FROM documents WHERE accession = ? AND document = ?', key).fetchone() is not None
+
+    def add(self, accession, document, raw_xml, cik=None, date=None):
+        """
+        Compresses a document and appends it to the archive. A document already archived with the same content is not written again
+
+        :param accession: The filing's accession number
+        :param document: 'primary_doc' or 'info_table'
+        :param raw_xml: The raw XML bytes
+        :param cik: The filer's CIK, used in the .tsv file name of info tables
+        :param date: The filing date used in the .tsv file name of info tables
+        :return (bool): Whether the document was written
+        """
+
+        if isinstance(raw_xml, str):
+            raw_xml = raw_xml.encode('utf-8')
+        digest = sha1(raw_xml).hexdigest()
+        # Compress before taking the write lock, so other writers only wait for the append itself
+        codec, compressed = _compress(raw_xml)
+
+        with self.transaction() as connection:
+            existing = connection.execute('SELECT sha1 FROM documents WHERE accession = ? AND document = ?', (accession, document)).fetchone()
+            if existing is not None and existing[0] == digest:
+                return False
+
+            segment = connection.execute('SELECT COALESCE(MAX(segment), 0) FROM documents').fetchone()[0]
+            if os.path.exists(self._segment_path(segment)) and os.path.getsize(self._segment_path(segment)) >= SEGMENT_SIZE:
+                segment += 1
+
+            with open(self._segment_path(segment), 'ab') as segment_file:
+                offset = segment_file.tell()
+                segment_file.write(compressed)
+
+            connection.execute('INSERT OR REPLACE INTO documents (accession, document, cik, date, segment, offset, length, raw_length, codec, sha1, '
+                               'archived_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (accession, document, cik, date, segment, offset, len(compressed), len(raw_xml), codec, digest, time.time()))
+
+        return True
+
+    def get(self, accession, document):
+        """
+        Looks up the index entry of a document
+
+        :param accession: The filing's accession number
+        :param document: 'primary_doc' or 'info_table'
+        :return (dict | None): The entry, or None if the document isn't archived
+        """
+
+        cursor = self._connection.execute('SELECT * FROM documents WHERE accession = ? AND document = ?', (accession, document))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def read(self, accession, document):
+        """
+        Reads a document back from its segment's memory map
+
+        :param accession: The filing's accession number
+        :param document: 'primary_doc' or 'info_table'
+        :return (bytes | None): The raw XML, or None if the document isn't archived
+        """
+
+        entry = self.get(accession, document)
+        if entry is None:
+            return None
+        return _decompress(entry['codec'], self._slice(entry['segment'], entry['offset'], entry['length']))
+
+    def _slice(self, segment, offset, length):
+        with self._lock:
+            segment_map = self._maps.get(segment)
+            # Segments only grow, remap the current one once it has grown past the mapped size
+            if segment_map is None or offset + length > len(segment_map):
+                if segment_map is not None:
+                    segment_map.close()
+                with open(self._segment_path(segment), 'rb') as segment_file:
+                    segment_map = self._maps[segment] = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return segment_map[offset:offset + length]
+
+    def entries(self, document=None):
+        """
+        Lists the archived documents, in the order they were archived
+
+        :param document: Only list 'primary_doc' or 'info_table' documents
+        :return (list): Index entries, as returned by get()
+        """
+
+        query = 'SELECT * FROM documents'
+        parameters = ()
+        if document is not None:
+            query += ' WHERE document = ?'
+            parameters = (document,)
+        cursor = self._connection.execute(query + ' ORDER BY segment, offset', parameters)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def close(self):
+        with self._lock:
+            for segment_map in self._maps.values():
+                segment_map.close()
+            self._maps.clear()
+        super().close()
+
+
+def get_raw_archive(path=RAW_ARCHIVE_DIR):
+    """
+    Returns this process' shared RawArchive for a directory, opening it on first use. None disables archiving
+
+    :param path: Directory of the archive, or None
+    :return (RawArchive | None): The archive
+    """
+
+    if not path:
+        return None
+    return per_process(('raw_archive', path), lambda: RawArchive(path))
+
+
+def _reparse_document(entry, parser, columnar, path):
+    """
+    Parses one archived document again. Runs inside a worker process, which reads the document from the archive itself so only the index
+    entry crosses the process boundary
+
+    :param entry: The document's index entry
+    :param parser: Key into INFO_TABLE_PARSERS
+    :param columnar: Also write the report as typed columns
+    :param path: Directory of the archive
+    :return (dict): The result of pipelines.parse_document
+    """
+
+    # Imported here, pipelines imports this module to archive documents as they are parsed
+    from pipelines import parse_document
+
+    item = {'document': entry['document'], 'raw_xml': get_raw_archive(path).read(entry['accession'], entry['document']), 'accession': entry['accession']}
+    if entry['document'] == 'info_table':
+        item.update({'fund_cik': entry['cik'], 'date': entry['date'], 'parser': parser, 'columnar': columnar})
+    return parse_document(item)
+
+
+def reparse(parser='lxml', columnar=False, workers=None, path=RAW_ARCHIVE_DIR):
+    """
+    Rebuilds every .tsv report, the summary store and the manifest from the archive, without any network access
+
+    :param parser: Key into INFO_TABLE_PARSERS selecting the engine used for 13F Holdings Reports
+    :param columnar: Also write each report as typed columns
+    :param workers: Number of worker processes (defaults to the number of CPUs)
+    :param path: Directory of the archive
+    :return (dict): The number of documents and rows parsed, and the failures
+    """
+
+    if parser not in INFO_TABLE_PARSERS:
+        logging.warning(f'Unknown parser \'{parser}\', falling back to \'lxml\'')
+        parser = 'lxml'
+
+    if not os.path.exists(os.path.join(path, 'index.db')):
+        logging.warning(f'No raw archive found in {path}')
+        return {'documents': 0, 'rows': 0, 'failed': 0}
+
+    entries = get_raw_archive(path).entries()
+    logging.info(f'Reparsing {len(entries)} archived documents with the {parser} parser')
+    start = time.perf_counter()
+    totals = {'documents': 0, 'rows': 0, 'failed': 0}
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = [(entry, executor.submit(_reparse_document, entry, parser, columnar, path)) for entry in entries]
+        for entry, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                totals['failed'] += 1
+                logging.warning(f'Failed to reparse {entry["document"]} of {entry["accession"]}: {e}')
+                continue
+
+            totals['documents'] += 1
+            if entry['document'] == 'info_table':
+                totals['rows'] += result['rows']
+
+    logging.info(f'Reparsed {totals["documents"]} documents ({totals["rows"]} holdings) in {time.perf_counter() - start:.1f}s, {totals["failed"]} failed')
+    return totals
@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+import os
+from urllib.request import pathname2url
+import sqlite3
+import threading
+
+
+class SqliteStore:
+    """
+    Base class of the SQLite-backed stores (summaries, manifest, raw archive index, batch ledger).
+
+    The connection runs in autocommit mode with WAL journaling and a busy timeout, so SQLite's file locking serializes writers across processes,
+    while a lock serializes the threads sharing this connection. Writes spanning several statements go through transaction().
+
+    :var path (str): Location of the SQLite database file, or ':memory:'
+    """
+
+    def __init__(self, path, schema=(), read_only=False):
+        """
+        Opens (and creates if needed) the database
+
+        :param path: Location of the SQLite database file, or ':memory:'
+        :param schema: CREATE ... IF NOT EXISTS statements run on every open
+        :param read_only: Open an existing database without creating or changing anything, for readers running next to a crawl
+        """
+
+        self.path = path
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        if read_only:
+            self._connection = sqlite3.connect(f'file:{pathname2url(os.path.abspath(path))}?mode=ro', uri=True, timeout=60,
+                                               check_same_thread=False, isolation_level=None)
+            return
+
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        for statement in schema:
+            self._connection.execute(statement)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the statements of the with block as one write transaction. The write lock is taken up front (BEGIN IMMEDIATE), so reads inside the
+        block see the state the writes are based on, and the transaction is rolled back if the block raises
+
+        :return (Connection): The connection
+        """
+
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def close(self):
+        self._connection.close()
+
+
+_instances = { }
+
+
+def per_process(key, factory):
+    """
+    Returns this process' shared instance for a key, creating it with factory on first use. SQLite connections, memory maps and open files
+    must not be shared with forked worker processes, so a process that finds an instance created by its parent makes its own
+
+    :param key: Hashable key of the instance, such as a store's path
+    :param factory: Callable creating the instance
+    :return: The instance
+    """
+
+    instance = _instances.get(key)
+    if instance is None or instance[0] != os.getpid():
+        instance = _instances[key] = (os.getpid(), factory())
+    return instance[1]
@@ -0,0 +1,135 @@
+from sqlite_store import SqliteStore, per_process
+import csv
+import json
+import logging
+import os
+
+
+SUMMARY_DB_PATH = './13F_Reports/search_summary.db'
+SUMMARY_TSV_PATH = './13F_Reports/search_summary.tsv'
+
+
+class SummaryStore(SqliteStore):
+    """
+    Keyed store for the flattened primary_doc.xml summaries, backed by SQLite.
+
+    Each summary is stored as a JSON document under the primary key (filer_cik, period), so upserting a filing is a single B-tree lookup instead of
+    a read-rewrite of the whole search_summary.tsv file. Writers are serialized across processes and threads, see SqliteStore.
+
+    :var path (str): Location of the SQLite database file
+    """
+
+    def __init__(self, path=SUMMARY_DB_PATH):
+        """
+        Opens (and creates if needed) the summary database
+
+        :param path: Location of the SQLite database file
+        """
+
+        super().__init__(path, ["""
+            CREATE TABLE IF NOT EXISTS summary (
+                filer_cik TEXT NOT NULL,
+                period TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (filer_cik, period)
+            )
+        """])
+
+    def upsert(self, fund):
+        """
+        Inserts the summary for a filing, or overwrites the existing one for the same filer and period
+
+        :param fund: Dict of flattened primary_doc.xml tag names to values. Must contain filer_cik and reportcalendarorquarter
+        """
+
+        filer_cik = fund.get('filer_cik', fund.get('filingmanager_name', 'N/A'))
+        period = fund.get('reportcalendarorquarter', 'N/A')
+
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO summary (filer_cik, period, data) VALUES (?, ?, ?)', (filer_cik, period, json.dumps(fund)))
+
+    def import_tsv(self, path=SUMMARY_TSV_PATH):
+        """
+        Loads the summaries from an existing search_summary.tsv, used to migrate files written before the store existed
+
+        :param path: Location of the .tsv file
+        :return (int): The number of summaries imported
+        """
+
+        count = 0
+        try:
+            with open(path, 'rt') as tsv_file:
+                for line in csv.DictReader(tsv_file, delimiter='\t'):
+                    self.upsert({header: value for header, value in line.items() if value != 'N/A'})
+                    count += 1
+        except IOError:
+            logging.debug(f'Failed to open {path}')
+
+        return count
+
+    def get(self, filer_cik, period):
+        """
+        Looks up the summary of a single filing
+
+        :param filer_cik: The filer's CIK
+        :param period: The reportCalendarOrQuarter of the filing
+        :return (dict | None): The stored summary, or None if it doesn't exist
+        """
+
+        row = self._connection.execute('SELECT data FROM summary WHERE filer_cik = ? AND period = ?', (filer_cik, period)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def __iter__(self):
+        """
+        Iterates over every stored summary, ordered by filer and period
+
+        :return (generator): One dict per stored filing
+        """
+
+        for (data,) in self._connection.execute('SELECT data FROM summary ORDER BY filer_cik, period'):
+            yield json.loads(data)
+
+    def export_tsv(self, path=SUMMARY_TSV_PATH):
+        """
+        Writes every stored summary to a .tsv file with sorted headers, using the N/A placeholder for tags a filing doesn't have
+
+        :param path: Location of the .tsv file
+        :return (int): The number of summaries written
+        """
+
+        headers = set()
+        for fund in self:
+            headers.update(fund)
+        headers = sorted(headers)
+
+        count = 0
+        try:
+            with open(path, 'wt') as tsv_file:
+                tsv_writer = csv.writer(tsv_file, delimiter='\t')
+                tsv_writer.writerow(headers)
+                for fund in self:
+                    tsv_writer.writerow([fund.get(header, 'N/A') for header in headers])
+                    count += 1
+        except IOError:
+            logging.debug(f'Failed to open {path}')
+
+        return count
+
+
+def get_summary_store():
+    """
+    Returns this process' shared SummaryStore, opening it on first use
+
+    :return (SummaryStore): The shared summary store
+    """
+
+    return per_process(('summary_store', SUMMARY_DB_PATH), _open_summary_store)
+
+
+def _open_summary_store():
+    migrate = not os.path.exists(SUMMARY_DB_PATH) and os.path.exists(SUMMARY_TSV_PATH)
+    store = SummaryStore()
+    if migrate:
+        logging.info(f'Importing existing {SUMMARY_TSV_PATH} into {SUMMARY_DB_PATH}...')
+        store.import_tsv()
+    return store
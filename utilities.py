@@ -1,9 +1,13 @@
 from test_data import test_data
-from twisted.internet import reactor
-from scrapy.crawler import CrawlerRunner
+from twisted.internet import reactor, defer
+from scrapy.crawler import Crawler, CrawlerRunner
+from scrapy.settings import Settings
 from mutual_fund_spider import MutualFundsSpider
+from batch_ledger import BatchLedger, resume_spider_dir
+import itertools
 import os
 import sys
+import time
 import logging
 
 
@@ -26,26 +30,192 @@ def make_13f_dir():
             sys.exit()
 
 
-def run_test():
+def extract_cik(entry):
     """
-    Runs an asynchronous crawler process for every ticker in test_data in parallel
+    Extracts the CIK from a ticker formatted "Name | CIK" or "CIK | Name", or a bare CIK
 
-    :return: None
+    :param entry: The ticker or CIK
+    :return (str): The CIK
     """
 
-    runner = CrawlerRunner()
+    temp = entry.split('|')
 
-    for index, test in enumerate(test_data):
-        temp = test.split('|')
+    try:
+        int(temp[0].strip())
+        return temp[0].strip()
+    except ValueError:
+        return temp[-1].strip()
 
-        try:
-            int(temp[0].strip())
-            test_cik = temp[0].strip()
-        except ValueError:
-            test_cik = temp[1].strip()
 
-        runner.crawl(MutualFundsSpider, depth=1, cik=test_cik)
+def read_ciks(source):
+    """
+    Streams CIKs from a file with one ticker or CIK per line, or from stdin when source is "-". Blank lines and lines starting with # are skipped
+
+    :param source: Path of the CIK list file, or "-" for stdin
+    :return (generator): One CIK per entry
+    """
+
+    cik_file = sys.stdin if source == '-' else open(source, 'rt')
+
+    try:
+        for line in cik_file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield extract_cik(line)
+    finally:
+        if cik_file is not sys.stdin:
+            cik_file.close()
+
+
+def crawl_succeeded(crawler):
+    """
+    Checks a finished crawler's stats for signs that its filer was not fully crawled
+
+    :param crawler: The finished Scrapy Crawler
+    :return (bool): True if the spider finished normally, without exceptions, requests that ran out of retries, pages or documents that failed to
+        download (see MutualFundsSpider.request_failed) or documents that failed to parse (see ParsingPipeline)
+    """
+
+    stats = crawler.stats.get_stats()
+    return stats.get('finish_reason') == 'finished' and not any(stats.get(key) for key in ('spider_exceptions/count', 'retry/max_reached',
+                                                                                          'rate_limiter/gave_up', 'requests/failed', 'parser/failed'))
+
+
+def crawler_settings(overrides=None, **defaults):
+    """
+    Builds the settings of a CrawlerProcess or CrawlerRunner. Spider custom_settings take precedence over plain project settings, so overrides are
+    set with command-line priority to win over MutualFundsSpider.custom_settings as well
+
+    :param overrides: Settings that override the spider's own
+    :param defaults: Settings the spider may override
+    :return (Settings): The settings
+    """
+
+    settings = Settings(defaults)
+    settings.setdict(overrides or { }, priority='cmdline')
+    return settings
+
+
+def run_batch(ciks, max_spiders=8, max_requests=16, settings=None, job=None, retries=1, **spider_kwargs):
+    """
+    Crawls every CIK through a single CrawlerRunner, with at most max_spiders spiders running at once.
+
+    Each filer gets its own MutualFundsSpider, so an error in one filer never stops the others. Requests are capped globally by giving each
+    spider an equal share of max_requests, and at least one request, so max_spiders is lowered to max_requests when it is higher. Filers that
+    failed are crawled again in up to retries further passes, once every other filer is done. A throughput summary is logged once every filer
+    has been crawled.
+
+    With a job directory, the state of every filer is kept in a BatchLedger and each spider gets its own Scrapy JOBDIR, so running the same job
+    again after a crash resumes it: done filers are skipped, interrupted filers continue from their queued requests, failed ones are retried.
 
-    deferred = runner.join()
-    deferred.addBoth(lambda _: reactor.stop())
+    :param ciks: Iterable of CIKs, consumed lazily
+    :param max_spiders: Maximum number of spiders crawling at once
+    :param max_requests: Maximum number of concurrent requests across all spiders
+    :param settings: Scrapy settings overriding MutualFundsSpider.custom_settings, see crawler_settings
+    :param job: Directory of the job to start or resume, or None to not persist the batch
+    :param retries: Number of extra passes over the failed filers
+    :param spider_kwargs: Passed to every MutualFundsSpider (depth, since, parser...)
+    :return (dict): Lists of the 'done' and 'failed' CIKs
+    """
+
+    if max_spiders > max_requests:
+        # Every spider needs at least one request slot, more spiders than requests would go over the global cap
+        logging.warning(f'Crawling {max_requests} filers at once instead of {max_spiders}, to stay within {max_requests} concurrent requests')
+        max_spiders = max_requests
+
+    runner = CrawlerRunner(crawler_settings(settings, CONCURRENT_REQUESTS=max(max_requests // max_spiders, 1)))
+    ledger = BatchLedger(job)
+    results = {'done': [], 'failed': []}
+    totals = {'documents': 0, 'responses': 0}
+    start_time = time.time()
+
+    if job is not None:
+        counts = ledger.counts()
+        if sum(counts.values()):
+            logging.info(f'Resuming job {job}: {counts["done"]} filers done, {counts["in_flight"]} interrupted, {counts["pending"]} pending, {counts["failed"]} failed')
+        # Filers in flight when the last run stopped are picked up again with their JOBDIR, failed ones start over
+        ledger.requeue(['in_flight', 'failed'])
+
+    # Only read the CIK source ahead of the crawl in batches, a 100k line file is never held in memory
+    ciks = iter(ciks)
+
+    def claim():
+        while True:
+            cik = ledger.claim()
+            if cik is None:
+                # Nothing pending, move the next few CIKs of the source into the ledger. CIKs it already knows (done in an earlier run) are skipped
+                batch = list(itertools.islice(ciks, max_spiders))
+                if not batch:
+                    return
+                ledger.add(batch)
+                continue
+            yield cik
+
+    @defer.inlineCallbacks
+    def worker(queue):
+        # Every worker pulls from the same queue, so at most max_spiders CIKs are in progress
+        for cik in queue:
+            spider_dir = ledger.spider_dir(cik)
+            spider_settings = runner.settings.copy()
+            if spider_dir is not None:
+                if os.path.isdir(spider_dir):
+                    resume_spider_dir(spider_dir)
+                spider_settings.set('JOBDIR', spider_dir, priority='cmdline')
+
+            crawler = Crawler(MutualFundsSpider, spider_settings)
+            try:
+                yield runner.crawl(crawler, cik=cik, **spider_kwargs)
+            except Exception as e:
+                logging.error(f'Crawl for CIK {cik} failed: {e}')
+                ledger.finish(cik, False, str(e))
+                continue
+
+            totals['documents'] += crawler.stats.get_value('item_scraped_count', 0)
+            totals['responses'] += crawler.stats.get_value('downloader/response_count', 0)
+            succeeded = crawl_succeeded(crawler)
+            ledger.finish(cik, succeeded, None if succeeded else crawler.stats.get_value('finish_reason'))
+            if succeeded:
+                results['done'].append(cik)
+
+    @defer.inlineCallbacks
+    def run_passes():
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                failed = ledger.requeue(['failed'])
+                if not failed:
+                    break
+                logging.info(f'Retrying {failed} failed filers (pass {attempt + 1} of {retries + 1})')
+
+            queue = claim()
+            yield defer.DeferredList([worker(queue) for _ in range(max_spiders)])
+
+    def stop(result):
+        # An empty batch finishes without ever waiting on the reactor, which must not be stopped before it runs
+        if reactor.running:
+            reactor.stop()
+        return result
+
+    reactor.callWhenRunning(lambda: run_passes().addBoth(stop))
     reactor.run()
+
+    results['failed'] = ledger.ciks('failed')
+    ledger.close()
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    filers = len(results['done']) + len(results['failed'])
+    logging.info(f'Crawled {filers} filers ({len(results["failed"])} failed) in {elapsed:.1f}s: '
+                 f'{filers / elapsed * 60:.1f} filers/min, {totals["documents"] / elapsed:.2f} docs/sec, {totals["responses"] / elapsed:.2f} responses/sec')
+    if results['failed']:
+        logging.warning(f'Failed CIKs: {", ".join(results["failed"])}')
+
+    return results
+
+
+def run_test():
+    """
+    Runs an asynchronous crawler process for every ticker in test_data in parallel
+
+    :return: None
+    """
+
+    run_batch((extract_cik(test) for test in test_data), max_spiders=len(test_data), max_requests=8 * len(test_data), depth=1)
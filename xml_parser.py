@@ -1,10 +1,117 @@
 from bs4 import BeautifulSoup
+from lxml import etree
+from io import BytesIO
 from utilities import *
+from summary_store import get_summary_store
+from columnar import ColumnarHoldingsWriter, columnar_path
+from instrumentation import end_stage
 import logging
+import time
 import csv
+import os
 
 
-def parse_info_table(raw_xml, fund_name, date):
+def holdings_tsv_path(fund_name, date):
+    """
+    :param fund_name: The name (CIK) of the filer
+    :param date: The period of the report
+    :return (str): Path of the .tsv file of a 13F holdings report
+    """
+
+    return f'./13F_Reports/{fund_name.lower().strip()}_13f_holdings_{date.lower().strip()}.tsv'
+
+
+
+# Columns of the 13F information table schema, in schema order. Children of votingAuthority are prefixed with their parent's name
+INFO_TABLE_COLUMNS = ('nameofissuer', 'titleofclass', 'cusip', 'value', 'sshprnamt', 'sshprnamttype', 'putcall', 'investmentdiscretion', 'othermanager',
+                      'votingauthority_sole', 'votingauthority_shared', 'votingauthority_none')
+
+
+class HoldingsTsvWriter:
+    """
+    Writes a 13F holdings .tsv file one row at a time, so nothing but the current row is held in memory.
+
+    The header is written up front from the information table schema (INFO_TABLE_COLUMNS) and each value is placed through a dict of column
+    positions. A tag outside the schema is appended as a new column when first seen; rows written before it are padded with the N/A placeholder
+    by a single pass over the file on close(), which only runs when that happened.
+
+    Rows go to a temporary file that close() renames to the report's path, so readers never see a partial report. Call abort() instead when
+    parsing fails, to delete it.
+
+    :var rows (int): Number of rows written
+    """
+
+    def __init__(self, path, columns=INFO_TABLE_COLUMNS):
+        """
+        :param path: Path of the .tsv file
+        :param columns: Columns known up front
+        """
+
+        self.path = path
+        self.columns = list(columns)
+        self.positions = {name: index for index, name in enumerate(self.columns)}
+        self.header_width = len(self.columns)
+        self.rows = 0
+        self.temp_path = f'{path}.{os.getpid()}.tmp'
+        self.file = open(self.temp_path, 'wt')
+        self.writer = csv.writer(self.file, delimiter='\t')
+        self.writer.writerow(self.columns)
+
+    def write(self, row):
+        """
+        Appends one row
+
+        :param row: Dict of column name -> text value
+        """
+
+        values = ['N/A'] * len(self.columns)
+        for name, value in row.items():
+            position = self.positions.get(name)
+            if position is None:
+                position = self.positions[name] = len(self.columns)
+                self.columns.append(name)
+                values.append('N/A')
+            values[position] = value
+
+        self.writer.writerow(values)
+        self.rows += 1
+
+    def close(self):
+        """
+        Closes the report, first adding the columns discovered after the header was written, if any, and moves it to its path
+        """
+
+        self.file.close()
+
+        try:
+            if len(self.columns) > self.header_width:
+                fixed_path = f'{self.temp_path}.fixed'
+                with open(self.temp_path, 'rt', newline='') as written_file, open(fixed_path, 'wt') as fixed_file:
+                    reader = csv.reader(written_file, delimiter='\t')
+                    writer = csv.writer(fixed_file, delimiter='\t')
+                    next(reader)
+                    writer.writerow(self.columns)
+                    padding = len(self.columns)
+                    for values in reader:
+                        writer.writerow(values + ['N/A'] * (padding - len(values)))
+                os.replace(fixed_path, self.temp_path)
+            os.replace(self.temp_path, self.path)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        """
+        Closes and deletes the partial report. A report written earlier to the same path is left as it was
+        """
+
+        self.file.close()
+        for path in (self.temp_path, f'{self.temp_path}.fixed'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def parse_info_table(raw_xml, fund_name, date, columnar=False):
     """
     Parses the 13F Holdings Report XML document, and writes it to a .tsv file.
 
@@ -13,8 +120,11 @@ def parse_info_table(raw_xml, fund_name, date):
     :param raw_xml: The raw XML object to be parsed
     :param fund_name: The name of the filer
     :param date: The period of this report
+    :param columnar: Also write the report as typed columns, see columnar.py
+    :return (int): The number of holdings written
     """
 
+    stage_start = time.perf_counter()
     soup = BeautifulSoup(raw_xml, 'lxml')
 
     # Check for a variant of tag names prepended by ns1:
@@ -22,8 +132,42 @@ def parse_info_table(raw_xml, fund_name, date):
     if not info_tables:
         info_tables = soup.find_all('ns1:infotable')
 
-    headers = []
-    processed_tables = []
+    # Raises if the report can't be created, so the filing isn't recorded as ingested
+    tsv_writer = HoldingsTsvWriter(holdings_tsv_path(fund_name, date))
+
+    columnar_writer = None
+    if columnar:
+        try:
+            columnar_writer = ColumnarHoldingsWriter(columnar_path(fund_name, date))
+        except ImportError as e:
+            logging.warning(str(e))
+
+    try:
+        stage_start = _write_info_tables(info_tables, tsv_writer, columnar_writer, stage_start)
+    except BaseException:
+        # Delete the partial report, the previous report (if any) stays in place
+        tsv_writer.abort()
+        raise
+
+    tsv_writer.close()
+    stage_start = end_stage('write', stage_start)
+    if columnar_writer is not None:
+        columnar_writer.close()
+        end_stage('write_columnar', stage_start)
+
+    return tsv_writer.rows
+
+
+def _write_info_tables(info_tables, tsv_writer, columnar_writer, stage_start):
+    """
+    Flattens the infoTable elements found by parse_info_table and writes them to its writers
+
+    :param info_tables: The BeautifulSoup infoTable elements
+    :param tsv_writer: The HoldingsTsvWriter
+    :param columnar_writer: The ColumnarHoldingsWriter, or None
+    :param stage_start: perf_counter value the first parse stage is timed from
+    :return (float): perf_counter value the next stage is timed from
+    """
 
     # Iterate through each info table, and replace prepend parent tag name onto children to avoid losing hierarchy data
     for table in info_tables:
@@ -52,59 +196,150 @@ def parse_info_table(raw_xml, fund_name, date):
         for tag in table.findAll(lambda element: element.text is not None and not element.findAll()):
             # Remove ns1: from the tag names that will become TSV headers
             name = tag.name.split(':')[1] if 'ns1' in tag.name else tag.name
-            if name not in headers:
-                headers.append(name)
             new_table[name] = tag.text.strip()
 
-        processed_tables.append(new_table)
+        stage_start = end_stage('parse', stage_start)
+
+        # Write each processed info table into the .tsv file as a new line, tags missing from it are filled with the N/A placeholder
+        tsv_writer.write(new_table)
+        stage_start = end_stage('write', stage_start)
+        if columnar_writer is not None:
+            columnar_writer.add(new_table)
+            stage_start = end_stage('write_columnar', stage_start)
+
+    return stage_start
+
+
+def _local_name(tag):
+    """
+    Strips the namespace URI ({...}) or prefix (ns1:) from an lxml tag and lowercases it, matching the tag names produced by BeautifulSoup
 
-    # Write the headers and each processed info table into the .tsv file as a new line
+    :param tag: The lxml tag name
+    :return (str): The bare, lowercase tag name
+    """
+
+    return tag.rsplit('}', 1)[-1].rsplit(':', 1)[-1].lower()
+
+
+def iter_info_table_rows(raw_xml):
+    """
+    Streams the 13F Holdings Report XML document with lxml's iterparse, yielding each infoTable flattened into a dict of header -> value.
+
+    Children of votingAuthority are prefixed with their parent's name (votingauthority_sole, ...) just like parse_info_table. Each infoTable is cleared, and
+    its already processed siblings deleted, as soon as it has been flattened so memory stays bounded no matter how many holdings the report contains.
+
+    :param raw_xml: The raw XML object to be parsed
+    :return (generator): One dict per infoTable, in document order
+    """
+
+    if isinstance(raw_xml, str):
+        raw_xml = raw_xml.encode('utf-8')
+
+    # recover=True lets lxml keep going when the ns1: prefix is used without being declared
+    context = etree.iterparse(BytesIO(raw_xml), events=('end',), recover=True, huge_tree=True)
+
+    for _, element in context:
+        if not isinstance(element.tag, str) or _local_name(element.tag) != 'infotable':
+            continue
+
+        row = { }
+        # Only leaf elements carry values, iterdescendants(tag=etree.Element) skips comments and processing instructions
+        for child in element.iterdescendants(tag=etree.Element):
+            if len(child):
+                continue
+            name = _local_name(child.tag)
+            if _local_name(child.getparent().tag) == 'votingauthority':
+                name = f'votingauthority_{name}'
+            row[name] = (child.text or '').strip()
+
+        yield row
+
+        # Free the finished infoTable and everything parsed before it
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    del context
+
+
+def parse_info_table_streaming(raw_xml, fund_name, date, columnar=False):
+    """
+    Streaming variant of parse_info_table built on lxml.etree.iterparse. Produces the same .tsv file and columns without building a BeautifulSoup tree.
+
+    :param raw_xml: The raw XML object to be parsed
+    :param fund_name: The name of the filer
+    :param date: The period of this report
+    :param columnar: Also write the report as typed columns, see columnar.py
+    :return (int): The number of holdings written
+    """
+
+    stage_start = time.perf_counter()
+    # Raises if the report can't be created, so the filing isn't recorded as ingested
+    tsv_writer = HoldingsTsvWriter(holdings_tsv_path(fund_name, date))
+
+    columnar_writer = None
+    if columnar:
+        try:
+            columnar_writer = ColumnarHoldingsWriter(columnar_path(fund_name, date))
+        except ImportError as e:
+            logging.warning(str(e))
+
+    # Each row is written as soon as it is parsed, so memory doesn't grow with the number of holdings
     try:
-        with open(f'./13F_Reports/{fund_name.lower().strip()}_13f_holdings_{date.lower().strip()}.tsv', 'wt') as tsv_file:
-            tsv_writer = csv.writer(tsv_file, delimiter='\t')
-            tsv_writer.writerow(headers)
-
-            for table in processed_tables:
-                row_builder = []
-                for header in headers:
-                    if header in table:
-                        row_builder.append(table[header])
-                    else:
-                        # If this report is missing a tag name that another report has, fill it with N/A placeholder
-                        row_builder.append('N/A')
-                tsv_writer.writerow(row_builder)
-    except IOError:
-        logging.debug(f'Failed to create ./13F_Reports/{fund_name.lower().strip()}_13f_holdings_{date.lower().strip()}.tsv')
+        for row in iter_info_table_rows(raw_xml):
+            stage_start = end_stage('parse', stage_start)
+            tsv_writer.write(row)
+            stage_start = end_stage('write', stage_start)
+            if columnar_writer is not None:
+                columnar_writer.add(row)
+                stage_start = end_stage('write_columnar', stage_start)
+    except BaseException:
+        # Delete the partial report, the previous report (if any) stays in place
+        tsv_writer.abort()
+        raise
+
+    stage_start = end_stage('parse', stage_start)
+    tsv_writer.close()
+    stage_start = end_stage('write', stage_start)
+    if columnar_writer is not None:
+        columnar_writer.close()
+        end_stage('write_columnar', stage_start)
+
+    return tsv_writer.rows
+
+
+def amendment_type(summary):
+    """
+    :param summary: A primary_doc.xml summary, as returned by parse_primary_doc
+    :return (str | None): RESTATEMENT or NEW HOLDINGS for a 13F-HR/A amendment, None for an original report
+    """
+
+    if summary.get('isamendment', '').strip().lower() != 'true':
+        return None
+    # An amendment that doesn't say which kind it is is taken to restate the whole report
+    return summary.get('amendmenttype', '').strip().upper() or 'RESTATEMENT'
+
+
+# Engines available for parsing the 13F Holdings Report, selectable with the -parser command-line argument
+INFO_TABLE_PARSERS = {
+    'lxml': parse_info_table_streaming,
+    'soup': parse_info_table,
+}
 
 
 def parse_primary_doc(raw_xml):
     """
-    Parses the primary_doc.xml document and appends or overwrites its values to search_summary.tsv
+    Parses the primary_doc.xml document and upserts its values into the summary store, keyed by filer CIK and report period.
+    Use SummaryStore.export_tsv() to write search_summary.tsv.
 
     :param raw_xml: The raw XML object to be parsed
+    :return (dict): The flattened summary
     """
 
+    stage_start = time.perf_counter()
     soup = BeautifulSoup(raw_xml, 'lxml')
 
-    headers = []
-    existing_funds = []
     new_fund = { }
-    found_existing = False
-
-    # Get the existing headers and summary data if the search_summary.tsv file is already populated to maintain consistent headers
-    try:
-        with open("./13F_Reports/search_summary.tsv", "rt") as tsv_file:
-            reader = csv.reader(tsv_file, delimiter='\t')
-            for n, line in enumerate(reader):
-                if n == 0:
-                    headers = line
-                else:
-                    line_entry = { }
-                    for t, header in enumerate(headers):
-                        line_entry[header] = line[t]
-                    existing_funds.append(line_entry)
-    except IOError:
-        logging.info('No existing mutual_fund_summary.tsv file found, creating new one...')
 
     # Modify the tree to flatten the important sections with repeating tag names by prepending them with the tag names of their parents. Thereby preserving hierarchy in a flat structure
     soup.filer.replace_with(BeautifulSoup(f"""
@@ -135,42 +370,14 @@ def parse_primary_doc(raw_xml):
     </signatureblock>
     """, 'xml'))
 
-    # Find all XML tags that have text but no children, and add their names to headers array if they don't already exist
+    # Find all XML tags that have text but no children
     for tag in soup.findAll(lambda element: element.text.strip() is not None and not element.findAll()):
-        if tag.name not in headers:
-            headers.append(tag.name)
         new_fund[tag.name] = tag.text.strip()
 
-    # Check if the new document should replace an existing one or be appended
-    for n, fund in enumerate(existing_funds):
-        if 'filingmanager_name' in fund and fund['filingmanager_name'] == new_fund['filingmanager_name']:
-            logging.info('Fund already exists. Checking if this is a new version...')
-            if 'reportcalendarorquarter' in fund and fund['reportcalendarorquarter'] == new_fund['reportcalendarorquarter']:
-                # This is a duplicate and should be overwritten
-                existing_funds[n] = new_fund
-                found_existing = True
+    stage_start = end_stage('parse', stage_start)
 
-    # If the entry hasn't replaced an existing one, append it the array of existing funds
-    if not found_existing:
-        logging.info('New Fund, Appending to Existing...')
-        existing_funds.append(new_fund)
+    # Replace the existing entry for this filer and period, or add a new one
+    get_summary_store().upsert(new_fund)
+    end_stage('write', stage_start)
 
-    # Sort the headers to make it more orderly
-    headers.sort()
-
-    # Write the headers and entries to a search_summary.tsv file
-    try:
-        with open("./13F_Reports/search_summary.tsv", "wt") as tsv_file:
-            tsv_writer = csv.writer(tsv_file, delimiter='\t')
-            tsv_writer.writerow(headers)
-            for fund in existing_funds:
-                # Use row_builder to assemble each tsv line with the appropriate value or placeholder N/A
-                row_builder = []
-                for header in headers:
-                    if header in fund:
-                        row_builder.append(fund[header])
-                    else:
-                        row_builder.append('N/A')
-                tsv_writer.writerow(row_builder)
-    except IOError:
-        logging.debug('Failed to open ./13F_Reports/search_summary.tsv')
+    return new_fund